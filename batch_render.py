@@ -0,0 +1,226 @@
+#! /usr/bin/python
+"""
+Render many small trays with one OpenSCAD process.
+
+For a 1x1 to 3x3 tray, the geometry takes almost no time:  nearly all of the
+wall-clock goes into starting OpenSCAD, parsing the file and setting up CGAL.
+When a burst of them comes in, it's much faster to pay that once:
+
+    1. Lay the trays out on a grid, GAP mm apart, in one SCAD document built
+       from the createTray() objects
+    2. Render it with a single OpenSCAD run
+    3. Split the mesh back up by connected component, giving each component
+       to the tray whose region (its footprint plus half the gap) it sits in
+    4. Verify each tray's bounding box is exactly the one expected, and move
+       it back to the origin, where its own render would have put it
+
+Nothing is welded or re-meshed, each tray gets back the triangles OpenSCAD
+made for it.  A tray that fails the check is reported as such, and it's up
+to the caller to render it on its own (the render server does).
+
+    python3 batch_render.py batch.yaml --out-dir ./output_trays
+
+takes the same YAML list of trays as pack_plates.py.  Use --benchmark N to
+render N copies of a small tray one at a time and then as one batch, and
+report the speedup:
+
+    python3 batch_render.py --benchmark 8
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import yaml
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from solid import scad_render_to_file, translate, union
+
+from constants import *
+from generate_tray import LOG_IT, createTray, compute_tray_footprint, run_openscad, render_tray_stl, \
+    xScale, yScale, zScale
+from mesh_utils import read_stl, write_stl, mesh_bounds, translate_mesh
+
+# Trays with at most this many bins along each axis are worth batching
+MAX_BATCH_BINS = 3
+DEFAULT_BATCH_GAP = 10.0
+
+
+def is_small_tray(xlist, ylist, max_bins=MAX_BATCH_BINS):
+    return len(xlist) <= max_bins and len(ylist) <= max_bins
+
+
+def tray_spec_to_mm(spec):
+    """ MM copy of a tray param map (xlist, ylist, depth, wall, floor, round, units) """
+    rescale = 1.0 if spec.get('units', 'mm') == 'mm' else MM_PER_IN
+    out = {k: spec[k] * rescale for k in ('depth', 'wall', 'floor', 'round')}
+    out['xlist'] = [x * rescale for x in spec['xlist']]
+    out['ylist'] = [y * rescale for y in spec['ylist']]
+    return out
+
+
+def layout_batch(footprints, gap=DEFAULT_BATCH_GAP):
+    """
+    Puts (width, height) footprints on a roughly square grid of rows, gap apart.  Keeping the
+    batch compact keeps the coordinates small, and OpenSCAD only writes ~6 significant digits.
+    Returns the (x, y) offset of each.
+    """
+    ncols = max(1, int(np.ceil(np.sqrt(len(footprints)))))
+    offsets = []
+    y = 0.0
+    for row in range(0, len(footprints), ncols):
+        x = 0.0
+        for w, h in footprints[row:row + ncols]:
+            offsets.append((x, y))
+            x += w + gap
+        y += max(h for _, h in footprints[row:row + ncols]) + gap
+    return offsets
+
+
+def write_batch_scad(fn_scad, specs, offsets, slot_resolution=None):
+    """ MM ONLY.  One SCAD file with every tray in specs, each moved to its offset """
+    objs = []
+    for spec, (x, y) in zip(specs, offsets):
+        _, _, trayObj = createTray(spec['xlist'], spec['ylist'], spec['depth'], spec['wall'], spec['floor'],
+                                   spec['round'], slot_resolution=slot_resolution)
+        objs.append(translate([x, y, 0])(trayObj))
+    scad_render_to_file(union()(*objs), fn_scad, file_header='$fn=64;')
+
+
+def label_components(tris, tol=1e-4):
+    """ Connected component of every triangle, where triangles sharing a vertex (within ~tol) are connected """
+    keys = np.round(tris.reshape(-1, 3) / tol).astype(np.int64)
+    _, vert_ids = np.unique(keys, axis=0, return_inverse=True)
+    vert_ids = vert_ids.reshape(-1, 3)
+    nverts = int(vert_ids.max()) + 1 if len(vert_ids) else 0
+
+    # Each triangle joins its first vertex to the other two, which is enough for connectivity
+    rows = np.concatenate([vert_ids[:, 0], vert_ids[:, 0]])
+    cols = np.concatenate([vert_ids[:, 1], vert_ids[:, 2]])
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(nverts, nverts))
+    _, vert_labels = connected_components(graph, directed=False)
+    return vert_labels[vert_ids[:, 0]]
+
+
+def split_batch_mesh(tris, regions, tol=1e-4):
+    """
+    Splits the batch mesh into one triangle array per region, where regions is a list of
+    (xmin, ymin, xmax, ymax).  Each connected component goes to the region holding the center of
+    its bounding box.  Raises an IOError if any component is outside every region.
+    """
+    labels = label_components(tris, tol)
+    ncomp = int(labels.max()) + 1 if len(labels) else 0
+    tri_lo = tris.min(axis=1)
+    tri_hi = tris.max(axis=1)
+    comp_lo = np.full((ncomp, 3), np.inf)
+    comp_hi = np.full((ncomp, 3), -np.inf)
+    np.minimum.at(comp_lo, labels, tri_lo)
+    np.maximum.at(comp_hi, labels, tri_hi)
+    centers = (comp_lo + comp_hi) / 2
+
+    regions = np.asarray(regions, dtype=np.float64).reshape(-1, 4)
+    inside = (centers[:, None, 0] >= regions[None, :, 0]) & (centers[:, None, 0] <= regions[None, :, 2]) & \
+             (centers[:, None, 1] >= regions[None, :, 1]) & (centers[:, None, 1] <= regions[None, :, 3])
+    if ncomp and not inside.any(axis=1).all():
+        raise IOError(f'{int((~inside.any(axis=1)).sum())} mesh components are outside every tray region')
+
+    comp_region = inside.argmax(axis=1)
+    tri_region = comp_region[labels]
+    return [tris[tri_region == i] for i in range(len(regions))]
+
+
+def check_tray_bounds(tris, width, height, total_depth, tol=0.01):
+    """ An empty string if the mesh spans exactly [0, width] x [0, height] x [0, total_depth], else why not """
+    if len(tris) == 0:
+        return 'no triangles'
+    lo, hi = mesh_bounds(tris)
+    expected_hi = np.array([width, height, total_depth])
+    if np.abs(lo).max() > tol or np.abs(hi - expected_hi).max() > tol:
+        return f'bounds {lo.round(3).tolist()} - {hi.round(3).tolist()}, expected [0, 0, 0] - {expected_hi.tolist()}'
+    return ''
+
+
+def render_batch(fn_stls, specs, work_dir=None, gap=DEFAULT_BATCH_GAP, slot_resolution=None):
+    """
+    Renders every tray in specs (param maps, any units) with one OpenSCAD run, and writes each
+    one's STL to the matching fn_stls path.  Returns a list with an empty string for every tray
+    that was written, or the reason it wasn't.  Raises if the OpenSCAD run itself fails.
+    """
+    specs_mm = [tray_spec_to_mm(s) for s in specs]
+    footprints = [compute_tray_footprint(s['xlist'], s['ylist'], s['wall']) for s in specs_mm]
+    offsets = layout_batch(footprints, gap)
+
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='tray_batch_')
+    os.makedirs(work_dir, exist_ok=True)
+    fn_base = os.path.join(work_dir, 'batch')
+    write_batch_scad(fn_base + '.scad', specs_mm, offsets, slot_resolution)
+    run_openscad(fn_base + '.scad', fn_base + '.stl')
+
+    regions = [(x - gap / 2, y - gap / 2, x + w + gap / 2, y + h + gap / 2)
+               for (x, y), (w, h) in zip(offsets, footprints)]
+    parts = split_batch_mesh(read_stl(fn_base + '.stl'), regions)
+
+    problems = []
+    for fn_stl, spec, (x, y), (w, h), tris in zip(fn_stls, specs_mm, offsets, footprints, parts):
+        tris = translate_mesh(tris, (-x, -y, 0))
+        problem = check_tray_bounds(tris, w * xScale, h * yScale, (spec['floor'] + spec['depth']) * zScale)
+        if not problem:
+            write_stl(fn_stl, tris)
+        problems.append(problem)
+
+    LOG_IT(f'Rendered {len(specs)} trays in one batch, {sum(1 for p in problems if not p)} verified')
+    return problems
+
+
+if __name__ == '__main__':
+    from pack_plates import normalize_tray_spec
+
+    parser = argparse.ArgumentParser(usage="python3 batch_render.py batch.yaml [options]",
+                                     description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("batch_file", nargs='?', default=None)
+    parser.add_argument("--out-dir",
+                        dest="out_dir",
+                        default='./output_trays',
+                        type=str,
+                        help="Where to write tray_00.stl, tray_01.stl, ... (default ./output_trays)")
+    parser.add_argument("--gap",
+                        dest="gap",
+                        default=DEFAULT_BATCH_GAP,
+                        type=float,
+                        help=f"Space between the trays in the batch (mm, default {DEFAULT_BATCH_GAP:g})")
+    parser.add_argument("--benchmark",
+                        dest="benchmark",
+                        default=None,
+                        type=int,
+                        help="Render this many small trays one at a time, then as one batch, and compare")
+    args = parser.parse_args()
+
+    if args.benchmark is None:
+        with open(args.batch_file) as f:
+            specs = [normalize_tray_spec(s) for s in yaml.safe_load(f)]
+        os.makedirs(args.out_dir, exist_ok=True)
+        fn_stls = [os.path.join(args.out_dir, f'tray_{i:02d}.stl') for i in range(len(specs))]
+        for fn_stl, problem in zip(fn_stls, render_batch(fn_stls, specs, gap=args.gap)):
+            LOG_IT(f'{fn_stl}:  {problem or "OK"}')
+        sys.exit(0)
+
+    specs = [{'xlist': [30.0 + i, 40.0], 'ylist': [50.0, 20.0], 'depth': 30.0, 'wall': 1.8, 'floor': 1.8,
+              'round': 10.0, 'units': 'mm'} for i in range(args.benchmark)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        t0 = time.time()
+        for i, s in enumerate(specs):
+            render_tray_stl(os.path.join(tmpdir, f'single_{i:02d}'), s['xlist'], s['ylist'], s['depth'],
+                            s['wall'], s['floor'], s['round'])
+        single_sec = time.time() - t0
+
+        t0 = time.time()
+        problems = render_batch([os.path.join(tmpdir, f'batch_{i:02d}.stl') for i in range(len(specs))], specs,
+                                work_dir=tmpdir, gap=args.gap)
+        batch_sec = time.time() - t0
+
+    LOG_IT(f'{len(specs)} trays:  {single_sec:.1f} sec one at a time, {batch_sec:.1f} sec batched '
+           f'({single_sec / batch_sec:.2f}x), {sum(1 for p in problems if not p)} verified')
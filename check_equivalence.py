@@ -0,0 +1,290 @@
+#! /usr/bin/python
+"""
+Checks that a faster geometry path produces the same tray as the reference.
+
+The reference is what we've always shipped:  createTray() rendered with
+SolidPython's scad_render_to_file(), then OpenSCAD.  Every tray in the corpus
+is rendered with the reference and with each alternative engine, and the two
+meshes are compared with:
+
+    volume      relative difference of the enclosed volumes
+    bbox        largest difference between the bounding-box corners (mm)
+    hausdorff   symmetric Hausdorff distance (mm), estimated by sampling
+                points over each surface and measuring the exact distance to
+                the nearby triangles of the other surface (found by KD-tree)
+
+The Hausdorff estimate can miss a feature smaller than the sample spacing
+(which is reported too), so use more --samples for trays with tiny bins.  A
+pair fails if any metric is over its tolerance.
+
+    python3 check_equivalence.py --engines stream parallel --report equivalence.json
+
+Any two STL files can also be compared directly, e.g. from a native mesher:
+
+    python3 check_equivalence.py --compare reference.stl other.stl
+
+Exits with status 1 if anything failed.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import yaml
+import numpy as np
+from scipy.spatial import cKDTree
+from solid import scad_render_to_file
+
+from constants import *
+from generate_tray import LOG_IT, createTray, run_openscad, render_tray_stl
+from parallel_render import render_tray_parallel
+from mesh_utils import read_stl, mesh_bounds, mesh_volume, triangle_areas, sample_surface, \
+    closest_points_on_triangles
+
+
+# A spread of layouts: single bin, flat floors, deep & shallow roundness,
+# non-square bins, and one big enough to need strips.  All in mm.
+DEFAULT_CORPUS = [
+    {'xlist': [40], 'ylist': [40]},
+    {'xlist': [40, 25, 70], 'ylist': [30, 100, 60, 60]},
+    {'xlist': [20, 20, 20], 'ylist': [20, 20], 'round': 0},
+    {'xlist': [15, 60], 'ylist': [80, 10], 'round': 5, 'depth': 20},
+    {'xlist': [30] * 8, 'ylist': [25] * 6, 'wall': 1.2, 'floor': 1.2},
+]
+
+DEFAULT_TOLERANCES = {
+    'volume_rel': 1e-3,
+    'bbox_mm': 0.01,
+    'hausdorff_mm': 0.05,
+}
+
+
+def render_reference(fn_stl, xlist, ylist, depth, wall, floor, round):
+    fn_scad = os.path.splitext(fn_stl)[0] + '.scad'
+    _, _, trayObj = createTray(xlist, ylist, depth, wall, floor, round)
+    scad_render_to_file(trayObj, fn_scad, file_header='$fn=64;')
+    return run_openscad(fn_scad, fn_stl)
+
+
+def render_parallel(fn_stl, *tray_args):
+    # At least two strips even on one core, or there's no stitching to check
+    return render_tray_parallel(fn_stl, *tray_args, strips=max(2, os.cpu_count() or 1),
+                                work_dir=os.path.splitext(fn_stl)[0] + '_strips')
+
+
+def render_polyhedron(fn_stl, *tray_args):
+    return render_tray_stl(fn_stl, *tray_args, slot_resolution=32)
+
+
+# Each engine takes (fn_stl, xlist, ylist, depth, wall, floor, round) in mm and returns the STL path
+ENGINES = {
+    'stream': render_tray_stl,
+    'parallel': render_parallel,
+    'polyhedron': render_polyhedron,
+}
+
+
+def normalize_corpus_spec(spec):
+    """ Fills in the mm defaults, so the report shows exactly what was rendered """
+    return {
+        'xlist': [float(x) for x in spec['xlist']],
+        'ylist': [float(y) for y in spec['ylist']],
+        'depth': float(spec.get('depth', DEFAULT_DEPTH_MM)),
+        'wall': float(spec.get('wall', DEFAULT_WALL_MM)),
+        'floor': float(spec.get('floor', DEFAULT_FLOOR_MM)),
+        'round': float(spec.get('round', DEFAULT_ROUND_MM)),
+    }
+
+
+def directed_distances(pts_from, tris_to, nsamples, rng, k=4, k_refine=128, refine_batch=2000):
+    """
+    Distance from each point to the other surface.  Two KD-trees find the
+    candidate triangles nearby:  one over the triangle centroids (which covers
+    the finely tessellated round floors) and one over area-weighted samples
+    (which covers the big flat walls, whose centroids can be far away).  We
+    take the exact distance to the closest candidate, which is never less than
+    the true distance, and exact unless the closest triangle was missed.
+
+    Long slivers are the ones that get missed, so the largest distances (the
+    ones the Hausdorff estimate depends on) are re-checked with many more
+    candidates, until the largest refined distance beats all unrefined ones.
+    """
+    samples, sample_tri = sample_surface(tris_to, nsamples, rng, return_index=True)
+    sample_tree = cKDTree(samples)
+    centroid_tree = cKDTree(tris_to.mean(axis=1))
+
+    def candidate_distances(pts, kk):
+        _, near_samples = sample_tree.query(pts, k=kk, workers=-1)
+        _, near_centroids = centroid_tree.query(pts, k=kk, workers=-1)
+        cand = tris_to[np.concatenate([sample_tri[near_samples].reshape(len(pts), -1),
+                                       near_centroids.reshape(len(pts), -1)], axis=1)]
+        closest = closest_points_on_triangles(pts[:, None, :], cand)
+        return np.linalg.norm(closest - pts[:, None, :], axis=-1).min(axis=1)
+
+    # In chunks, to keep the candidate arrays to a few hundred MB
+    dists = np.concatenate([candidate_distances(pts_from[i:i + 100000], k)
+                            for i in range(0, len(pts_from), 100000)])
+
+    refined = np.zeros(len(dists), dtype=bool)
+    while not refined.all():
+        unrefined = np.flatnonzero(~refined)
+        batch = unrefined[np.argsort(-dists[unrefined])[:refine_batch]]
+        dists[batch] = np.minimum(dists[batch], candidate_distances(pts_from[batch], k_refine))
+        refined[batch] = True
+        if refined.all() or dists[refined].max() >= dists[~refined].max():
+            break
+
+    return dists
+
+
+def compare_meshes(tris_ref, tris_alt, nsamples=200000, seed=0):
+    """ All of the metrics for one pair of meshes, as a JSON-friendly dict """
+    rng = np.random.default_rng(seed)
+    t0 = time.perf_counter()
+
+    vol_ref, vol_alt = mesh_volume(tris_ref), mesh_volume(tris_alt)
+    lo_ref, hi_ref = mesh_bounds(tris_ref)
+    lo_alt, hi_alt = mesh_bounds(tris_alt)
+    bbox_diff = max(np.abs(lo_ref - lo_alt).max(), np.abs(hi_ref - hi_alt).max())
+
+    d_ref_alt = directed_distances(sample_surface(tris_ref, nsamples, rng), tris_alt, nsamples, rng)
+    d_alt_ref = directed_distances(sample_surface(tris_alt, nsamples, rng), tris_ref, nsamples, rng)
+
+    # Typical distance between neighboring samples on the larger surface
+    area = max(triangle_areas(tris_ref).sum(), triangle_areas(tris_alt).sum())
+    spacing = np.sqrt(area / nsamples)
+
+    return {
+        'triangles': {'reference': len(tris_ref), 'alternative': len(tris_alt)},
+        'volume_mm3': {'reference': float(vol_ref), 'alternative': float(vol_alt)},
+        'volume_rel_diff': float(abs(vol_alt - vol_ref) / abs(vol_ref)),
+        'bbox_max_diff_mm': float(bbox_diff),
+        'hausdorff_mm': float(max(d_ref_alt.max(), d_alt_ref.max())),
+        'mean_distance_mm': float((d_ref_alt.mean() + d_alt_ref.mean()) / 2.0),
+        'sample_spacing_mm': float(spacing),
+        'compare_sec': time.perf_counter() - t0,
+    }
+
+
+def check_tolerances(metrics, tol):
+    """ Returns a list of human-readable failures (empty if it passes) """
+    failures = []
+    if metrics['volume_rel_diff'] > tol['volume_rel']:
+        failures.append(f'volume differs by {100 * metrics["volume_rel_diff"]:.4f}%')
+    if metrics['bbox_max_diff_mm'] > tol['bbox_mm']:
+        failures.append(f'bounding box differs by {metrics["bbox_max_diff_mm"]:.4f} mm')
+    if metrics['hausdorff_mm'] > tol['hausdorff_mm']:
+        failures.append(f'Hausdorff distance {metrics["hausdorff_mm"]:.4f} mm')
+    return failures
+
+
+def timed_render(engine, fn_stl, spec):
+    t0 = time.perf_counter()
+    engine(fn_stl, spec['xlist'], spec['ylist'], spec['depth'], spec['wall'], spec['floor'], spec['round'])
+    return read_stl(fn_stl), time.perf_counter() - t0
+
+
+def run_corpus(corpus, engine_names, tol, nsamples, work_dir):
+    results = []
+    for itray, spec in enumerate(corpus):
+        spec = normalize_corpus_spec(spec)
+        LOG_IT(f'Tray {itray}: {spec["xlist"]} x {spec["ylist"]}')
+        tris_ref, ref_sec = timed_render(render_reference, os.path.join(work_dir, f'tray{itray}_reference.stl'), spec)
+
+        for name in engine_names:
+            result = {'tray': spec, 'engine': name, 'reference_sec': ref_sec}
+            try:
+                tris_alt, result['engine_sec'] = timed_render(ENGINES[name],
+                                                              os.path.join(work_dir, f'tray{itray}_{name}.stl'), spec)
+                result.update(compare_meshes(tris_ref, tris_alt, nsamples))
+                result['failures'] = check_tolerances(result, tol)
+            except Exception as e:
+                result['failures'] = [f'{type(e).__name__}: {e}']
+
+            result['passed'] = len(result['failures']) == 0
+            LOG_IT(f'  {name:>10}: {"PASS" if result["passed"] else "FAIL " + "; ".join(result["failures"])}'
+                   f'  ({ref_sec:.1f}s reference, {result.get("engine_sec", float("nan")):.1f}s {name})')
+            results.append(result)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage="python3 check_equivalence.py [options]",
+                                     description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engines",
+                        dest="engines",
+                        nargs='+',
+                        choices=sorted(ENGINES.keys()),
+                        default=sorted(ENGINES.keys()),
+                        help="Alternative engines to check against the reference (default: all)")
+
+    parser.add_argument("--corpus",
+                        dest="corpus",
+                        default=None,
+                        type=str,
+                        help="YAML file with a list of tray specs (xlist, ylist, depth, wall, floor, round in mm)")
+
+    parser.add_argument("--compare",
+                        dest="compare",
+                        nargs=2,
+                        default=None,
+                        metavar=('REFERENCE_STL', 'OTHER_STL'),
+                        help="Just compare two existing STL files")
+
+    parser.add_argument("--samples",
+                        dest="samples",
+                        default=200000,
+                        type=int,
+                        help="Surface samples per mesh for the Hausdorff estimate")
+
+    parser.add_argument("--tol-volume", dest="tol_volume", default=DEFAULT_TOLERANCES['volume_rel'], type=float,
+                        help="Relative volume tolerance")
+    parser.add_argument("--tol-bbox", dest="tol_bbox", default=DEFAULT_TOLERANCES['bbox_mm'], type=float,
+                        help="Bounding box tolerance (mm)")
+    parser.add_argument("--tol-hausdorff", dest="tol_hausdorff", default=DEFAULT_TOLERANCES['hausdorff_mm'],
+                        type=float, help="Hausdorff distance tolerance (mm)")
+
+    parser.add_argument("--report",
+                        dest="report",
+                        default='./equivalence_report.json',
+                        type=str,
+                        help="Where to write the JSON report")
+
+    parser.add_argument("--work-dir",
+                        dest="work_dir",
+                        default=None,
+                        type=str,
+                        help="Keep the rendered files here (default: a temporary directory)")
+
+    args = parser.parse_args()
+    tol = {'volume_rel': args.tol_volume, 'bbox_mm': args.tol_bbox, 'hausdorff_mm': args.tol_hausdorff}
+
+    if args.compare is not None:
+        result = compare_meshes(read_stl(args.compare[0]), read_stl(args.compare[1]), args.samples)
+        result['failures'] = check_tolerances(result, tol)
+        result['passed'] = len(result['failures']) == 0
+        results = [dict(files=args.compare, **result)]
+        LOG_IT(json.dumps(result, indent=2))
+    else:
+        corpus = DEFAULT_CORPUS
+        if args.corpus is not None:
+            with open(args.corpus, 'r') as f:
+                corpus = yaml.safe_load(f)
+
+        if args.work_dir is None:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                results = run_corpus(corpus, args.engines, tol, args.samples, tmpdir)
+        else:
+            os.makedirs(args.work_dir, exist_ok=True)
+            results = run_corpus(corpus, args.engines, tol, args.samples, args.work_dir)
+
+    passed = all([r['passed'] for r in results])
+    with open(args.report, 'w') as f:
+        json.dump({'tolerances': tol, 'samples': args.samples, 'passed': passed, 'results': results}, f, indent=2)
+
+    LOG_IT(f'{sum([r["passed"] for r in results])}/{len(results)} passed, report written to {args.report}')
+    sys.exit(0 if passed else 1)
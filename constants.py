@@ -12,3 +12,13 @@ DEFAULT_DEPTH_IN = 1.5
 DEFAULT_WALL_IN = 0.07
 DEFAULT_FLOOR_IN = 0.07
 DEFAULT_ROUND_IN = 0.5
+
+# Tray dimensions are rounded to this resolution before computing the cache key,
+# so tiny float/unit-conversion differences don't cause a separate render.
+HASH_QUANTUM_MM = 0.01
+
+# Bit-flags describing how a requested tray layout maps onto its canonical
+# (cached) layout.  Flips are applied first, then the x/y swap.
+XFORM_FLIP_X = 1   # xlist reversed:  mirror across the tray's center line in x
+XFORM_FLIP_Y = 2   # ylist reversed:  mirror across the tray's center line in y
+XFORM_SWAP_XY = 4  # xlist & ylist swapped:  reflect across the x=y diagonal
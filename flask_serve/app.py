@@ -1,20 +1,30 @@
 import copy
 import os.path
 
-from flask import Flask, render_template, redirect, url_for, send_file, request
+from flask import Flask, Response, render_template, redirect, url_for, send_file, request, abort, jsonify
 from flask_bootstrap import Bootstrap
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, IntegerField, FloatField, RadioField
 from wtforms.validators import DataRequired, InputRequired, ValidationError
 
+import io
+import re
 import sys
 import ast
+import functools
+import contextlib
+import gzip
+import json
 import numpy as np
 import yaml
 import time
 import logging
 import subprocess
 import requests
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from constants import *
 
@@ -35,12 +45,55 @@ sys.path.append('..')
 THIS_SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
 S3BUCKET = 'etotheipi-gentray-store'
 
-from gen_tray_png import draw_tray, base64_encode_file
-from generate_tray import compute_bin_volume, generate_tray_hash, check_status
+from gen_tray_png import render_tray_png
+from generate_tray import compute_bin_volume, generate_tray_key, check_status, apply_tray_xform, parse_tray_spec, \
+    generate_script_args
+from mesh_utils import parse_stl_bytes, write_stl, transform_tray_mesh, mesh_bounds, mesh_volume
+from mesh_share import get_mesh_registry
+from preview_mesh import PREVIEW_LEVELS, build_preview_mesh, encode_glb
+from job_index import JobIndex, is_stale_request
+from tray_store import LocalTrayStore, get_tray_store
+from tray_estimate import DEFAULT_PRINT_PROFILE, estimate_tray, estimate_trays, format_estimate, parse_print_profile
+
+# Every job and tray status is also recorded here, so the bulk API can answer with one query
+JOB_DB_PATH = os.environ.get('GENTRAY_JOB_DB', os.path.join(THIS_SCRIPT_PATH, 'gentray_jobs.sqlite3'))
+JOB_INDEX = JobIndex(JOB_DB_PATH)
+
+# OpenSCAD is CPU-bound and single-threaded, so only run this many generate scripts at once.
+# The rest wait their turn (these threads just wait on the subprocesses)
+RENDER_WORKERS = int(os.environ.get('GENTRAY_RENDER_WORKERS', os.cpu_count() or 1))
+RENDER_POOL = ThreadPoolExecutor(max_workers=RENDER_WORKERS)
+
+# Matplotlib isn't thread-safe and is the slowest part of a preview, so PNGs are drawn in a few
+# worker processes of their own.  Spawned rather than forked, since this process has threads.
+PNG_WORKERS = int(os.environ.get('GENTRAY_PNG_WORKERS', 2))
+_PNG_POOL = None
+_PNG_POOL_LOCK = threading.Lock()
+
+def png_pool():
+    global _PNG_POOL
+    with _PNG_POOL_LOCK:
+        if _PNG_POOL is None:
+            _PNG_POOL = ProcessPoolExecutor(max_workers=PNG_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _PNG_POOL
+
+# Compresses the mirrored/transposed STLs the local store keeps, off the request path
+COMPRESS_POOL = ThreadPoolExecutor(max_workers=1)
+
+# With GENTRAY_MESH_DB set, the generate scripts publish each rendered mesh in shared memory and
+# the downloads and mesh stats read it from there, rather than each one parsing the STL again
+MESH_REGISTRY = get_mesh_registry()
+
+MAX_BATCH_TRAYS = 500
+MAX_STATUS_HASHES = 5000
+MAX_ESTIMATE_TRAYS = 10000
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'c70ed076fbeccb6230acbc437e6be159'
 
+# Behind a proxy that understands X-Sendfile, let it send the stored files instead of a worker
+app.config['USE_X_SENDFILE'] = os.environ.get('GENTRAY_X_SENDFILE', '') not in ('', '0')
+
 def validator_is_positive_numeric(form, field):
     try:
         f = float(field.data)
@@ -140,6 +193,183 @@ def parse_form(form):
     input_dict['vol_mtrx_ml'] = compute_volume_matrix(xlist, ylist, depth, round, units)
     return input_dict
 
+# Canonical params of the trays we've seen, by tray hash.  Lets the preview endpoints rebuild a
+# tray from just its hash.  They're kept in the job index, so every worker (and the next process)
+# can find them, and the most recently used are kept here too.
+MAX_TRAY_PARAMS = 4096
+TRAY_PARAMS = OrderedDict()
+_TRAY_PARAMS_LOCK = threading.Lock()
+
+def cache_tray_params(tray_hash, canon):
+    with _TRAY_PARAMS_LOCK:
+        TRAY_PARAMS[tray_hash] = canon
+        TRAY_PARAMS.move_to_end(tray_hash)
+        while len(TRAY_PARAMS) > MAX_TRAY_PARAMS:
+            TRAY_PARAMS.popitem(last=False)
+
+
+def remember_tray(param_map):
+    tray_hash, xform, canon = generate_tray_key(**{k: param_map[k] for k in
+                                                  ('xlist', 'ylist', 'depth', 'wall', 'floor', 'round', 'units')})
+    JOB_INDEX.remember_tray_params(tray_hash, canon)
+    cache_tray_params(tray_hash, canon)
+    return tray_hash, xform
+
+
+def lookup_tray_params(tray_hash):
+    """ Memory, then the job index, then the tray's status in the store.  Raises KeyError """
+    with _TRAY_PARAMS_LOCK:
+        params = TRAY_PARAMS.get(tray_hash)
+    if params is None:
+        params = JOB_INDEX.get_tray_params(tray_hash)
+    if params is None:
+        dl_status = check_status(S3BUCKET, tray_hash)
+        if 'params' not in dl_status:
+            raise KeyError(f'Unknown tray: {tray_hash}')
+        params = dl_status['params']
+    cache_tray_params(tray_hash, params)
+    return params
+
+
+def preview_mesh_urls(tray_hash, xform):
+    return [url_for('preview_mesh', tray_hash=tray_hash, level=lvl, xform=xform)
+            for lvl in range(len(PREVIEW_LEVELS))]
+
+
+def requested_tray_params(tray_hash, xform, units='mm'):
+    """ The canonical params for the hash, turned back into the requested layout and units """
+    params = copy.deepcopy(lookup_tray_params(tray_hash))
+    params['xlist'], params['ylist'] = apply_tray_xform(params['xlist'], params['ylist'], xform, inverse=True)
+    if units != 'mm':
+        for k in ('depth', 'wall', 'floor', 'round'):
+            params[k] = round(params[k] / MM_PER_IN, 6)
+        params['xlist'] = [round(x / MM_PER_IN, 6) for x in params['xlist']]
+        params['ylist'] = [round(y / MM_PER_IN, 6) for y in params['ylist']]
+        params['units'] = units
+    return params
+
+
+# Tray hashes are sha256 hex digests, and each tray has 8 layouts (any combination of the XFORM_* bits)
+TRAY_HASH_PATTERN = re.compile(r'[0-9a-f]{64}')
+NUM_TRAY_XFORMS = 8
+
+def tray_request_xform(tray_hash):
+    """
+    The requested layout, ?xform= (default 0).  Aborts with a 400 if it isn't one of the layouts
+    or the tray hash isn't a hash, before either gets near a cache, a file name or the store.
+    """
+    try:
+        xform = int(request.args.get('xform', 0))
+    except ValueError:
+        abort(400)
+    if xform not in range(NUM_TRAY_XFORMS) or not TRAY_HASH_PATTERN.fullmatch(tray_hash):
+        abort(400)
+    return xform
+
+
+################################################################################
+# Everything below is derived deterministically from the tray hash (which includes the script
+# version), so it can be cached forever by browsers and CDNs.  Each resource is built once per
+# process and kept alongside its gzipped variant.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def make_variants(raw, compress=True):
+    return {'identity': raw, 'gzip': gzip.compress(raw, compresslevel=9) if compress else None}
+
+
+def serve_immutable(etag, mimetype, build_variants):
+    """
+    Conditional GET against a strong ETag, without building anything if the client already has it.
+    The gzip variant gets its own ETag, since it is a different representation.
+    """
+    etags = {'identity': etag, 'gzip': etag + '-gz'}
+    if any(request.if_none_match.contains(t) for t in etags.values()):
+        resp = Response(status=304)
+        resp.set_etag(etags['gzip'] if request.if_none_match.contains(etags['gzip']) else etag)
+    else:
+        try:
+            variants = build_variants()
+        except KeyError:
+            abort(404)
+
+        encoding = 'identity'
+        if variants['gzip'] is not None and 'gzip' in request.accept_encodings:
+            encoding = 'gzip'
+
+        resp = Response(variants[encoding], mimetype=mimetype)
+        resp.set_etag(etags[encoding])
+        if encoding != 'identity':
+            resp.headers['Content-Encoding'] = encoding
+
+    resp.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
+
+
+# The tray hash covers the tray and the generate script, not how the app draws or measures it.
+# Bump this whenever a preview, volume table, estimate or mesh stats would come out different.
+RESOURCE_VERSION = 1
+
+def resource_etag(kind, tray_hash, xform, units='mm', extra=''):
+    return f'{kind}-v{RESOURCE_VERSION}-{tray_hash}-{xform}-{units}{extra}'
+
+
+def tray_resource_urls(tray_hash, xform, units='mm'):
+    return {
+        'preview_url': url_for('preview_png', tray_hash=tray_hash, xform=xform, units=units),
+        'volumes_url': url_for('volume_table', tray_hash=tray_hash, xform=xform, units=units),
+        'estimate_url': url_for('print_estimate', tray_hash=tray_hash, xform=xform),
+        'mesh_stats_url': url_for('mesh_stats', tray_hash=tray_hash, xform=xform),
+        'mesh_urls': preview_mesh_urls(tray_hash, xform),
+    }
+
+
+@functools.lru_cache(maxsize=256)
+def build_preview_glb(tray_hash, xform, level):
+    params = requested_tray_params(tray_hash, xform)
+    verts, faces = build_preview_mesh(**params, level=level)
+    return make_variants(encode_glb(verts, faces))
+
+
+@functools.lru_cache(maxsize=256)
+def build_preview_png(tray_hash, xform, units):
+    params = requested_tray_params(tray_hash, xform, units)
+    vol_mtrx = compute_volume_matrix(params['xlist'], params['ylist'], params['depth'], params['round'], units)
+    png = png_pool().submit(render_tray_png,
+                            params['xlist'],
+                            params['ylist'],
+                            params['wall'],
+                            vol_mtrx_ml=vol_mtrx,
+                            depth=params['depth'],
+                            floor=params['floor'],
+                            units=units).result()
+
+    # PNGs are already compressed, gzip won't buy anything
+    return make_variants(png, compress=False)
+
+
+@functools.lru_cache(maxsize=256)
+def build_volume_table(tray_hash, xform, units):
+    params = requested_tray_params(tray_hash, xform, units)
+    vol_mtrx = compute_volume_matrix(params['xlist'], params['ylist'], params['depth'], params['round'], units)
+    table = {
+        'tray_hash': tray_hash,
+        'units': units,
+        'xlist': params['xlist'],
+        'ylist': params['ylist'],
+        'vol_ml': vol_mtrx.tolist(),
+        'vol_cups': (vol_mtrx / ML_PER_CUP).tolist(),
+    }
+    return make_variants(json.dumps(table).encode('utf-8'))
+
+
+@functools.lru_cache(maxsize=256)
+def build_print_estimate(tray_hash, xform):
+    params = requested_tray_params(tray_hash, xform)
+    estimate = dict(estimate_tray(**params), tray_hash=tray_hash, profile=DEFAULT_PRINT_PROFILE._asdict())
+    return make_variants(json.dumps(estimate).encode('utf-8'))
+
+
 @app.route('/', methods=('GET', 'POST'))
 def redirect_root():
     return redirect(url_for('gen_tray_form'))
@@ -152,16 +382,6 @@ def gen_tray_form():
     if form.validate_on_submit():
         param_map = parse_form(form)
 
-        tmp_file = draw_tray(param_map['xlist'],
-                             param_map['ylist'],
-                             param_map['wall'],
-                             param_map['vol_mtrx_ml'],
-                             param_map['depth'],
-                             param_map['floor'],
-                             units=param_map['units'])
-
-        rawb64 = base64_encode_file(tmp_file)
-
         cmd_args  = f" \\\n   {param_map['xlist']}"
         cmd_args += f" \\\n   {param_map['ylist']}"
         cmd_args += f" \\\n   --depth {param_map['depth']}"
@@ -177,13 +397,38 @@ def gen_tray_form():
         local_cmd = "python3 generate_tray.py"
 
         if 'preview_only' in request.form:
-            return render_template('input_form.html', form=form, preview=True, preview_b64=rawb64,
+            tray_hash, xform = remember_tray(param_map)
+            return render_template('input_form.html', form=form, preview=True,
+                                   **tray_resource_urls(tray_hash, xform, param_map['units']),
+                                   estimate_txt=format_estimate(estimate_trays([param_map])[0]),
                                    docker_cmd=docker_cmd + cmd_args,
                                    local_cmd=local_cmd + cmd_args)
         elif 'generate_stl' in request.form:
             return redirect(url_for('process_stl_request'), code=307)
 
-    return render_template('input_form.html', form=form, preview=False, preview_b64=None)
+    return render_template('input_form.html', form=form, preview=False)
+
+
+def tray_already_requested(tray_hash):
+    """
+    Queued, in progress or done.  Check the local index first, it's much cheaper than S3.  A render
+    queued or started too long ago has been lost (e.g. to a restart), so it doesn't count.
+    """
+    status = JOB_INDEX.get_tray_statuses([tray_hash])[tray_hash]
+    if status['status'].lower() == 'dne':
+        status = check_status(S3BUCKET, tray_hash)
+    return status['status'].lower() in ('queued', 'initiated', 'complete') and not is_stale_request(status)
+
+
+def launch_tray_generation(tray_hash, canon_params):
+    """ Queue up the generate script for the canonical (mm) layout of a tray """
+    # This is in the flask_serve directory, need to go up one level for the create script
+    root_dir = os.path.dirname(THIS_SCRIPT_PATH)
+    call_args = generate_script_args(canon_params, S3BUCKET, tray_hash, JOB_DB_PATH)
+
+    logging.info('Queueing subprocess with:' + '|'.join(call_args))
+    JOB_INDEX.set_tray_status(tray_hash, 'Queued', 'Waiting for a free render worker', canon_params)
+    RENDER_POOL.submit(subprocess.run, call_args, cwd=root_dir)
 
 
 @app.route('/process_stl_request', methods=('POST',))
@@ -192,34 +437,20 @@ def process_stl_request():
     if form.validate_on_submit():
         param_map = parse_form(form)
         del(param_map['vol_mtrx_ml'])
-        tray_hash = generate_tray_hash(**param_map)
-
-        # This is in the flask_serve directory, need to go up one level for the create script
-        root_dir = os.path.dirname(THIS_SCRIPT_PATH)
-        call_args = [
-            sys.executable,  # the python interpreter running this script
-            os.path.join(root_dir, 'generate_tray.py'),
-            f'[{",".join([str(x) for x in param_map["xlist"]])}]',
-            f'[{",".join([str(y) for y in param_map["ylist"]])}]',
-            '--depth', f'{param_map["depth"]}',
-            '--wall', f'{param_map["wall"]}',
-            '--floor', f'{param_map["floor"]}',
-            '--round', f'{param_map["round"]}',
-            '--s3bucket', S3BUCKET,
-            '--s3dir', tray_hash,
-            '--yes'
-        ]
-
-        if form.binary_mm_or_in.data != 'mm':
-            call_args += ['--inches']
-
-        logging.info('Creating subprocess with:' + '|'.join(call_args))
-
-        # Starts this process in the background and continues immediately
-        subprocess.Popen(call_args, cwd=root_dir)
+        tray_hash, xform, canon = generate_tray_key(**param_map)
+        JOB_INDEX.add_job(tray_hash, xform)
+        redir_url = url_for('download_status_wait', tray_hash=tray_hash, xform=xform)
+
+        # Equivalent trays (other units, mirrored or transposed layouts) share a hash,
+        # so there's a good chance this one has already been generated.
+        if tray_already_requested(tray_hash):
+            logging.info(f'Tray cache hit: {tray_hash} (xform={xform})')
+            return redirect(redir_url)
+
+        logging.info(f'Tray cache miss: {tray_hash} (xform={xform})')
+        launch_tray_generation(tray_hash, canon)
         time.sleep(1)
 
-        redir_url = url_for('download_status_wait', tray_hash=tray_hash)
         return redirect(redir_url)
     else:
         raise IOError("No form data submitted to process_stl_request(form)")
@@ -227,6 +458,8 @@ def process_stl_request():
 
 @app.route('/download_status_wait/<tray_hash>', methods=('GET',))
 def download_status_wait(tray_hash):
+    # The stored params are the canonical layout, xform gets us back to what was requested
+    xform = tray_request_xform(tray_hash)
     dl_status = check_status(S3BUCKET, tray_hash)
     logging.info(yaml.dump(dl_status, indent=2))
 
@@ -235,49 +468,349 @@ def download_status_wait(tray_hash):
                                wait_for_download=True,
                                is_complete=False,
                                message="Request submitted to generate tray.",
-                               tray_hash=tray_hash)
+                               tray_hash=tray_hash,
+                               xform=xform)
 
 
-    params = copy.deepcopy(dl_status['params'])
-    vol_mtrx = compute_volume_matrix(params['xlist'],
-                                     params['ylist'],
-                                     params['depth'],
-                                     params['round'],
-                                     params['units'])
-
-    tmp_file = draw_tray(
-        params['xlist'],
-        params['ylist'],
-        params['wall'],
-        vol_mtrx_ml=vol_mtrx,
-        floor=params['floor'],
-        depth=params['depth'],
-        units=params['units'])
-
-    rawb64 = base64_encode_file(tmp_file)
+    cache_tray_params(tray_hash, dl_status['params'])
+    params = requested_tray_params(tray_hash, xform)
 
     if dl_status['status'].lower() == 'initiated':
         return render_template('download_stl.html',
                                wait_for_download=True,
                                is_complete=False,
-                               preview_b64=rawb64,
+                               **tray_resource_urls(tray_hash, xform),
                                message="Tray is being generated.  Please wait...",
-                               params=dl_status['params'],
-                               tray_hash=tray_hash)
+                               params=params,
+                               tray_hash=tray_hash,
+                               xform=xform)
     elif dl_status['status'].lower() == 'complete':
         return render_template('download_stl.html',
                                wait_for_download=False,
                                is_complete=True,
-                               preview_b64=rawb64,
+                               **tray_resource_urls(tray_hash, xform),
                                message="Tray generation complete!  Use the download link below",
-                               params=dl_status['params'],
-                               tray_hash=tray_hash)
+                               params=params,
+                               tray_hash=tray_hash,
+                               xform=xform)
     elif dl_status['status'].lower() == 'failed':
         return render_template('download_stl.html',
                                wait_for_download=False,
                                is_complete=False,
-                               params=dl_status['params'],
-                               tray_hash=tray_hash)
+                               params=params,
+                               tray_hash=tray_hash,
+                               xform=xform)
+
+
+def artifact_etag(path, encoding):
+    """
+    Stored artifacts are only ever replaced (by rename), never modified in place, so the inode,
+    size and mtime identify the exact bytes.  That makes this a strong validator, good for If-Range.
+    """
+    st = os.stat(path)
+    return f'{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}-{encoding}'
+
+
+def pick_stored_encoding(variants):
+    """ The smallest stored encoding the client accepts.  Nothing is ever compressed per request """
+    for encoding in ('br', 'gzip'):
+        if encoding in variants and request.accept_encodings.quality(encoding) > 0:
+            return encoding
+    return 'identity'
+
+
+def send_stored_artifact(variants, mimetype, download_name):
+    """
+    Sends one of the stored {encoding: path} variants straight from disk.  send_file() hands the
+    open file to the server's wsgi.file_wrapper (sendfile() where the server supports it, or
+    X-Sendfile to a front-end proxy with GENTRAY_X_SENDFILE), and handles Range, If-Range and
+    If-None-Match against our ETag.
+    """
+    encoding = pick_stored_encoding(variants)
+    path = variants[encoding]
+    resp = send_file(path,
+                     mimetype=mimetype,
+                     as_attachment=True,
+                     download_name=download_name,
+                     conditional=True,
+                     etag=artifact_etag(path, encoding),
+                     max_age=0)
+    if encoding != 'identity':
+        resp.headers['Content-Encoding'] = encoding
+    resp.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
+
+
+@contextlib.contextmanager
+def rendered_tray_mesh(store, tray_hash):
+    """
+    The canonical (N, 3, 3) mesh of a rendered tray.  Straight from the shared memory segment
+    the generate script published if there is one (a read-only float32 view, only valid inside
+    the with block), otherwise parsed from the stored STL.  Raises KeyError if there's neither.
+    """
+    shared = MESH_REGISTRY.attach(tray_hash) if MESH_REGISTRY is not None else None
+    if shared is not None:
+        with shared:
+            yield shared.tris
+        return
+
+    stl_bytes = store.get_bytes(f'{tray_hash}/organizer_tray.stl')
+    if stl_bytes is None:
+        raise KeyError(tray_hash)
+    yield parse_stl_bytes(stl_bytes)
+
+
+def transformed_stl_key(store, tray_hash, xform):
+    """
+    The local store keeps each mirrored/transposed copy that's been asked for next to the
+    canonical STL, so it can be sent from disk like any other.  Rebuilt if the canonical STL
+    is newer.  Their compressed variants are made in the background, until then it's identity.
+    """
+    stl_key = f'{tray_hash}/organizer_tray.stl'
+    xform_key = f'{tray_hash}/organizer_tray_xform{xform}.stl'
+    canon_path, xform_path = store.local_path(stl_key), store.local_path(xform_key)
+    if not os.path.exists(canon_path):
+        return None
+
+    if not os.path.exists(xform_path) or os.stat(xform_path).st_mtime_ns < os.stat(canon_path).st_mtime_ns:
+        buf = io.BytesIO()
+        with rendered_tray_mesh(store, tray_hash) as tris:
+            write_stl(buf, transform_tray_mesh(tris, xform))
+        store.put_bytes(xform_key, buf.getvalue())
+        COMPRESS_POOL.submit(store.put_encoded_variants, xform_key, xform_path)
+    return xform_key
+
+
+@app.route('/download_stl/<tray_hash>', methods=('GET',))
+def download_stl(tray_hash):
+    """
+    Only the canonical layout of each tray is stored.  From S3, if that's what was requested we
+    just send the user to the stored file, otherwise we mirror or transpose the stored mesh on
+    the way out.  The local store serves the files itself, resumable and precompressed.
+    """
+    xform = tray_request_xform(tray_hash)
+    store = get_tray_store(S3BUCKET)
+    stl_key = f'{tray_hash}/organizer_tray.stl'
+
+    if isinstance(store, LocalTrayStore):
+        if xform != 0:
+            stl_key = transformed_stl_key(store, tray_hash, xform)
+        variants = store.encoded_variants(stl_key) if stl_key is not None else {}
+        if 'identity' not in variants:
+            return f'No STL file available for tray {tray_hash}', 404
+        return send_stored_artifact(variants, 'model/stl', 'organizer_tray.stl')
+
+    if xform == 0:
+        return redirect(store.public_url(stl_key))
+
+    buf = io.BytesIO()
+    try:
+        with rendered_tray_mesh(store, tray_hash) as tris:
+            write_stl(buf, transform_tray_mesh(tris, xform))
+    except KeyError:
+        return f'No STL file available for tray {tray_hash}', 404
+    buf.seek(0)
+    return send_file(buf, mimetype='model/stl', as_attachment=True, download_name='organizer_tray.stl')
+
+
+@app.route('/preview_mesh/<tray_hash>/<int:level>', methods=('GET',))
+def preview_mesh(tray_hash, level):
+    """
+    Approximate 3D mesh of the tray as binary glTF.  Level 0 is coarse and takes a few ms, the page
+    then requests the finer levels one at a time.
+    """
+    xform = tray_request_xform(tray_hash)
+    if level >= len(PREVIEW_LEVELS):
+        abort(404)
+
+    return serve_immutable(resource_etag('mesh', tray_hash, xform, extra=f'-L{level}'),
+                           'model/gltf-binary',
+                           lambda: build_preview_glb(tray_hash, xform, level))
+
+
+@app.route('/preview_png/<tray_hash>', methods=('GET',))
+def preview_png(tray_hash):
+    xform = tray_request_xform(tray_hash)
+    units = request.args.get('units', 'mm')
+    if units not in ('mm', 'in'):
+        abort(404)
+
+    return serve_immutable(resource_etag('png', tray_hash, xform, units),
+                           'image/png',
+                           lambda: build_preview_png(tray_hash, xform, units))
+
+
+@app.route('/volume_table/<tray_hash>', methods=('GET',))
+def volume_table(tray_hash):
+    """ Volume of every bin in mL and cups, indexed [ix][iy] like the preview """
+    xform = tray_request_xform(tray_hash)
+    units = request.args.get('units', 'mm')
+    if units not in ('mm', 'in'):
+        abort(404)
+
+    return serve_immutable(resource_etag('vol', tray_hash, xform, units),
+                           'application/json',
+                           lambda: build_volume_table(tray_hash, xform, units))
+
+
+@app.route('/print_estimate/<tray_hash>', methods=('GET',))
+def print_estimate(tray_hash):
+    """ Material, filament, weight and print time with the default print profile """
+    xform = tray_request_xform(tray_hash)
+    return serve_immutable(resource_etag('est', tray_hash, xform),
+                           'application/json',
+                           lambda: build_print_estimate(tray_hash, xform))
+
+
+@functools.lru_cache(maxsize=256)
+def build_mesh_stats(tray_hash, xform):
+    """ Measured from the rendered mesh, so only once it exists (not cached until then) """
+    with rendered_tray_mesh(get_tray_store(S3BUCKET), tray_hash) as tris:
+        lo, hi = mesh_bounds(tris)
+        stats = {
+            'tray_hash': tray_hash,
+            'triangles': len(tris),
+            'volume_cm3': float(mesh_volume(tris)) / MM3_PER_ML,
+            'size_mm': (hi - lo).astype(float).tolist(),
+        }
+    if xform & XFORM_SWAP_XY:
+        stats['size_mm'][:2] = stats['size_mm'][1::-1]
+    return make_variants(json.dumps(stats).encode('utf-8'))
+
+
+@app.route('/mesh_stats/<tray_hash>', methods=('GET',))
+def mesh_stats(tray_hash):
+    """ Triangle count, solid volume and bounding box of the rendered STL """
+    xform = tray_request_xform(tray_hash)
+    return serve_immutable(resource_etag('meshstats', tray_hash, xform),
+                           'application/json',
+                           lambda: build_mesh_stats(tray_hash, xform))
+
+
+################################################################################
+# JSON API, for submitting and polling many trays at once
+################################################################################
+def job_json(job_id, tray_hash, xform, status):
+    return {
+        'job_id': job_id,
+        'tray_hash': tray_hash,
+        'xform': xform,
+        'status': status,
+        'status_url': url_for('download_status_wait', tray_hash=tray_hash, xform=xform),
+        'download_url': url_for('download_stl', tray_hash=tray_hash, xform=xform),
+    }
+
+
+@app.route('/api/trays', methods=('POST',))
+def api_submit_trays():
+    """
+    Body: {"trays": [{"xlist": [...], "ylist": [...], "depth": ..., ...}, ...]}
+    Returns a job ID and canonical tray hash for every spec, in order.  Trays that already exist
+    (or are equivalent to one that does) are not generated again.
+    """
+    body = request.get_json(silent=True) or {}
+    specs = body.get('trays')
+    if not isinstance(specs, list) or len(specs) == 0:
+        return jsonify({'error': 'Expected {"trays": [...]} with at least one tray'}), 400
+    if len(specs) > MAX_BATCH_TRAYS:
+        return jsonify({'error': f'At most {MAX_BATCH_TRAYS} trays per request'}), 400
+
+    parsed, errors = [], []
+    for i, spec in enumerate(specs):
+        try:
+            parsed.append(parse_tray_spec(spec))
+        except ValueError as e:
+            errors.append({'index': i, 'error': str(e)})
+    if errors:
+        return jsonify({'errors': errors}), 400
+
+    keys = [generate_tray_key(**param_map) for param_map in parsed]
+    statuses = JOB_INDEX.get_tray_statuses([tray_hash for tray_hash, _, _ in keys])
+
+    jobs = []
+    for tray_hash, xform, canon in keys:
+        cache_tray_params(tray_hash, canon)
+        status = statuses[tray_hash]['status']
+        if status.lower() in ('dne', 'failed') or is_stale_request(statuses[tray_hash]):
+            launch_tray_generation(tray_hash, canon)
+            status = statuses[tray_hash]['status'] = 'Queued'
+        jobs.append(job_json(JOB_INDEX.add_job(tray_hash, xform), tray_hash, xform, status))
+
+    logging.info(f'API batch submission: {len(jobs)} trays')
+    return jsonify({'jobs': jobs}), 202
+
+
+@app.route('/api/trays/status', methods=('GET', 'POST'))
+def api_tray_status():
+    """
+    Status of many trays in one round trip:  GET with repeated ?hash=... arguments, or POST
+    {"tray_hashes": [...]}.  Answered from the job index with one query.
+    """
+    if request.method == 'POST':
+        tray_hashes = (request.get_json(silent=True) or {}).get('tray_hashes', [])
+    else:
+        tray_hashes = request.args.getlist('hash')
+
+    if not isinstance(tray_hashes, list) or not all([isinstance(h, str) for h in tray_hashes]):
+        return jsonify({'error': 'Expected a list of tray hashes'}), 400
+    if len(tray_hashes) > MAX_STATUS_HASHES:
+        return jsonify({'error': f'At most {MAX_STATUS_HASHES} hashes per request'}), 400
+
+    return jsonify({'trays': JOB_INDEX.get_tray_statuses(tray_hashes)})
+
+
+@app.route('/api/estimate', methods=('POST',))
+def api_estimate():
+    """
+    Body: {"trays": [...], "profile": {"layer_height": 0.28, ...}}, trays in the same form as
+    /api/trays and any PrintProfile fields to override.  Nothing is rendered, the estimates
+    are computed directly from the dimensions, in order.
+    """
+    body = request.get_json(silent=True) or {}
+    specs = body.get('trays')
+    if not isinstance(specs, list) or len(specs) == 0:
+        return jsonify({'error': 'Expected {"trays": [...]} with at least one tray'}), 400
+    if len(specs) > MAX_ESTIMATE_TRAYS:
+        return jsonify({'error': f'At most {MAX_ESTIMATE_TRAYS} trays per request'}), 400
+
+    try:
+        profile = parse_print_profile(body.get('profile', {}))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    parsed, errors = [], []
+    for i, spec in enumerate(specs):
+        try:
+            parsed.append(parse_tray_spec(spec))
+        except ValueError as e:
+            errors.append({'index': i, 'error': str(e)})
+    if errors:
+        return jsonify({'errors': errors}), 400
+
+    return jsonify({'profile': profile._asdict(), 'estimates': estimate_trays(parsed, profile)})
+
+
+@app.route('/api/jobs', methods=('GET',))
+def api_recent_jobs():
+    """ Most recent jobs first, paginated with ?limit= and ?offset= """
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+
+    jobs = [dict(job_json(j['job_id'], j['tray_hash'], j['xform'], j['status']), created=j['created'])
+            for j in JOB_INDEX.recent_jobs(limit, offset)]
+    total = JOB_INDEX.count_jobs()
+    next_url = url_for('api_recent_jobs', limit=limit, offset=offset + limit) if offset + limit < total else None
+    return jsonify({'jobs': jobs, 'total': total, 'next': next_url})
+
+
+@app.route('/api/jobs/<job_id>', methods=('GET',))
+def api_job(job_id):
+    j = JOB_INDEX.get_job(job_id)
+    if j is None:
+        return jsonify({'error': f'Unknown job: {job_id}'}), 404
+    return jsonify(dict(job_json(j['job_id'], j['tray_hash'], j['xform'], j['status']),
+                        created=j['created'], message=j['message']))
 
 
 @app.route('/about', methods=('GET',))
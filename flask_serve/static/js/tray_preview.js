@@ -0,0 +1,53 @@
+// Progressive 3D tray preview.  Loads each level of detail in turn (coarsest
+// first) and swaps it into the scene as soon as it arrives.
+import * as THREE from 'three';
+import { GLTFLoader } from 'three/addons/loaders/GLTFLoader.js';
+import { OrbitControls } from 'three/addons/controls/OrbitControls.js';
+
+const container = document.getElementById('tray3d');
+const levelUrls = JSON.parse(container.dataset.levels);
+
+const renderer = new THREE.WebGLRenderer({ antialias: true });
+renderer.setSize(container.clientWidth, container.clientHeight);
+container.appendChild(renderer.domElement);
+
+const scene = new THREE.Scene();
+scene.background = new THREE.Color(0xf4f4f4);
+scene.add(new THREE.HemisphereLight(0xffffff, 0x666666, 2.0));
+const sun = new THREE.DirectionalLight(0xffffff, 1.5);
+sun.position.set(1, 2, 1);
+scene.add(sun);
+
+const camera = new THREE.PerspectiveCamera(40, container.clientWidth / container.clientHeight, 1, 10000);
+const controls = new OrbitControls(camera, renderer.domElement);
+const material = new THREE.MeshStandardMaterial({ color: 0x8888cc, roughness: 0.7 });
+const loader = new GLTFLoader();
+
+let current = null;
+
+function showLevel(gltf, first) {
+    const tray = gltf.scene;
+    tray.traverse((obj) => { if (obj.isMesh) obj.material = material; });
+    if (current) scene.remove(current);
+    scene.add(tray);
+    current = tray;
+
+    if (first) {
+        const box = new THREE.Box3().setFromObject(tray);
+        const center = box.getCenter(new THREE.Vector3());
+        const size = box.getSize(new THREE.Vector3()).length();
+        controls.target.copy(center);
+        camera.position.copy(center).add(new THREE.Vector3(0.3, 0.8, 0.9).multiplyScalar(size));
+        controls.update();
+    }
+}
+
+async function loadLevels() {
+    for (let i = 0; i < levelUrls.length; i++) {
+        const gltf = await loader.loadAsync(levelUrls[i]);
+        showLevel(gltf, i === 0);
+    }
+}
+
+renderer.setAnimationLoop(() => renderer.render(scene, camera));
+loadLevels();
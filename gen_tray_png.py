@@ -1,9 +1,13 @@
+import io
 import os
 import numpy as np
 import tempfile
-import matplotlib.pyplot as plt
 import base64
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PatchCollection
 from matplotlib.patches import Rectangle
+from collections import namedtuple
 from constants import *
 
 
@@ -45,74 +49,86 @@ def rescale_dims_for_display(
     return xlist_adj, ylist_adj, wall_size_adj
 
 
-def draw_tray(xlist,
-              ylist,
-              wall_size,
-              vol_mtrx_ml=None, # always in mL regardless of x/y/depth/etc units
-              depth=None,
-              floor=None,
-              units='mm',
-              out_filename=None):
+# The preview is always 12x12 inches at 72 dpi
+FIGURE_SIZE_IN = 12
+PREVIEW_DPI = 72
 
-    # Depth and floor args are provided just to be displayed, not used in computing the drawing
-    fig, ax = plt.subplots(figsize=(12, 12))
+# About how much room a two-line, size-12 label needs at that dpi.  Labels that
+# won't fit are skipped, otherwise big grids turn into a black smear of text
+# (and most of the drawing time goes into laying it out).
+LABEL_WIDTH_PX = 80
+LABEL_HEIGHT_PX = 32
 
-    if vol_mtrx_ml is not None:
-        if (len(xlist), len(ylist)) != tuple(vol_mtrx_ml.shape[:2]):
-            err_msg  = f'Input vol_mtrx_ml has shape {vol_mtrx_ml.shape}, does not'
-            err_msg += f'match shape of xlist ({len(xlist)}) and ylist ({len(ylist)})'
-            raise IOError(err_msg)
-    
-    # To make things sane 
+FRAME_COLOR = '#333333'
+BIN_COLOR = '#8888cc'
+
+
+def _fit_labels(offsets, sizes, label_size):
+    """
+    Which bins along one axis get a label centered on them:  left to right,
+    skip any label that would overlap the previous one (all in drawing units)
+    """
+    show = []
+    last_end = -np.inf
+    for off, sz in zip(offsets, sizes):
+        center = off + sz/2
+        show.append(center - label_size/2 >= last_end)
+        if show[-1]:
+            last_end = center + label_size/2
+    return show
+
+
+TrayLayout = namedtuple('TrayLayout', 'xlist_draw ylist_draw wall_draw xoffs yoffs x0 y0 x_total y_total xlim ylim')
+
+
+def tray_display_layout(xlist, ylist, wall_size):
+    """
+    Where everything goes, in drawing units:  the rescaled sizes, the lower-left
+    corner of every bin, the frame at (x0, y0) and the axis limits
+    """
     xlist_draw, ylist_draw, wall_size_draw = rescale_dims_for_display(xlist, ylist, wall_size)
-    
+
     x_total = sum(xlist_draw) + (len(xlist_draw)+1) * wall_size_draw
     y_total = sum(ylist_draw) + (len(ylist_draw)+1) * wall_size_draw
     x0, y0 = 10, 20
-    rect = Rectangle((x0, y0), x_total, y_total, linewidth=0, facecolor='#333333')
-    ax.add_patch(rect)
-    xoff, yoff = x0+wall_size_draw, y0+wall_size_draw
-
-    for ix,x in enumerate(xlist_draw):
-        for iy,y in enumerate(ylist_draw):
-            rect = Rectangle((xoff, yoff), x, y, linewidth=0, facecolor='#8888cc')
-            ax.add_patch(rect)
-            
-            if ix == 0:
-                if units == 'mm':
-                    y_txt = f'{ylist[iy]:.1f} mm\n({ylist[iy] / MM_PER_IN:.2f} in)'
-                else:
-                    y_txt = f'{ylist[iy]:.2f} in\n({ylist[iy] * MM_PER_IN:.2f} mm)'
-
-                ax.text(x0-1, yoff + ylist[iy]/2, y_txt, ha='right', va='center', size=12)
-                
-            if vol_mtrx_ml is not None:
-                vol_ml = int(vol_mtrx_ml[ix, iy])
-                vol_cup = vol_ml / ML_PER_CUP
-                ax.text(xoff + x/2,
-                        yoff + y/2,
-                        f'{vol_ml} mL\n({vol_cup:.2f} cups)',
-                        size=12,
-                        ha='center',
-                        va='center',
-                        color='w')
-                    
-            # Increment y-position for drawing
-            yoff += y + wall_size_draw
 
-        # Draw x-label
-        if units == 'mm':
-            x_txt = f'{xlist[ix]:.1f} mm\n({xlist[ix] / MM_PER_IN:.2f} in)'
-        else:
-            x_txt = f'{xlist[ix]:.2f} in\n({xlist[ix] * MM_PER_IN:.2f} mm)'
+    xoffs = x0 + wall_size_draw + np.concatenate([[0], np.cumsum(np.array(xlist_draw) + wall_size_draw)[:-1]])
+    yoffs = y0 + wall_size_draw + np.concatenate([[0], np.cumsum(np.array(ylist_draw) + wall_size_draw)[:-1]])
+    return TrayLayout(xlist_draw, ylist_draw, wall_size_draw, xoffs, yoffs,
+                      x0, y0, x_total, y_total, x0+x_total+5, y0+y_total+5)
 
-        ax.text(xoff + x/2, y0-1, x_txt, ha='center', va='top', size=12)
 
-        # Reset y-position for drawing, increment x-position
-        yoff = y0 + wall_size_draw
-        xoff += x + wall_size_draw
-        
-    # Some summary text
+def tray_label_visibility(layout, px_per_unit):
+    """
+    Which labels fit at this scale:  (show_xlabel, show_ylabel, fits_vol) where
+    fits_vol[ix, iy] says whether that bin is big enough for its volume
+    """
+    show_xlabel = _fit_labels(layout.xoffs, layout.xlist_draw, LABEL_WIDTH_PX / px_per_unit)
+    show_ylabel = _fit_labels(layout.yoffs, layout.ylist_draw, LABEL_HEIGHT_PX / px_per_unit)
+    fits_vol_x = np.array(layout.xlist_draw) * px_per_unit >= LABEL_WIDTH_PX
+    fits_vol_y = np.array(layout.ylist_draw) * px_per_unit >= LABEL_HEIGHT_PX
+    return show_xlabel, show_ylabel, np.outer(fits_vol_x, fits_vol_y)
+
+
+def axes_px_per_unit(ax, layout):
+    """ Pixels per drawing unit once the layout's limits are set on the axes """
+    ax_box = ax.get_position()
+    fig_w_px, fig_h_px = ax.figure.get_size_inches() * ax.figure.dpi
+    return min(ax_box.width * fig_w_px / layout.xlim, ax_box.height * fig_h_px / layout.ylim)
+
+
+def size_label_text(size, units='mm'):
+    if units == 'mm':
+        return f'{size:.1f} mm\n({size / MM_PER_IN:.2f} in)'
+    return f'{size:.2f} in\n({size * MM_PER_IN:.2f} mm)'
+
+
+def volume_label_text(vol_ml):
+    vol_ml = int(vol_ml)
+    return f'{vol_ml} mL\n({vol_ml / ML_PER_CUP:.2f} cups)'
+
+
+def tray_summary_text(xlist, ylist, wall_size, depth=None, floor=None, units='mm', skipped_vols=False):
     x_total_real = sum(xlist) + (len(xlist)+1) * wall_size
     y_total_real = sum(ylist) + (len(ylist)+1) * wall_size
 
@@ -129,18 +145,112 @@ def draw_tray(xlist,
             total_size_txt += f'\nTotal Tray Height (depth+floor): {depth + floor:.1f} in'
             total_size_txt += f' ({(depth + floor) * MM_PER_IN:.2f} mm)'
 
-    ax.text(2, 1, total_size_txt, size=12, ha='left', va='bottom')
+    if skipped_vols:
+        total_size_txt += '\n(Some bins are too small to show their volumes)'
+    return total_size_txt
+
+
+def tray_rectangles(layout):
+    """ The frame, then every bin (x-major, same order as vol_mtrx_ml.flat) """
+    rects = [Rectangle((layout.x0, layout.y0), layout.x_total, layout.y_total)]
+    rects += [Rectangle((xoff, yoff), x, y) for xoff, x in zip(layout.xoffs, layout.xlist_draw)
+                                            for yoff, y in zip(layout.yoffs, layout.ylist_draw)]
+    return rects
+
 
-    ax.set_xlim(0, x0+x_total+5)
-    ax.set_ylim(0, y0+y_total+5)
+def build_tray_figure(xlist,
+                      ylist,
+                      wall_size,
+                      vol_mtrx_ml=None, # always in mL regardless of x/y/depth/etc units
+                      depth=None,
+                      floor=None,
+                      units='mm',
+                      dpi=PREVIEW_DPI):
+    """
+    Builds the preview with matplotlib's object-oriented API on the Agg canvas.
+    Nothing goes through pyplot, so there's no global figure registry holding on
+    to old figures, and it's safe to call from any thread.
+    """
+    # Depth and floor args are provided just to be displayed, not used in computing the drawing
+    fig = Figure(figsize=(FIGURE_SIZE_IN, FIGURE_SIZE_IN), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    if vol_mtrx_ml is not None:
+        if (len(xlist), len(ylist)) != tuple(vol_mtrx_ml.shape[:2]):
+            err_msg  = f'Input vol_mtrx_ml has shape {vol_mtrx_ml.shape}, does not'
+            err_msg += f'match shape of xlist ({len(xlist)}) and ylist ({len(ylist)})'
+            raise IOError(err_msg)
+
+    # To make things sane
+    layout = tray_display_layout(xlist, ylist, wall_size)
+    x0, y0 = layout.x0, layout.y0
+    ax.set_xlim(0, layout.xlim)
+    ax.set_ylim(0, layout.ylim)
     ax.set_aspect(1)
     ax.axis('off')
-    plt.show()
+
+    # The frame and all the bins in one collection, instead of one artist per bin
+    rects = tray_rectangles(layout)
+    ax.add_collection(PatchCollection(rects,
+                                      facecolors=[FRAME_COLOR] + [BIN_COLOR] * (len(rects) - 1),
+                                      linewidths=0))
+
+    show_xlabel, show_ylabel, fits_vol = tray_label_visibility(layout, axes_px_per_unit(ax, layout))
+    skipped_vols = False
+
+    for ix, (xoff, x) in enumerate(zip(layout.xoffs, layout.xlist_draw)):
+        # Draw x-label
+        if show_xlabel[ix]:
+            ax.text(xoff + x/2, y0-1, size_label_text(xlist[ix], units), ha='center', va='top', size=12)
+
+        for iy, (yoff, y) in enumerate(zip(layout.yoffs, layout.ylist_draw)):
+            if ix == 0 and show_ylabel[iy]:
+                ax.text(x0-1, yoff + y/2, size_label_text(ylist[iy], units), ha='right', va='center', size=12)
+
+            if vol_mtrx_ml is not None:
+                if not fits_vol[ix, iy]:
+                    skipped_vols = True
+                    continue
+                ax.text(xoff + x/2,
+                        yoff + y/2,
+                        volume_label_text(vol_mtrx_ml[ix, iy]),
+                        size=12,
+                        ha='center',
+                        va='center',
+                        color='w')
+
+    # Some summary text
+    total_size_txt = tray_summary_text(xlist, ylist, wall_size, depth, floor, units, skipped_vols)
+    ax.text(2, 1, total_size_txt, size=12, ha='left', va='bottom')
+    return fig
+
+
+def render_tray_png(*args, **kwargs):
+    """ Same arguments as build_tray_figure(), returns the PNG as bytes.  No files involved """
+    fig = build_tray_figure(*args, **kwargs)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=fig.dpi)
+    return buf.getvalue()
+
+
+def draw_tray(xlist,
+              ylist,
+              wall_size,
+              vol_mtrx_ml=None, # always in mL regardless of x/y/depth/etc units
+              depth=None,
+              floor=None,
+              units='mm',
+              out_filename=None):
+    """ Writes the preview PNG to out_filename (a new temp file if None) and returns the filename """
+    png = render_tray_png(xlist, ylist, wall_size, vol_mtrx_ml, depth, floor, units)
 
     if out_filename is None:
-        (_, out_filename) = tempfile.mkstemp(suffix='.png')
-        
-    fig.savefig(out_filename, dpi=72)
+        fd, out_filename = tempfile.mkstemp(suffix='.png')
+        os.close(fd)
+
+    with open(out_filename, 'wb') as f:
+        f.write(png)
     return out_filename
 
 
@@ -42,6 +42,7 @@ from solid import *
 from solid.utils import *
 from ast import literal_eval
 from math import sqrt, pi
+from math import floor as floor_func
 from hashlib import sha256
 import os
 import io
@@ -53,9 +54,15 @@ import requests
 import tempfile
 import yaml
 import logging
+import sqlite3
 
 # The constants file contains conversion constants and default size values
 from constants import *
+from scad_stream import stream_tray_scad
+from slot_polyhedron import slot_polyhedron
+from job_index import JobIndex, is_stale_request
+from tray_store import get_tray_store
+from mesh_share import get_mesh_registry
 
 logging.basicConfig(filename='gentray_script.log', level=logging.INFO)
 logging.info('Starting generate script')
@@ -73,7 +80,7 @@ zScale = 1.0
 
 ################################################################################
 # This will create a plug that can be subtracted from the tray frame/box
-def create_subtract_slot(x_offset, y_offset, x_size, y_size, depth, floor, round):
+def create_subtract_slot(x_offset, y_offset, x_size, y_size, depth, floor, round, resolution=None):
 
     x_size = float(x_size)
     y_size = float(y_size)
@@ -85,6 +92,11 @@ def create_subtract_slot(x_offset, y_offset, x_size, y_size, depth, floor, round
                      cube([x_size, y_size, depth*1.1])
                  )
 
+    # The same shape as a single polyhedron, computed directly (see slot_polyhedron.py)
+    if resolution is not None:
+        points, faces = slot_polyhedron(x_size, y_size, depth, round, resolution)
+        return translate([x_offset, y_offset, floor])(polyhedron(points=points, faces=faces))
+
     # Create 1:1 aspect, then stretch the whole thing at once 
     # Prism sitting with corner at origin
     fullPrism = cube([x_size, x_size, depth*1.1])
@@ -175,33 +187,149 @@ def compute_bin_volume(xsz, ysz, depth, round):
     return [totalVol_mL, totalVol_cups]
 
 
-def generate_tray_hash(xlist, ylist, depth, wall, floor, round, units='mm'):
+def get_script_version():
     """
-    This method generates a unique identifier for a given tray for the given version of this script
-    (based on the version.txt file).  This allows us to generate a given tray one time, and then it
-    can be saved to a central location and pulled if it is requested again, instead of regenerating.
+    The version.txt file lives next to this script.  Resolve it from here, not
+    from the current directory, so the tray hash doesn't depend on where the
+    process was started.
     """
-    to_hash = []
+    version_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'version.txt')
+    if not os.path.exists(version_file):
+        return ''
 
-    if os.path.exists('version.txt'):
-        to_hash.append(open('version.txt', 'r').read().strip())
+    with open(version_file, 'r') as f:
+        return f.read().strip()
 
-    to_hash.append(','.join([str(x) for x in xlist]))
-    to_hash.append(','.join([str(y) for y in ylist]))
-    to_hash.append(str(floor))
-    to_hash.append(str(wall))
-    to_hash.append(str(depth))
-    to_hash.append(str(round))
-    to_hash.append(units)
+
+def _quantize_mm(value, rescale):
+    # Integer number of HASH_QUANTUM_MM steps.  Note that "round" is shadowed by
+    # the tray parameter name in most of this file, so don't use it here.
+    return int(floor_func(float(value) * rescale / HASH_QUANTUM_MM + 0.5))
+
+
+def apply_tray_xform(xlist, ylist, xform, inverse=False):
+    """
+    Flips first, then the x/y swap (see XFORM_* in constants.py).  Use
+    inverse=True to go from the canonical layout back to the requested one.
+    """
+    xlist, ylist = list(xlist), list(ylist)
+    if inverse and xform & XFORM_SWAP_XY:
+        xlist, ylist = ylist, xlist
+    if xform & XFORM_FLIP_X:
+        xlist = xlist[::-1]
+    if xform & XFORM_FLIP_Y:
+        ylist = ylist[::-1]
+    if not inverse and xform & XFORM_SWAP_XY:
+        xlist, ylist = ylist, xlist
+    return xlist, ylist
+
+
+def generate_tray_key(xlist, ylist, depth, wall, floor, round, units='mm'):
+    """
+    Computes the canonical cache key for a tray.  Returns (hash, xform, canon_params):
+
+    - All values are converted to mm and quantized to HASH_QUANTUM_MM, so that
+      [30,40] and [30.0,40.0], or the same tray entered in inches, match.
+    - Every slot is symmetric, so a tray with its x- or y-list reversed is just
+      the mirror image, and swapping the lists is a reflection across the
+      diagonal.  Of the eight such layouts we pick the lexicographically
+      smallest one as the canonical layout.
+    - xform describes how the *requested* layout maps to the canonical one.
+      Because each of these operations is its own inverse, the requested
+      tray's mesh can be recovered from the canonical mesh with
+      mesh_utils.transform_tray_mesh(tris, xform).
+
+    canon_params is the canonical parameter map (mm), which is what should
+    actually be rendered and stored under the hash.
+    """
+    rescale = 1.0 if units == 'mm' else MM_PER_IN
+    xq = [_quantize_mm(x, rescale) for x in xlist]
+    yq = [_quantize_mm(y, rescale) for y in ylist]
+    others = [_quantize_mm(v, rescale) for v in (depth, wall, floor, round)]
+
+    canon_lists, xform = min((tuple(map(tuple, apply_tray_xform(xq, yq, xf))), xf) for xf in range(8))
+    canon_xq, canon_yq = canon_lists
+
+    to_hash = [
+        get_script_version(),
+        ','.join([str(x) for x in canon_xq]),
+        ','.join([str(y) for y in canon_yq]),
+        ','.join([str(v) for v in others]),
+        f'q={HASH_QUANTUM_MM}mm',
+    ]
 
     unique_str = '|'.join(to_hash).encode('utf-8')
     hash_str = sha256(unique_str).hexdigest()
     LOG_IT('Value hashed for ID:', unique_str)
     LOG_IT('Hash value for tray:', hash_str)
-    return hash_str
+
+    def to_mm(q):
+        return float(f'{q * HASH_QUANTUM_MM:.6f}')
+
+    canon_params = {
+        'xlist': [to_mm(x) for x in canon_xq],
+        'ylist': [to_mm(y) for y in canon_yq],
+        'depth': to_mm(others[0]),
+        'wall': to_mm(others[1]),
+        'floor': to_mm(others[2]),
+        'round': to_mm(others[3]),
+        'units': 'mm'
+    }
+    return hash_str, xform, canon_params
 
 
-def createTray(xlist, ylist, depth, wall, floor, round, units='mm'):
+def generate_tray_hash(xlist, ylist, depth, wall, floor, round, units='mm'):
+    """
+    This method generates a unique identifier for a given tray for the given version of this script
+    (based on the version.txt file).  This allows us to generate a given tray one time, and then it
+    can be saved to a central location and pulled if it is requested again, instead of regenerating.
+    Equivalent trays (see generate_tray_key) get the same identifier.
+    """
+    return generate_tray_key(xlist, ylist, depth, wall, floor, round, units)[0]
+
+
+def parse_tray_spec(spec):
+    """
+    Validates one tray spec from the bulk API or the render server, filling in defaults.  Raises
+    ValueError.  An optional slot_resolution is checked too, but it's how to render the tray rather
+    than part of it, so it's not in the returned params.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError('Each tray must be an object')
+
+    slot_resolution = spec.get('slot_resolution')
+    if slot_resolution is not None and (not isinstance(slot_resolution, int) or isinstance(slot_resolution, bool)
+                                        or slot_resolution <= 0):
+        raise ValueError('slot_resolution must be a positive integer or null')
+
+    units = spec.get('units', 'mm')
+    if units not in ('mm', 'in'):
+        raise ValueError('units must be "mm" or "in"')
+
+    param_map = {'units': units}
+    for k in ('xlist', 'ylist'):
+        vals = spec.get(k)
+        if not isinstance(vals, list) or len(vals) == 0 or \
+           not all([isinstance(v, (int, float)) and not isinstance(v, bool) and v > 0 for v in vals]):
+            raise ValueError(f'{k} must be a non-empty list of positive numbers')
+        param_map[k] = vals
+
+    defaults = {
+        'depth': DEFAULT_DEPTH_MM if units == 'mm' else DEFAULT_DEPTH_IN,
+        'wall': DEFAULT_WALL_MM if units == 'mm' else DEFAULT_WALL_IN,
+        'floor': DEFAULT_FLOOR_MM if units == 'mm' else DEFAULT_FLOOR_IN,
+        'round': DEFAULT_ROUND_MM if units == 'mm' else DEFAULT_ROUND_IN,
+    }
+    for k, default in defaults.items():
+        v = spec.get(k, default)
+        if not isinstance(v, (int, float)) or isinstance(v, bool) or v < 0:
+            raise ValueError(f'{k} must be a single, positive value')
+        param_map[k] = float(v)
+
+    return param_map
+
+
+def createTray(xlist, ylist, depth, wall, floor, round, units='mm', slot_resolution=None):
     # Input can be mm or inches, but convert to mm before any calcs
     if units != 'mm':
         xlist = [x*MM_PER_IN for x in xlist]
@@ -219,7 +347,7 @@ def createTray(xlist, ylist, depth, wall, floor, round, units='mm'):
     for ysz in ylist:
         xOff = wall
         for xsz in xlist:
-            slots.append(create_subtract_slot(xOff, yOff, xsz, ysz, depth, floor, round))
+            slots.append(create_subtract_slot(xOff, yOff, xsz, ysz, depth, floor, round, slot_resolution))
             xOff += wall + xsz
         yOff += wall + ysz
 
@@ -249,36 +377,152 @@ def createTray(xlist, ylist, depth, wall, floor, round, units='mm'):
               )]
 
 
+def compute_slot_offsets(sizes, wall):
+    """ Start position of each bin along one axis, same layout as createTray() """
+    offsets = []
+    off = wall
+    for sz in sizes:
+        offsets.append(off)
+        off += wall + sz
+    return offsets
+
+
+def createTrayStrip(xlist, ylist, depth, wall, floor, round, axis, first, last, slot_resolution=None):
+    """
+    MM ONLY.  Creates one strip of the tray:  bins first..last (inclusive) along
+    the given axis (0 for columns, 1 for rows), with every bin of the other
+    axis.  The strip is cut through the middle of the walls on either side, and
+    stays at its position in the full tray, so the rendered strips can be put
+    back together without any translation.
+    """
+    sizes = xlist if axis == 0 else ylist
+    offsets = compute_slot_offsets(sizes, wall)
+    totalWidth, totalHeight = compute_tray_footprint(xlist, ylist, wall)
+    total = totalWidth if axis == 0 else totalHeight
+
+    lo = 0 if first == 0 else offsets[first] - wall / 2.0
+    hi = total if last == len(sizes) - 1 else offsets[last] + sizes[last] + wall / 2.0
+
+    slots = []
+    for iy, yOff in enumerate(compute_slot_offsets(ylist, wall)):
+        for ix, xOff in enumerate(compute_slot_offsets(xlist, wall)):
+            if first <= (ix if axis == 0 else iy) <= last:
+                slots.append(create_subtract_slot(xOff, yOff, xlist[ix], ylist[iy], depth, floor, round,
+                                                  slot_resolution))
+
+    if axis == 0:
+        stripPrism = translate([lo, 0, 0])(cube([hi - lo, totalHeight, floor + depth]))
+    else:
+        stripPrism = translate([0, lo, 0])(cube([totalWidth, hi - lo, floor + depth]))
+
+    return lo, hi, scale([xScale, yScale, zScale])(difference()(stripPrism, union()(*slots)))
+
+
+def compute_tray_footprint(xlist, ylist, wall):
+    """
+    The outer width & height of the tray, in the same units as the inputs.
+    This is the same number createTray() returns, but without building the
+    SolidPython object tree (useful when laying out hundreds of trays).
+    """
+    totalWidth = sum(xlist) + (len(xlist) + 1) * wall
+    totalHeight = sum(ylist) + (len(ylist) + 1) * wall
+    return totalWidth, totalHeight
+
+
+def write_tray_scad(fn_scad, xlist, ylist, depth, wall, floor, round, units='mm', slot_resolution=None):
+    """
+    Write the tray out as an OpenSCAD file.  This streams the text directly
+    from the slot layout (see scad_stream.py), which produces exactly what
+    scad_render_to_file(createTray(...)) would, without building the tree.
+    """
+    stream_tray_scad(fn_scad, xlist, ylist, depth, wall, floor, round, units,
+                     slot_resolution=slot_resolution,
+                     scale_xyz=(xScale, yScale, zScale),
+                     orig_code_file=os.path.abspath(__file__))
+    return compute_tray_footprint(xlist, ylist, wall)
+
+
+def run_openscad(fn_scad, fn_stl):
+    """ This is the slow part:  OpenSCAD/CGAL converts the .scad file to an .stl """
+    subprocess.check_call('openscad -o "%s" "%s"' % (fn_stl, fn_scad), shell=True)
+    return fn_stl
+
+
+def generate_script_args(canon_params, s3bucket, s3dir, job_db=None):
+    """ Command line to render the canonical layout of a tray into the shared store, the way the web app does """
+    call_args = [
+        sys.executable,  # the python interpreter running this script
+        os.path.abspath(__file__),
+        f'[{",".join([str(x) for x in canon_params["xlist"]])}]',
+        f'[{",".join([str(y) for y in canon_params["ylist"]])}]',
+        '--depth', f'{canon_params["depth"]}',
+        '--wall', f'{canon_params["wall"]}',
+        '--floor', f'{canon_params["floor"]}',
+        '--round', f'{canon_params["round"]}',
+        '--s3bucket', s3bucket,
+        '--s3dir', s3dir,
+    ]
+    if job_db is not None:
+        call_args += ['--job-db', job_db]
+    return call_args + ['--yes']
+
+
+def render_tray_stl(fname, xlist, ylist, depth, wall, floor, round, units='mm', slot_resolution=None):
+    """
+    Writes <fname>.scad and <fname>.stl for the given tray (any extension on
+    fname is ignored).  Returns the path to the STL file.
+    """
+    fname = os.path.splitext(fname)[0]
+    write_tray_scad(fname + '.scad', xlist, ylist, depth, wall, floor, round, units, slot_resolution)
+    return run_openscad(fname + '.scad', fname + '.stl')
+
+
 # Only if there is
 def upload_status(params, status, message, s3obj):
-    s3client = boto3.client('s3')
     upload_params = copy.deepcopy(params)
     stat_file = {
         'status': status,
         'message': message,
-        'params': upload_params
+        'params': upload_params,
+        'updated': time.time()
     }
 
-    with tempfile.TemporaryFile() as fp:
-        fp.write(yaml.dump(stat_file, indent=2).encode('utf-8'))
-        fp.seek(0)
-        s3client.upload_fileobj(fp, args.s3bucket, s3obj, ExtraArgs={'ContentType': 'text/plain', 'ACL': 'public-read'})
+    get_tray_store(args.s3bucket).put_bytes(s3obj, yaml.dump(stat_file, indent=2).encode('utf-8'),
+                                            content_type='text/plain', public=True)
+
+    # Keep the web tier's job index in sync, so it doesn't have to poll S3 tray-by-tray
+    if args.job_db is not None:
+        JobIndex(args.job_db).set_tray_status(args.s3dir, status, message, upload_params)
+
+def share_rendered_mesh(tray_hash, fn_stl):
+    """ Puts the mesh in shared memory for the web app, if GENTRAY_MESH_DB is set.  Never fails the job """
+    registry = get_mesh_registry()
+    if registry is None:
+        return
+    try:
+        registry.publish_stl(tray_hash, fn_stl)
+    except (OSError, sqlite3.Error) as e:
+        LOG_IT('Could not share the rendered mesh:', str(e))
 
 # Only if there is
 def check_status(s3bucket, s3dir):
-    s3_download = f'https://{s3bucket}.s3.amazonaws.com/{s3dir}/status.txt'
-    status_file_obj = requests.get(s3_download)
-    if status_file_obj.status_code != 200:
+    status_file = get_tray_store(s3bucket).get_bytes(f'{s3dir}/status.txt')
+    if status_file is None:
         return {'status': 'DNE'}
     else:
-        LOG_IT("Getting status file to see if it has already been created:", s3_download)
-        status_dict = yaml.safe_load(status_file_obj.content)
+        LOG_IT("Getting status file to see if it has already been created:", f'{s3dir}/status.txt')
+        status_dict = yaml.safe_load(status_file)
         return status_dict
 
 
 
 
 if __name__=="__main__":
+    # The Docker image's entrypoint is this script, --serve switches it to the long-running render server
+    if sys.argv[1:2] == ['--serve']:
+        from tray_server import main
+        sys.exit(main(sys.argv[2:]))
+
     descr = """
     Create generic trays with rounded bin floors.
 
@@ -290,6 +534,7 @@ if __name__=="__main__":
        $ python3 generate_tray.py [x0, x1, ...] [y0, y1, ...] <options>
        $ python3 generate_tray.py [15,25,35] [30,40,50,60]
        $ python3 generate_tray.py [25] [50,50,50,50] --depth=20 --wall=2.5 --floor=2 --round=12
+       $ python3 generate_tray.py --serve --workers 4 < specs.jsonl    (see tray_server.py)
        
        
     NOTE: Total tray height is depth+floor.
@@ -351,6 +596,43 @@ if __name__=="__main__":
                         type=str,
                         help="Unique identifier for files to be stored in S3")
 
+    parser.add_argument("--job-db",
+                        dest='job_db',
+                        default=None,
+                        type=str,
+                        help="SQLite job index to update along with the S3 status file")
+
+    parser.add_argument("--strips",
+                        dest='strips',
+                        default=1,
+                        type=int,
+                        help="Split the tray into this many strips and render them in parallel (default 1)")
+
+    parser.add_argument("--slot-resolution",
+                        dest='slot_resolution',
+                        default=None,
+                        type=int,
+                        help="Build each rounded slot as one polyhedron with this many floor segments per side, "
+                             "instead of sphere CSG (much faster in OpenSCAD)")
+
+    parser.add_argument("--filament-diameter",
+                        dest='filament_diameter',
+                        default=1.75,
+                        type=float,
+                        help="Filament diameter for the material estimate (mm, default 1.75)")
+
+    parser.add_argument("--filament-density",
+                        dest='filament_density',
+                        default=1.24,
+                        type=float,
+                        help="Filament density for the weight estimate (g/cm3, default 1.24 for PLA)")
+
+    parser.add_argument("--layer-height",
+                        dest='layer_height',
+                        default=0.2,
+                        type=float,
+                        help="Layer height for the print time estimate (mm, default 0.2)")
+
     parser.add_argument("--hardcoded-params",
                         dest='hardcoded_params',
                         action='store_true',
@@ -418,6 +700,18 @@ if __name__=="__main__":
         else:
             round = max(max_round_size, 0)
 
+    # When writing to the shared cache, always render the canonical layout (mm,
+    # quantized).  Requests for mirrored/transposed copies of the same tray are
+    # served by transforming this mesh instead of rendering it again.
+    if args.s3bucket is not None:
+        _, xform, canon = generate_tray_key(xsizes, ysizes, depth, wall, floor, round, units)
+        if xform != 0 or units != 'mm':
+            LOG_IT('Rendering canonical layout of this tray for the shared cache')
+        xsizes, ysizes = canon['xlist'], canon['ylist']
+        depth, wall, floor, round = canon['depth'], canon['wall'], canon['floor'], canon['round']
+        units = 'mm'
+        RESCALE = 1.0
+
     if units == 'mm':
         xszStrs = [str(int(x)) for x in xsizes]
         yszStrs = [str(int(y)) for y in ysizes]
@@ -458,8 +752,7 @@ if __name__=="__main__":
 
     # Now tell solid python to create the .scad file
     LOG_IT('Writing to OpenSCAD file:', fn_scad)
-    twid, thgt, trayObj = createTray(xsizes, ysizes, depth, wall, floor, round, units)
-    scad_render_to_file(trayObj, fn_scad, file_header='$fn=64;')
+    twid, thgt = write_tray_scad(fn_scad, xsizes, ysizes, depth, wall, floor, round, units, args.slot_resolution)
 
     ################################################################################
     # The next section is simply for printing useful info to the console
@@ -542,6 +835,14 @@ if __name__=="__main__":
         LOG_IT(f'Total Depth  (with floor):  {depth+floor:.2f} in \t /  {(depth+floor)*MM_PER_IN:.1f} mm')
         LOG_IT('')
 
+    from tray_estimate import PrintProfile, estimate_tray, format_estimate
+    profile = PrintProfile(filament_diameter=args.filament_diameter,
+                           density=args.filament_density,
+                           layer_height=args.layer_height)
+    LOG_IT('Estimated print:', format_estimate(estimate_tray(xsizes, ysizes, depth, wall, floor, round, units, profile),
+                                               profile))
+    LOG_IT('')
+
     param_map = {
         'xlist': xsizes,
         'ylist': ysizes,
@@ -565,15 +866,19 @@ if __name__=="__main__":
 
     # The following section is only relevant if you specified an S3 storage location
     if args.s3bucket is not None:
-        import boto3
         from botocore.exceptions import ClientError
 
         if args.s3dir is None:
-            args.s3dir = generate_tray_hash(xsizes, ysizes, depth, wall, floor, round)
+            args.s3dir = generate_tray_hash(xsizes, ysizes, depth, wall, floor, round, units)
 
+        # Failed trays are tried again, and so are ones whose render was lost along the way
         exist_status = check_status(args.s3bucket, args.s3dir)
-        if exist_status['status'].lower() != 'dne':  # does-not-exist flag is false == already exists
+        if exist_status['status'].lower() not in ('dne', 'failed') and not is_stale_request(exist_status):
             LOG_IT(f'Tray already exists.')
+            # The web app marked it Queued before launching this, don't leave the index saying so
+            if args.job_db is not None:
+                JobIndex(args.job_db).set_tray_status(args.s3dir, exist_status['status'],
+                                                      exist_status.get('message', ''), exist_status.get('params'))
             exit(0)
 
         s3paths = {
@@ -589,8 +894,14 @@ if __name__=="__main__":
     LOG_IT('Converting to STL file:', fn_stl)
 
     try:
-        proc = subprocess.check_call('openscad -o "%s" "%s"' % (fn_stl, fn_scad), shell=True)
+        if args.strips > 1:
+            from parallel_render import render_tray_parallel
+            render_tray_parallel(fn_stl, xsizes, ysizes, depth, wall, floor, round, units, strips=args.strips,
+                                 slot_resolution=args.slot_resolution)
+        else:
+            run_openscad(fn_scad, fn_stl)
         if args.s3bucket is not None:
+            share_rendered_mesh(args.s3dir, fn_stl)
             upload_status(param_map,
                           status='Complete',
                           message=f'Model Generation Complete.  You can download the STL now',
@@ -606,9 +917,10 @@ if __name__=="__main__":
 
     if args.s3bucket is not None:
         try:
-            s3client = boto3.client('s3')
-            response = s3client.upload_file(fn_stl, args.s3bucket, s3paths['stl'])
-        except ClientError as e:
+            store = get_tray_store(args.s3bucket)
+            store.put_file(s3paths['stl'], fn_stl)
+            store.put_encoded_variants(s3paths['stl'], fn_stl)
+        except (ClientError, OSError) as e:
             upload_status(param_map,
                           status='Failed',
                           message=f'Model created but could not be made available for download.  Error: "{str(e)}"',
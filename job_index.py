@@ -0,0 +1,175 @@
+"""
+A small SQLite index of submitted jobs and tray statuses.
+
+The object store (S3) is the source of truth for the generated files, but
+asking it for the status of N trays means N GETs.  The web tier and the
+generate script both record every status change here as well, so the bulk
+API can answer "what's the status of these 200 trays" with one indexed query.
+
+Two tables:
+
+    jobs:   one row per submission (several jobs can point at the same tray)
+    trays:  one row per canonical tray hash, with its latest status
+
+SQLite in WAL mode handles one writer and many readers across processes,
+which is all we need here:  each connection is short-lived.
+"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import contextlib
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id     TEXT PRIMARY KEY,
+    tray_hash  TEXT NOT NULL,
+    xform      INTEGER NOT NULL,
+    created    REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_created ON jobs (created);
+CREATE INDEX IF NOT EXISTS jobs_by_hash ON jobs (tray_hash);
+
+CREATE TABLE IF NOT EXISTS trays (
+    tray_hash  TEXT PRIMARY KEY,
+    status     TEXT NOT NULL,
+    message    TEXT,
+    params     TEXT,
+    updated    REAL NOT NULL
+);
+"""
+
+# SQLite's default limit on the number of ?-parameters in one statement
+MAX_SQL_VARS = 999
+
+# A tray still Queued or Initiated this long after its last update has lost its render (the web
+# app restarted with it still waiting for a worker, or the generate script died), so it can be
+# requested again
+STALE_REQUEST_SEC = float(os.environ.get('GENTRAY_STALE_REQUEST_SEC', 2 * 3600))
+
+
+def is_stale_request(status_dict, now=None):
+    """
+    True for a Queued or Initiated status (from the index or the store) last updated more than
+    STALE_REQUEST_SEC ago.  Store statuses written before they had a time count as stale.
+    """
+    if str(status_dict.get('status', '')).lower() not in ('queued', 'initiated'):
+        return False
+    updated = status_dict.get('updated')
+    if updated is None:
+        return True
+    return (time.time() if now is None else now) - updated > STALE_REQUEST_SEC
+
+
+class JobIndex:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """ Commits on success, rolls back on error, and always closes """
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add_job(self, tray_hash, xform=0):
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute('INSERT INTO jobs (job_id, tray_hash, xform, created) VALUES (?, ?, ?, ?)',
+                         (job_id, tray_hash, int(xform), time.time()))
+        return job_id
+
+    def set_tray_status(self, tray_hash, status, message='', params=None):
+        with self._connect() as conn:
+            conn.execute('INSERT INTO trays (tray_hash, status, message, params, updated) VALUES (?, ?, ?, ?, ?) '
+                         'ON CONFLICT(tray_hash) DO UPDATE SET status=excluded.status, message=excluded.message, '
+                         'params=COALESCE(excluded.params, trays.params), updated=excluded.updated',
+                         (tray_hash, status, message, None if params is None else json.dumps(params), time.time()))
+
+    def remember_tray_params(self, tray_hash, params):
+        """
+        Records a tray's canonical params (e.g. when it's previewed) without giving it a status, so
+        any web worker can rebuild the tray from its hash.  A tray with no status reads as DNE.
+        """
+        with self._connect() as conn:
+            conn.execute("INSERT INTO trays (tray_hash, status, message, params, updated) VALUES (?, 'DNE', '', ?, ?) "
+                         "ON CONFLICT(tray_hash) DO UPDATE SET params=COALESCE(trays.params, excluded.params)",
+                         (tray_hash, json.dumps(params), time.time()))
+
+    def get_tray_params(self, tray_hash):
+        """ The canonical params recorded for the tray, or None """
+        with self._connect() as conn:
+            row = conn.execute('SELECT params FROM trays WHERE tray_hash = ?', (tray_hash,)).fetchone()
+        return None if row is None or row['params'] is None else json.loads(row['params'])
+
+    @staticmethod
+    def _tray_row_to_dict(row):
+        return {
+            'status': row['status'],
+            'message': row['message'],
+            'params': None if row['params'] is None else json.loads(row['params']),
+            'updated': row['updated'],
+        }
+
+    def get_tray_statuses(self, tray_hashes):
+        """
+        Returns {tray_hash: status_dict} for every requested hash.  Hashes we
+        have never seen get {'status': 'DNE'}, same as check_status().
+        """
+        tray_hashes = list(dict.fromkeys(tray_hashes))
+        out = {h: {'status': 'DNE'} for h in tray_hashes}
+        with self._connect() as conn:
+            for i in range(0, len(tray_hashes), MAX_SQL_VARS):
+                chunk = tray_hashes[i:i + MAX_SQL_VARS]
+                rows = conn.execute(f'SELECT * FROM trays WHERE tray_hash IN ({",".join("?" * len(chunk))})', chunk)
+                for row in rows:
+                    out[row['tray_hash']] = self._tray_row_to_dict(row)
+        return out
+
+    def _job_query(self, where='', args=(), limit=None, offset=0):
+        sql = 'SELECT jobs.*, trays.status, trays.message FROM jobs ' \
+              'LEFT JOIN trays ON jobs.tray_hash = trays.tray_hash ' + where + ' ORDER BY jobs.created DESC'
+        if limit is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            args = tuple(args) + (int(limit), int(offset))
+
+        with self._connect() as conn:
+            return [{
+                'job_id': row['job_id'],
+                'tray_hash': row['tray_hash'],
+                'xform': row['xform'],
+                'created': row['created'],
+                'status': row['status'] or 'DNE',
+                'message': row['message'],
+            } for row in conn.execute(sql, args)]
+
+    def get_job(self, job_id):
+        jobs = self._job_query('WHERE jobs.job_id = ?', (job_id,))
+        return jobs[0] if jobs else None
+
+    def recent_jobs(self, limit=50, offset=0):
+        """ Most recent first """
+        return self._job_query(limit=limit, offset=offset)
+
+    def job_history(self):
+        """ Every job, oldest first, with its tray's params (None if they were never recorded) """
+        with self._connect() as conn:
+            return [{
+                'tray_hash': row['tray_hash'],
+                'created': row['created'],
+                'params': None if row['params'] is None else json.loads(row['params']),
+            } for row in conn.execute('SELECT jobs.tray_hash, jobs.created, trays.params FROM jobs '
+                                      'LEFT JOIN trays ON jobs.tray_hash = trays.tray_hash ORDER BY jobs.created')]
+
+    def count_jobs(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
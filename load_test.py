@@ -0,0 +1,405 @@
+#! /usr/bin/python
+"""
+Load test for the web app (flask_serve/app.py), entirely on this machine.
+
+The app is started as a subprocess with:
+
+    - a local directory standing in for the S3 bucket (GENTRAY_STORE)
+    - its own job index database
+    - a fake "openscad" first on the PATH, which sleeps for --render-sec and
+      writes an STL of --stl-mb megabytes, so the generate script runs its real
+      code path without the minutes of CGAL
+
+Then --concurrency simulated users hit it for --duration seconds, each picking
+a scenario at random according to --mix:
+
+    preview    load the form, preview a tray, fetch its PNG, volumes and 3D meshes
+    generate   load the form and submit a tray for STL generation
+    poll       reload the status page of a tray that was submitted
+    download   download the STL of a tray that is complete
+    api        bulk-submit a few trays and bulk-poll all known trays via the JSON API
+
+Trays are drawn from a fixed pool of --distinct-trays layouts, so repeats hit
+the caches like real traffic does.  The JSON report has the throughput, the
+p50/p95/p99 latency and error rate of every route, and the server's RSS over
+time, so runs before and after a change to the web tier can be compared:
+
+    python3 load_test.py --concurrency 16 --duration 60 --out loadtest_before.json
+
+The app and the generate script still write their logs and output_trays/
+where they always do.
+"""
+import os
+import re
+import sys
+import json
+import html
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import numpy as np
+import requests
+
+
+THIS_SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_MIX = 'preview=60,generate=10,poll=20,download=5,api=5'
+
+FAKE_OPENSCAD = '''#!{python}
+# Stand-in for openscad:  sleeps, then writes a binary STL of the requested size
+import os, sys, time
+time.sleep(float(os.environ.get('FAKE_OPENSCAD_SEC', '2')))
+ntri = max(1, int(float(os.environ.get('FAKE_OPENSCAD_MB', '1')) * 1e6 / 50))
+with open(sys.argv[sys.argv.index('-o') + 1], 'wb') as f:
+    f.write(b'fake openscad'.ljust(80, b' ') + ntri.to_bytes(4, 'little'))
+    f.write(bytes(50 * ntri))
+'''
+
+
+def write_fake_openscad(bin_dir):
+    fn = os.path.join(bin_dir, 'openscad')
+    with open(fn, 'w') as f:
+        f.write(FAKE_OPENSCAD.format(python=sys.executable))
+    os.chmod(fn, 0o755)
+    return fn
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, work_dir, port):
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    write_fake_openscad(bin_dir)
+
+    env = dict(os.environ)
+    env.update({
+        'PATH': bin_dir + os.pathsep + env.get('PATH', ''),
+        'PYTHONPATH': THIS_SCRIPT_PATH + os.pathsep + env.get('PYTHONPATH', ''),
+        'GENTRAY_STORE': os.path.join(work_dir, 'store'),
+        'GENTRAY_JOB_DB': os.path.join(work_dir, 'jobs.sqlite3'),
+        'GENTRAY_RENDER_WORKERS': str(args.render_workers),
+        'FAKE_OPENSCAD_SEC': str(args.render_sec),
+        'FAKE_OPENSCAD_MB': str(args.stl_mb),
+    })
+
+    if args.server == 'waitress':
+        cmd = [sys.executable, '-m', 'waitress', f'--listen=127.0.0.1:{port}', f'--threads={args.server_threads}',
+               '--call', 'app:flask_app']
+    else:
+        cmd = [sys.executable, '-m', 'flask', '--app', 'app:flask_app', 'run', '--port', str(port), '--with-threads']
+
+    log = open(os.path.join(work_dir, 'server.log'), 'w')
+    return subprocess.Popen(cmd, cwd=os.path.join(THIS_SCRIPT_PATH, 'flask_serve'), env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_for_server(base_url, proc, timeout=30):
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        if proc.poll() is not None:
+            raise IOError(f'Server exited with code {proc.returncode}, see server.log')
+        try:
+            requests.get(base_url + '/about', timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise IOError(f'Server did not start within {timeout} seconds')
+
+
+def read_rss_mb(pid):
+    """ Resident set size from /proc (Linux only), None if unavailable """
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stop_event = threading.Event()
+
+    def run(self):
+        t0 = time.time()
+        while not self.stop_event.is_set():
+            rss = read_rss_mb(self.pid)
+            if rss is not None:
+                self.samples.append([round(time.time() - t0, 2), round(rss, 1)])
+            self.stop_event.wait(self.interval)
+
+
+def make_tray_pool(n, seed):
+    rng = random.Random(seed)
+    pool = []
+    for _ in range(n):
+        pool.append({
+            'x_list': ', '.join([str(rng.randrange(10, 80, 5)) for _ in range(rng.randint(1, 6))]),
+            'y_list': ', '.join([str(rng.randrange(10, 80, 5)) for _ in range(rng.randint(1, 6))]),
+            'tray_depth': rng.choice([20, 25, 32, 40]),
+            'wall_thickness': 1.8,
+            'floor_thickness': 1.8,
+            'floor_round': rng.choice([5, 8, 12]),
+            'binary_mm_or_in': 'mm',
+        })
+    return pool
+
+
+class SimulatedUser:
+    """ One browser session.  Records (route, seconds, ok) for every request it makes """
+
+    # Shared by all users:  trays submitted for generation, and the ones seen complete
+    submitted = {}
+    complete = {}
+    lock = threading.Lock()
+
+    def __init__(self, base_url, tray_pool, records, rng):
+        self.base_url = base_url
+        self.tray_pool = tray_pool
+        self.records = records
+        self.rng = rng
+        self.session = requests.Session()
+
+    def request(self, route, method, path, ok_codes=(200,), **kwargs):
+        t0 = time.perf_counter()
+        try:
+            resp = self.session.request(method, self.base_url + path, allow_redirects=False, timeout=120, **kwargs)
+            ok = resp.status_code in ok_codes
+        except requests.RequestException:
+            resp, ok = None, False
+        self.records.append((route, time.perf_counter() - t0, ok))
+        return resp if ok else None
+
+    def load_form(self):
+        resp = self.request('GET /traygen', 'GET', '/traygen')
+        if resp is None:
+            return None
+        m = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', resp.text)
+        return m.group(1) if m else None
+
+    def scenario_preview(self):
+        token = self.load_form()
+        if token is None:
+            return
+        data = dict(self.rng.choice(self.tray_pool), csrf_token=token, preview_only='Preview')
+        resp = self.request('POST /traygen preview', 'POST', '/traygen', data=data)
+        if resp is None:
+            return
+
+        png = re.search(r'src="(/preview_png/[^"]+)"', resp.text)
+        vol = re.search(r'href="(/volume_table/[^"]+)"', resp.text)
+        levels = re.search(r"data-levels='([^']*)'", resp.text)
+        if png:
+            self.request('GET /preview_png', 'GET', html.unescape(png.group(1)))
+        if vol:
+            self.request('GET /volume_table', 'GET', html.unescape(vol.group(1)))
+        if levels:
+            for url in json.loads(html.unescape(levels.group(1))):
+                self.request('GET /preview_mesh', 'GET', url)
+
+    def scenario_generate(self):
+        token = self.load_form()
+        if token is None:
+            return
+        data = dict(self.rng.choice(self.tray_pool), csrf_token=token, generate_stl='Generate')
+        resp = self.request('POST /traygen generate', 'POST', '/traygen', ok_codes=(307,), data=data)
+        if resp is None:
+            return
+        resp = self.request('POST /process_stl_request', 'POST', '/process_stl_request', ok_codes=(302,), data=data)
+        if resp is None:
+            return
+
+        status_path = resp.headers['Location'].replace(self.base_url, '')
+        with self.lock:
+            self.submitted[status_path] = True
+        self.request('GET /download_status_wait', 'GET', status_path)
+
+    def scenario_poll(self):
+        with self.lock:
+            pending = [p for p in self.submitted if p not in self.complete]
+        if not pending:
+            return self.scenario_generate()
+
+        status_path = self.rng.choice(pending)
+        resp = self.request('GET /download_status_wait', 'GET', status_path)
+        if resp is not None and 'Tray generation complete' in resp.text:
+            with self.lock:
+                self.complete[status_path] = True
+
+    def scenario_download(self):
+        with self.lock:
+            done = list(self.complete)
+        if not done:
+            return self.scenario_poll()
+
+        self.request('GET /download_stl', 'GET', self.rng.choice(done).replace('/download_status_wait/', '/download_stl/'))
+
+    def scenario_api(self):
+        specs = []
+        for tray in self.rng.sample(self.tray_pool, min(3, len(self.tray_pool))):
+            specs.append({'xlist': [float(x) for x in tray['x_list'].split(',')],
+                          'ylist': [float(y) for y in tray['y_list'].split(',')],
+                          'depth': tray['tray_depth'],
+                          'round': tray['floor_round']})
+        resp = self.request('POST /api/trays', 'POST', '/api/trays', ok_codes=(202,), json={'trays': specs})
+        if resp is None:
+            return
+
+        hashes = [j['tray_hash'] for j in resp.json()['jobs']]
+        with self.lock:
+            hashes += [p.split('/')[-1].split('?')[0] for p in self.submitted]
+        self.request('POST /api/trays/status', 'POST', '/api/trays/status', json={'tray_hashes': hashes})
+
+
+def parse_mix(mix_str):
+    mix = {}
+    for part in mix_str.split(','):
+        name, weight = part.split('=')
+        if not hasattr(SimulatedUser, f'scenario_{name.strip()}'):
+            raise ValueError(f'Unknown scenario in --mix: {name}')
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def run_users(base_url, args, mix, tray_pool, records):
+    names, weights = list(mix.keys()), list(mix.values())
+    deadline = time.time() + args.duration
+
+    def user_loop(iuser):
+        rng = random.Random(args.seed + iuser)
+        user = SimulatedUser(base_url, tray_pool, records, rng)
+        while time.time() < deadline:
+            getattr(user, 'scenario_' + rng.choices(names, weights)[0])()
+            if args.think_sec > 0:
+                time.sleep(rng.expovariate(1.0 / args.think_sec))
+
+    threads = [threading.Thread(target=user_loop, args=(i,)) for i in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def summarize(records, elapsed):
+    def stats(lat, ok):
+        lat_ms = np.array(lat) * 1000.0
+        return {
+            'requests': len(lat),
+            'errors': int(len(ok) - sum(ok)),
+            'error_rate': float(1.0 - np.mean(ok)),
+            'throughput_rps': len(lat) / elapsed,
+            'p50_ms': float(np.percentile(lat_ms, 50)),
+            'p95_ms': float(np.percentile(lat_ms, 95)),
+            'p99_ms': float(np.percentile(lat_ms, 99)),
+            'max_ms': float(lat_ms.max()),
+        }
+
+    by_route = {}
+    for route, lat, ok in records:
+        by_route.setdefault(route, ([], []))
+        by_route[route][0].append(lat)
+        by_route[route][1].append(ok)
+
+    return {
+        'overall': stats([r[1] for r in records], [r[2] for r in records]) if records else {},
+        'routes': {route: stats(lat, ok) for route, (lat, ok) in sorted(by_route.items())},
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage="python3 load_test.py [options]",
+                                     description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", dest="concurrency", default=8, type=int, help="Simulated users")
+    parser.add_argument("--duration", dest="duration", default=30.0, type=float, help="Seconds of traffic")
+    parser.add_argument("--mix", dest="mix", default=DEFAULT_MIX, type=str,
+                        help=f"Relative weight of each scenario (default: {DEFAULT_MIX})")
+    parser.add_argument("--think-sec", dest="think_sec", default=0.0, type=float,
+                        help="Mean pause between a user's scenarios (0 for a closed loop at full speed)")
+    parser.add_argument("--distinct-trays", dest="distinct_trays", default=50, type=int,
+                        help="Size of the pool of tray layouts the users pick from")
+    parser.add_argument("--render-sec", dest="render_sec", default=2.0, type=float,
+                        help="How long the fake openscad takes per tray")
+    parser.add_argument("--stl-mb", dest="stl_mb", default=1.0, type=float,
+                        help="Size of the STL the fake openscad writes")
+    parser.add_argument("--render-workers", dest="render_workers", default=os.cpu_count(), type=int,
+                        help="GENTRAY_RENDER_WORKERS for the server")
+    parser.add_argument("--server", dest="server", default='waitress', choices=['waitress', 'flask'],
+                        help="Serve with waitress (like production) or the Flask dev server")
+    parser.add_argument("--server-threads", dest="server_threads", default=8, type=int,
+                        help="Waitress worker threads")
+    parser.add_argument("--url", dest="url", default=None, type=str,
+                        help="Test an already-running server instead of starting one (no RSS then)")
+    parser.add_argument("--rss-interval", dest="rss_interval", default=1.0, type=float,
+                        help="Seconds between server RSS samples")
+    parser.add_argument("--seed", dest="seed", default=0, type=int)
+    parser.add_argument("--work-dir", dest="work_dir", default=None, type=str,
+                        help="Keep the store, job index and server log here (default: a temporary directory)")
+    parser.add_argument("-o", "--out", dest="out", default='./loadtest_report.json', type=str)
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    tray_pool = make_tray_pool(args.distinct_trays, args.seed)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='gentray_loadtest_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    proc, sampler = None, None
+    base_url = args.url
+    if base_url is None:
+        port = free_port()
+        base_url = f'http://127.0.0.1:{port}'
+        proc = start_server(args, work_dir, port)
+        wait_for_server(base_url, proc)
+        sampler = RssSampler(proc.pid, args.rss_interval)
+        sampler.start()
+
+    print(f'Running {args.concurrency} users against {base_url} for {args.duration:.0f}s (work dir: {work_dir})')
+    records = []
+    t0 = time.time()
+    try:
+        run_users(base_url, args, mix, tray_pool, records)
+    finally:
+        elapsed = time.time() - t0
+        if proc is not None:
+            sampler.stop_event.set()
+            proc.terminate()
+            proc.wait(timeout=10)
+
+    report = {'config': dict(vars(args), mix=mix), 'elapsed_sec': elapsed}
+    report.update(summarize(records, elapsed))
+    if sampler is not None:
+        rss = [mb for _, mb in sampler.samples]
+        report['server_rss_mb'] = {
+            'start': rss[0] if rss else None,
+            'peak': max(rss) if rss else None,
+            'end': rss[-1] if rss else None,
+            'samples': sampler.samples,
+        }
+
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f'{"route":<30} {"reqs":>7} {"err%":>6} {"rps":>7} {"p50ms":>8} {"p95ms":>8} {"p99ms":>8}')
+    for route, st in list(report['routes'].items()) + [('(all)', report['overall'])]:
+        if st:
+            print(f'{route:<30} {st["requests"]:>7} {100*st["error_rate"]:>6.1f} {st["throughput_rps"]:>7.1f} '
+                  f'{st["p50_ms"]:>8.1f} {st["p95_ms"]:>8.1f} {st["p99_ms"]:>8.1f}')
+    if sampler is not None and sampler.samples:
+        print(f'Server RSS: {report["server_rss_mb"]["start"]:.0f} MB at start, '
+              f'{report["server_rss_mb"]["peak"]:.0f} MB peak, {report["server_rss_mb"]["end"]:.0f} MB at end')
+    print(f'Report written to {args.out}')
@@ -0,0 +1,288 @@
+"""
+Hands rendered meshes between processes through shared memory, instead of
+every consumer re-reading and re-parsing the STL.
+
+The process that renders a tray publishes its mesh once, as a POSIX shared
+memory segment (/dev/shm on Linux).  The segment holds the exact binary STL
+image (80-byte header, triangle count, then one STL_BINARY_DTYPE record per
+triangle), so a consumer can either write it straight to a file or socket, or
+look at the vertices as an (N, 3, 3) float32 numpy view.  Neither copies.
+
+Which segment holds which tray, and who is using it, is kept in a small
+SQLite manifest next to it, in the same style as the job index:
+
+    meshes:     one row per segment:  tray hash, segment name, the shape and
+                dtype of the vertex view, size, and when it was last used
+    mesh_refs:  one row per (segment, pid) holding it open, with a count
+
+Publishing a tray again retires its old segment rather than overwriting it,
+so readers never see a mesh change under them.  Segments are reclaimed
+(unlinked) once nobody holds them and either they've been retired, or the
+total is over the budget (GENTRAY_MESH_CACHE_MB), least recently used first.
+References from processes that have died are dropped when evicting.  Even if
+a segment is unlinked while mapped, the mapping stays valid until closed.
+
+Sharing is off unless GENTRAY_MESH_DB is set, and the web app and the
+generate scripts it launches need to see the same path.
+"""
+import os
+import mmap
+import time
+import uuid
+import sqlite3
+import contextlib
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from mesh_utils import STL_HEADER_SIZE, stl_image_size, stl_triangle_view, pack_stl, parse_stl_bytes
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meshes (
+    segment    TEXT PRIMARY KEY,
+    tray_hash  TEXT NOT NULL,
+    shape      TEXT NOT NULL,
+    dtype      TEXT NOT NULL,
+    nbytes     INTEGER NOT NULL,
+    retired    INTEGER NOT NULL DEFAULT 0,
+    created    REAL NOT NULL,
+    last_used  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS meshes_by_hash ON meshes (tray_hash, retired);
+
+CREATE TABLE IF NOT EXISTS mesh_refs (
+    segment  TEXT NOT NULL,
+    pid      INTEGER NOT NULL,
+    count    INTEGER NOT NULL,
+    PRIMARY KEY (segment, pid)
+);
+"""
+
+DEFAULT_CACHE_MB = 1024
+
+# Before Python 3.13, every process that opens a segment registers it with its resource tracker,
+# which unlinks it when that process exits.  The manifest decides when segments go away, not that.
+try:
+    shared_memory.SharedMemory.__init__.__code__.co_varnames.index('track')
+    _TRACKED_BY_DEFAULT = False
+except ValueError:
+    _TRACKED_BY_DEFAULT = True
+
+
+def _open_segment(name, create=False, size=0):
+    if not _TRACKED_BY_DEFAULT:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def _unlink_segment(name):
+    try:
+        shm = _open_segment(name)
+    except FileNotFoundError:
+        return
+    if _TRACKED_BY_DEFAULT:
+        # unlink() unregisters it again, so the tracker must know about it first
+        resource_tracker.register(shm._name, 'shared_memory')
+    shm.close()
+    shm.unlink()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedMesh:
+    """
+    One attached segment, mapped read-only.  Use it as a context manager:
+
+        with registry.attach(tray_hash) as mesh:
+            volume = mesh_volume(mesh.tris)
+            f.write(mesh.stl_bytes)
+
+    Closing gives back the reference in the manifest.  The mapping itself goes
+    away with the last view of it, so a view kept past the with block is
+    still good, it just no longer keeps the segment from being evicted.
+    """
+    def __init__(self, registry, manifest, shm):
+        self.registry = registry
+        self.manifest = manifest
+        self._map = mmap.mmap(shm._fd, manifest['nbytes'], prot=mmap.PROT_READ)
+        shm.close()
+        self.stl_bytes = memoryview(self._map)
+        self.tris = stl_triangle_view(self.stl_bytes)
+
+    def close(self):
+        if self._map is None:
+            return
+        self.tris = self.stl_bytes = self._map = None
+        self.registry._release(self.manifest['segment'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SharedMeshRegistry:
+    def __init__(self, db_path, cache_mb=None):
+        self.db_path = db_path
+        if cache_mb is None:
+            cache_mb = float(os.environ.get('GENTRAY_MESH_CACHE_MB', DEFAULT_CACHE_MB))
+        self.budget_bytes = int(cache_mb * 1024 * 1024)
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """ Like the job index, but takes the write lock up front:  every caller reads, then writes """
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _manifest(row):
+        return {
+            'segment': row['segment'],
+            'tray_hash': row['tray_hash'],
+            'shape': [int(n) for n in row['shape'].split(',')],
+            'dtype': row['dtype'],
+            'offset': STL_HEADER_SIZE,
+            'nbytes': row['nbytes'],
+            'created': row['created'],
+            'last_used': row['last_used'],
+        }
+
+    def publish(self, tray_hash, tris):
+        """ Copies the (N, 3, 3) mesh into a new segment, retiring any older one for this tray """
+        tris = np.asarray(tris)
+        nbytes = stl_image_size(len(tris))
+        name = f'gentray_{tray_hash[:16]}_{uuid.uuid4().hex[:8]}'
+        shm = _open_segment(name, create=True, size=nbytes)
+        try:
+            pack_stl(tris, out=shm.buf)
+        except BaseException:
+            shm.close()
+            _unlink_segment(name)
+            raise
+        shm.close()
+
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('UPDATE meshes SET retired = 1 WHERE tray_hash = ?', (tray_hash,))
+            conn.execute('INSERT INTO meshes (segment, tray_hash, shape, dtype, nbytes, created, last_used) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (name, tray_hash, f'{len(tris)},3,3', '<f4', nbytes, now, now))
+        self.evict()
+        return name
+
+    def publish_stl(self, tray_hash, fn_stl):
+        """ Publishes a binary STL file as-is, without building the mesh """
+        with open(fn_stl, 'rb') as f:
+            data = f.read()
+        tris = stl_triangle_view(data)
+        if tris is None:
+            tris = parse_stl_bytes(data, fn_stl)
+        return self.publish(tray_hash, tris)
+
+    def attach(self, tray_hash):
+        """ A SharedMesh for the latest segment of this tray, or None if there isn't one """
+        pid = os.getpid()
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM meshes WHERE tray_hash = ? AND retired = 0 '
+                               'ORDER BY created DESC LIMIT 1', (tray_hash,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('INSERT INTO mesh_refs (segment, pid, count) VALUES (?, ?, 1) '
+                         'ON CONFLICT(segment, pid) DO UPDATE SET count = count + 1', (row['segment'], pid))
+            conn.execute('UPDATE meshes SET last_used = ? WHERE segment = ?', (time.time(), row['segment']))
+        manifest = self._manifest(row)
+
+        try:
+            shm = _open_segment(manifest['segment'])
+        except FileNotFoundError:
+            # Gone from /dev/shm (e.g. a reboot) but still in the manifest
+            with self._connect() as conn:
+                conn.execute('DELETE FROM mesh_refs WHERE segment = ?', (manifest['segment'],))
+                conn.execute('DELETE FROM meshes WHERE segment = ?', (manifest['segment'],))
+            return None
+        return SharedMesh(self, manifest, shm)
+
+    def _release(self, segment):
+        with self._connect() as conn:
+            conn.execute('UPDATE mesh_refs SET count = count - 1 WHERE segment = ? AND pid = ?',
+                         (segment, os.getpid()))
+            conn.execute('DELETE FROM mesh_refs WHERE count <= 0')
+            retired = conn.execute('SELECT retired FROM meshes WHERE segment = ?', (segment,)).fetchone()
+        if retired is not None and retired['retired']:
+            self.evict()
+
+    def retire(self, tray_hash):
+        """ Stops handing out this tray's mesh, it's unlinked once the last holder lets go """
+        with self._connect() as conn:
+            conn.execute('UPDATE meshes SET retired = 1 WHERE tray_hash = ?', (tray_hash,))
+        self.evict()
+
+    def evict(self, budget_bytes=None):
+        """
+        Unlinks every retired segment that nobody holds, then the least recently used of the
+        rest until the total fits the budget.  Returns the names of the unlinked segments.
+        """
+        budget_bytes = self.budget_bytes if budget_bytes is None else budget_bytes
+        evicted = []
+        with self._connect() as conn:
+            for row in conn.execute('SELECT DISTINCT pid FROM mesh_refs').fetchall():
+                if not _pid_alive(row['pid']):
+                    conn.execute('DELETE FROM mesh_refs WHERE pid = ?', (row['pid'],))
+
+            total = conn.execute('SELECT COALESCE(SUM(nbytes), 0) FROM meshes').fetchone()[0]
+            unheld = conn.execute('SELECT segment, nbytes, retired FROM meshes '
+                                  'WHERE segment NOT IN (SELECT segment FROM mesh_refs) '
+                                  'ORDER BY retired DESC, last_used ASC').fetchall()
+            for row in unheld:
+                if not row['retired'] and total <= budget_bytes:
+                    break
+                conn.execute('DELETE FROM meshes WHERE segment = ?', (row['segment'],))
+                total -= row['nbytes']
+                evicted.append(row['segment'])
+
+        # Once it's out of the manifest nobody new can attach, so this is safe outside the transaction
+        for name in evicted:
+            _unlink_segment(name)
+        return evicted
+
+    def stats(self):
+        with self._connect() as conn:
+            row = conn.execute('SELECT COUNT(*) AS segments, COALESCE(SUM(nbytes), 0) AS nbytes, '
+                               'COALESCE(SUM(retired), 0) AS retired FROM meshes').fetchone()
+            held = conn.execute('SELECT COUNT(DISTINCT segment) FROM mesh_refs').fetchone()[0]
+        return {'segments': row['segments'], 'retired': row['retired'], 'held': held,
+                'nbytes': row['nbytes'], 'budget_bytes': self.budget_bytes}
+
+
+def get_mesh_registry():
+    """ The registry named by GENTRAY_MESH_DB, or None if mesh sharing is off """
+    db_path = os.environ.get('GENTRAY_MESH_DB')
+    return SharedMeshRegistry(db_path) if db_path else None
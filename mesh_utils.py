@@ -0,0 +1,269 @@
+"""
+Small NumPy helpers for reading, writing and manipulating triangle meshes.
+
+All meshes are passed around as a float array of shape (N, 3, 3):  N triangles,
+each with three vertices, each with (x, y, z) coordinates.  That's exactly what
+an STL file stores, so there is no vertex/face indexing to keep in sync, and
+every transform below is a single vectorized operation over the whole mesh.
+"""
+import numpy as np
+
+from constants import XFORM_FLIP_X, XFORM_FLIP_Y, XFORM_SWAP_XY
+
+
+STL_BINARY_DTYPE = np.dtype([
+    ('normal', '<f4', (3,)),
+    ('verts', '<f4', (3, 3)),
+    ('attr', '<u2'),
+])
+
+# 80-byte header, then the uint32 triangle count
+STL_HEADER_SIZE = 84
+
+
+def read_stl(fn):
+    """
+    Reads both ASCII STL (which is what OpenSCAD writes by default) and binary
+    STL.  Returns an (N, 3, 3) float64 array of triangles.
+    """
+    with open(fn, 'rb') as f:
+        return parse_stl_bytes(f.read(), fn)
+
+
+def stl_triangle_view(data):
+    """
+    The (N, 3, 3) float32 vertices of a binary STL image, as a view into data
+    (no copy).  Returns None if data isn't a binary STL.
+    """
+    # A binary STL has an 80-byte header, then a uint32 count, then 50 bytes
+    # per triangle.  An ASCII file that happens to satisfy that is unlikely.
+    if len(data) >= STL_HEADER_SIZE:
+        ntri = int(np.frombuffer(data, dtype='<u4', count=1, offset=80)[0])
+        if len(data) == stl_image_size(ntri):
+            return np.frombuffer(data, dtype=STL_BINARY_DTYPE, count=ntri, offset=STL_HEADER_SIZE)['verts']
+    return None
+
+
+def parse_stl_bytes(data, name='<bytes>'):
+    tris = stl_triangle_view(data)
+    if tris is not None:
+        return tris.astype(np.float64)
+
+    verts = [line.split()[1:4] for line in data.splitlines() if line.lstrip().startswith(b'vertex')]
+    if len(verts) % 3 != 0:
+        raise IOError(f'Malformed ASCII STL file: {name}')
+
+    return np.array(verts, dtype=np.float64).reshape(-1, 3, 3)
+
+
+def compute_normals(tris):
+    """ Unit normals for each triangle, following the right-hand rule """
+    nrm = np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0])
+    lens = np.linalg.norm(nrm, axis=1, keepdims=True)
+    lens[lens == 0] = 1.0
+    return nrm / lens
+
+
+def stl_image_size(ntri):
+    return STL_HEADER_SIZE + ntri * STL_BINARY_DTYPE.itemsize
+
+
+def pack_stl(tris, out=None, header=b'OrganizerTrays3DPrint'):
+    """
+    The binary STL image of the mesh.  Written straight into out (any writable
+    buffer of stl_image_size(len(tris)) bytes, e.g. shared memory) if given,
+    otherwise into a new bytearray.  Returns the buffer.
+    """
+    tris = np.asarray(tris)
+    if out is None:
+        out = bytearray(stl_image_size(len(tris)))
+    hdr = np.frombuffer(out, dtype=np.uint8, count=80)
+    hdr[:] = np.frombuffer(header[:80].ljust(80, b' '), dtype=np.uint8)
+    np.frombuffer(out, dtype='<u4', count=1, offset=80)[0] = len(tris)
+
+    recs = np.frombuffer(out, dtype=STL_BINARY_DTYPE, count=len(tris), offset=STL_HEADER_SIZE)
+    recs['normal'] = compute_normals(tris)
+    recs['verts'] = tris
+    recs['attr'] = 0
+    return out
+
+
+def write_stl(fn_or_fileobj, tris, header=b'OrganizerTrays3DPrint'):
+    """
+    Always writes binary STL -- it's ~5x smaller than ASCII and much faster to
+    write and parse.  Accepts a filename or an open binary file object.
+    """
+    image = pack_stl(tris, header=header)
+    if hasattr(fn_or_fileobj, 'write'):
+        fn_or_fileobj.write(image)
+    else:
+        with open(fn_or_fileobj, 'wb') as f:
+            f.write(image)
+
+
+def mesh_bounds(tris):
+    """ Returns (min_xyz, max_xyz) of the mesh """
+    pts = tris.reshape(-1, 3)
+    return pts.min(axis=0), pts.max(axis=0)
+
+
+def mesh_volume(tris):
+    """
+    Signed-tetrahedron sum.  Positive for a closed mesh with outward-facing
+    triangles, which is what OpenSCAD produces.
+    """
+    return np.einsum('ij,ij->i', tris[:, 0], np.cross(tris[:, 1], tris[:, 2])).sum() / 6.0
+
+
+def translate_mesh(tris, offset):
+    return tris + np.asarray(offset, dtype=np.float64).reshape(1, 1, 3)
+
+
+def rotate_mesh_z90(tris):
+    """
+    Rotates the mesh 90 degrees counter-clockwise about the z-axis, then shifts
+    it so the bounding box starts at the origin again.  A pure rotation does
+    not change the triangle winding, so normals stay outward-facing.
+    """
+    out = np.empty_like(tris)
+    out[..., 0] = -tris[..., 1]
+    out[..., 1] = tris[..., 0]
+    out[..., 2] = tris[..., 2]
+    return translate_mesh(out, -mesh_bounds(out)[0] * [1, 1, 0])
+
+
+def transform_tray_mesh(tris, xform):
+    """
+    Turns the mesh of a canonical tray into the mesh of the requested layout
+    (see generate_tray.generate_tray_key).  Swap first, then the flips, each
+    done in place on the tray's own bounding box.  Every one of these is a
+    reflection, so an odd number of them reverses the triangle winding, which
+    we undo to keep the normals pointing outward.
+    """
+    out = np.array(tris, dtype=np.float64, copy=True)
+    lo, hi = mesh_bounds(out)
+    nreflect = 0
+
+    if xform & XFORM_SWAP_XY:
+        out[..., [0, 1]] = out[..., [1, 0]]
+        lo, hi = lo[[1, 0, 2]], hi[[1, 0, 2]]
+        nreflect += 1
+    if xform & XFORM_FLIP_X:
+        out[..., 0] = lo[0] + hi[0] - out[..., 0]
+        nreflect += 1
+    if xform & XFORM_FLIP_Y:
+        out[..., 1] = lo[1] + hi[1] - out[..., 1]
+        nreflect += 1
+
+    if nreflect % 2 == 1:
+        out = out[:, ::-1, :]
+    return out
+
+
+def weld_vertices(tris, tol=1e-4):
+    """
+    Merges vertices closer than ~tol (by snapping to a tol-sized grid) and
+    returns an indexed mesh (verts, faces).  Triangles that collapse to a line
+    or point after welding are dropped.
+    """
+    pts = tris.reshape(-1, 3)
+    keys = np.round(pts / tol).astype(np.int64)
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    verts = pts[first]
+    faces = inverse.reshape(-1, 3)
+
+    degenerate = (faces[:, 0] == faces[:, 1]) | (faces[:, 1] == faces[:, 2]) | (faces[:, 0] == faces[:, 2])
+    return verts, faces[~degenerate]
+
+
+def check_manifold(faces):
+    """
+    A closed, consistently-oriented (i.e. printable) mesh uses every directed
+    edge exactly once, and the reverse of every edge exactly once.  Returns a
+    dict with the number of offending edges of each kind, all zero if good.
+    """
+    directed = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    uniq, counts = np.unique(directed, axis=0, return_counts=True)
+
+    # Look up the reverse of each unique directed edge
+    nvert = int(faces.max()) + 1 if len(faces) else 1
+    fwd_codes = uniq[:, 0] * nvert + uniq[:, 1]
+    rev_codes = uniq[:, 1] * nvert + uniq[:, 0]
+    has_reverse = np.isin(rev_codes, fwd_codes)
+
+    return {
+        'duplicate_edges': int((counts > 1).sum()),
+        'open_edges': int((~has_reverse).sum()),
+    }
+
+
+def is_manifold(faces):
+    return not any(check_manifold(faces).values())
+
+
+def remove_plane_faces(tris, axis, value, tol=1e-4):
+    """ Drops every triangle lying entirely in the plane <axis> == value """
+    on_plane = (np.abs(tris[:, :, axis] - value) < tol).all(axis=1)
+    return tris[~on_plane]
+
+
+def triangle_areas(tris):
+    return 0.5 * np.linalg.norm(np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0]), axis=1)
+
+
+def sample_surface(tris, n, rng=None, return_index=False):
+    """
+    Draws n points uniformly over the surface area of the mesh:  pick the
+    triangles weighted by area, then a uniform barycentric point in each.
+    Optionally also returns which triangle each point came from.
+    """
+    rng = np.random.default_rng(0) if rng is None else rng
+    areas = triangle_areas(tris)
+    idx = rng.choice(len(tris), size=n, p=areas / areas.sum())
+
+    # Folding (u, v) back into the lower-left half keeps the points uniform
+    u, v = rng.random(n), rng.random(n)
+    fold = u + v > 1.0
+    u[fold], v[fold] = 1.0 - u[fold], 1.0 - v[fold]
+
+    t = tris[idx]
+    pts = t[:, 0] + u[:, None] * (t[:, 1] - t[:, 0]) + v[:, None] * (t[:, 2] - t[:, 0])
+    return (pts, idx) if return_index else pts
+
+
+def closest_points_on_triangles(p, tris):
+    """
+    The point on each triangle closest to the matching point in p, for any
+    number of (point, triangle) pairs at once.  This is the region test from
+    Ericson's "Real-Time Collision Detection" (5.1.5), with np.where standing
+    in for the early returns:  later assignments win, so they go from the
+    interior to the vertices.
+    """
+    a, b, c = tris[..., 0, :], tris[..., 1, :], tris[..., 2, :]
+    ab, ac = b - a, c - a
+
+    def dot(u, v):
+        return (u * v).sum(axis=-1)
+
+    def safe_div(n, d):
+        return n / np.where(d == 0, 1.0, d)
+
+    d1, d2 = dot(ab, p - a), dot(ac, p - a)
+    d3, d4 = dot(ab, p - b), dot(ac, p - b)
+    d5, d6 = dot(ab, p - c), dot(ac, p - c)
+    va, vb, vc = d3 * d6 - d5 * d4, d5 * d2 - d1 * d6, d1 * d4 - d3 * d2
+
+    denom = va + vb + vc
+    out = a + safe_div(vb, denom)[..., None] * ab + safe_div(vc, denom)[..., None] * ac
+
+    def region(mask, pt):
+        return np.where(mask[..., None], pt, out)
+
+    out = region((va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0),
+                 b + safe_div(d4 - d3, (d4 - d3) + (d5 - d6))[..., None] * (c - b))
+    out = region((vb <= 0) & (d2 >= 0) & (d6 <= 0), a + safe_div(d2, d2 - d6)[..., None] * ac)
+    out = region((d6 >= 0) & (d5 <= d6), c)
+    out = region((vc <= 0) & (d1 >= 0) & (d3 <= 0), a + safe_div(d1, d1 - d3)[..., None] * ab)
+    out = region((d3 >= 0) & (d4 <= d3), b)
+    out = region((d1 <= 0) & (d2 <= 0), a)
+    return out
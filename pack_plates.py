@@ -0,0 +1,319 @@
+#! /usr/bin/python
+"""
+Pack many trays onto as few print-bed plates as possible, and write one
+combined STL per plate.
+
+The tray specs are supplied as a YAML file containing a list of parameter
+maps (the same keys used everywhere else: xlist, ylist, depth, wall, floor,
+round, units), plus an optional "count" for printing multiple copies:
+
+    - xlist: [30, 40, 75]
+      ylist: [20, 30, 45]
+      depth: 25
+      count: 3
+    - xlist: [1, 1.5]
+      ylist: [2, 2, 2]
+      units: in
+
+Then pack them onto a 220mm x 220mm bed with 5mm between trays:
+
+    python3 pack_plates.py batch.yaml --bed 220 220 --spacing 5
+
+The packing uses the MaxRects algorithm (best-short-side-fit, with 90-degree
+rotation allowed), placing each tray on whichever open plate it fits best.
+Packing itself is pure arithmetic and handles hundreds of trays in a few
+milliseconds -- the OpenSCAD renders are by far the slowest part, and each
+unique tray is only rendered once no matter how many copies are requested.
+"""
+import os
+import sys
+import time
+import argparse
+import yaml
+import numpy as np
+
+from constants import *
+from generate_tray import LOG_IT, compute_tray_footprint, generate_tray_key, render_tray_stl
+from mesh_utils import read_stl, write_stl, mesh_bounds, translate_mesh, rotate_mesh_z90, transform_tray_mesh
+
+
+def normalize_tray_spec(spec):
+    """ Fill in default values for anything not specified, using the spec's units """
+    units = spec.get('units', 'mm')
+    defaults = {
+        'depth': DEFAULT_DEPTH_MM if units == 'mm' else DEFAULT_DEPTH_IN,
+        'wall': DEFAULT_WALL_MM if units == 'mm' else DEFAULT_WALL_IN,
+        'floor': DEFAULT_FLOOR_MM if units == 'mm' else DEFAULT_FLOOR_IN,
+        'round': DEFAULT_ROUND_MM if units == 'mm' else DEFAULT_ROUND_IN,
+    }
+
+    out = {
+        'xlist': list(spec['xlist']),
+        'ylist': list(spec['ylist']),
+        'units': units,
+    }
+
+    for k, v in defaults.items():
+        out[k] = float(spec.get(k, v))
+
+    return out
+
+
+################################################################################
+class MaxRectsBin:
+    """
+    One print bed.  Keeps the list of maximal free rectangles, where each
+    rectangle is (x, y, w, h).  New placements split every free rectangle they
+    overlap, then any free rectangle contained in another one is pruned.
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.free_rects = [(0.0, 0.0, width, height)]
+        self.placements = []
+
+    def find_position(self, w, h, allow_rotate=True):
+        """
+        Returns (score, x, y, rotated) for the best free position, or None.
+        Lower score is better: (short-side leftover, long-side leftover)
+        """
+        best = None
+        orientations = [(w, h, False)]
+        if allow_rotate and w != h:
+            orientations.append((h, w, True))
+
+        for fx, fy, fw, fh in self.free_rects:
+            for rw, rh, rotated in orientations:
+                if rw <= fw and rh <= fh:
+                    leftover_w, leftover_h = fw - rw, fh - rh
+                    score = (min(leftover_w, leftover_h), max(leftover_w, leftover_h))
+                    if best is None or score < best[0]:
+                        best = (score, fx, fy, rotated)
+        return best
+
+    def place(self, x, y, w, h):
+        new_free = []
+        for fr in self.free_rects:
+            new_free.extend(self._split_free_rect(fr, x, y, w, h))
+        self.free_rects = self._prune(new_free)
+
+    @staticmethod
+    def _split_free_rect(fr, x, y, w, h):
+        fx, fy, fw, fh = fr
+        if x >= fx + fw or x + w <= fx or y >= fy + fh or y + h <= fy:
+            return [fr]
+
+        out = []
+        if x > fx:
+            out.append((fx, fy, x - fx, fh))
+        if x + w < fx + fw:
+            out.append((x + w, fy, fx + fw - x - w, fh))
+        if y > fy:
+            out.append((fx, fy, fw, y - fy))
+        if y + h < fy + fh:
+            out.append((fx, y + h, fw, fy + fh - y - h))
+        return out
+
+    @staticmethod
+    def _prune(rects):
+        def contains(a, b):
+            return a[0] <= b[0] and a[1] <= b[1] and \
+                   a[0] + a[2] >= b[0] + b[2] and a[1] + a[3] >= b[1] + b[3]
+
+        keep = []
+        for i, r in enumerate(rects):
+            redundant = False
+            for j, other in enumerate(rects):
+                # Identical rects: keep only the first copy
+                if i != j and contains(other, r) and (other != r or j < i):
+                    redundant = True
+                    break
+            if not redundant:
+                keep.append(r)
+        return keep
+
+
+def pack_trays(footprints, bed_width, bed_height, spacing=5.0, allow_rotate=True):
+    """
+    Packs a list of (width, height) footprints (mm) onto as few beds as
+    possible.  Spacing is added to every tray and to the bed, so trays end up
+    "spacing" apart from each other but may sit flush with the bed edges.
+
+    Returns a list of plates, each one a list of placement dicts:
+
+        {'index': <position in footprints>, 'x': ..., 'y': ..., 'rotated': bool,
+         'width': ..., 'height': ...}   (width/height after rotation)
+    """
+    bed_w = bed_width + spacing
+    bed_h = bed_height + spacing
+
+    # Biggest-first packing works much better than input order
+    order = sorted(range(len(footprints)),
+                   key=lambda i: (max(footprints[i]), footprints[i][0] * footprints[i][1]),
+                   reverse=True)
+
+    bins = []
+    for idx in order:
+        w, h = footprints[idx]
+        pw, ph = w + spacing, h + spacing
+
+        fits_w_h = pw <= bed_w and ph <= bed_h
+        fits_h_w = allow_rotate and ph <= bed_w and pw <= bed_h
+        if not (fits_w_h or fits_h_w):
+            raise ValueError(f'Tray {idx} ({w:.1f}mm x {h:.1f}mm) does not fit on a '
+                             f'{bed_width:.1f}mm x {bed_height:.1f}mm bed')
+
+        best = None
+        for b in bins:
+            pos = b.find_position(pw, ph, allow_rotate)
+            if pos is not None and (best is None or pos[0] < best[1][0]):
+                best = (b, pos)
+
+        if best is None:
+            b = MaxRectsBin(bed_w, bed_h)
+            bins.append(b)
+            best = (b, b.find_position(pw, ph, allow_rotate))
+
+        b, (_, x, y, rotated) = best
+        rw, rh = (ph, pw) if rotated else (pw, ph)
+        b.place(x, y, rw, rh)
+        b.placements.append({
+            'index': idx,
+            'x': x,
+            'y': y,
+            'rotated': rotated,
+            'width': rw - spacing,
+            'height': rh - spacing,
+        })
+
+    return [b.placements for b in bins]
+
+
+def plate_utilization(plate, bed_width, bed_height):
+    return sum(p['width'] * p['height'] for p in plate) / float(bed_width * bed_height)
+
+
+################################################################################
+def place_tray_meshes(plates, specs, work_dir):
+    """
+    Renders each unique tray once (via OpenSCAD), then rotates/translates copies
+    of the meshes into place.  Returns one list of (N, 3, 3) triangle arrays per
+    plate, one array per placement.
+
+    Mirrored and transposed versions of a tray share a hash, so only the
+    canonical layout is rendered, and each copy is transformed into the layout
+    its spec asked for (the footprint the packer made room for).
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    canon_meshes = {}
+    mesh_cache = {}
+
+    def get_mesh(spec):
+        tray_hash, xform, canon = generate_tray_key(**spec)
+        if tray_hash not in canon_meshes:
+            fn_stl = os.path.join(work_dir, f'tray_{tray_hash[:16]}.stl')
+            if not os.path.exists(fn_stl):
+                LOG_IT('Rendering tray:', canon['xlist'], canon['ylist'])
+                render_tray_stl(fn_stl, **canon)
+            tris = read_stl(fn_stl)
+            canon_meshes[tray_hash] = translate_mesh(tris, -mesh_bounds(tris)[0] * [1, 1, 0])
+        if (tray_hash, xform) not in mesh_cache:
+            mesh_cache[(tray_hash, xform)] = transform_tray_mesh(canon_meshes[tray_hash], xform)
+        return mesh_cache[(tray_hash, xform)]
+
+    plate_parts = []
+    for plate in plates:
+        parts = []
+        for p in plate:
+            tris = get_mesh(specs[p['index']])
+            if p['rotated']:
+                tris = rotate_mesh_z90(tris)
+            parts.append(translate_mesh(tris, [p['x'], p['y'], 0]))
+        plate_parts.append(parts)
+
+    return plate_parts
+
+
+def build_plate_meshes(plates, specs, work_dir):
+    """ Same as place_tray_meshes(), with each plate as one (N, 3, 3) triangle array """
+    return [np.concatenate(parts, axis=0) for parts in place_tray_meshes(plates, specs, work_dir)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage="python3 pack_plates.py <specs.yaml> [options]",
+                                     description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("spec_file", help="YAML file with a list of tray parameter maps")
+
+    parser.add_argument("--bed",
+                        dest="bed",
+                        nargs=2,
+                        type=float,
+                        default=[220.0, 220.0],
+                        help="Usable print-bed width and height (mm, default 220 220)")
+
+    parser.add_argument("--spacing",
+                        dest="spacing",
+                        type=float,
+                        default=5.0,
+                        help="Gap between neighboring trays (mm, default 5)")
+
+    parser.add_argument("--no-rotate",
+                        dest="no_rotate",
+                        action='store_true',
+                        help="Do not allow trays to be rotated 90 degrees")
+
+    parser.add_argument("-o", "--outdir",
+                        dest="outdir",
+                        default='output_plates',
+                        type=str,
+                        help="Directory for the plate STLs and layout file")
+
+    parser.add_argument("--layout-only",
+                        dest="layout_only",
+                        action='store_true',
+                        help="Only compute and report the layout, skip the OpenSCAD renders")
+
+    args = parser.parse_args()
+
+    with open(args.spec_file, 'r') as f:
+        raw_specs = yaml.safe_load(f)
+
+    # Expand "count" into individual copies
+    specs = []
+    for raw in raw_specs:
+        spec = normalize_tray_spec(raw)
+        specs.extend([spec] * int(raw.get('count', 1)))
+
+    footprints = []
+    for spec in specs:
+        w, h = compute_tray_footprint(spec['xlist'], spec['ylist'], spec['wall'])
+        rescale = 1.0 if spec['units'] == 'mm' else MM_PER_IN
+        footprints.append((w * rescale, h * rescale))
+
+    bed_w, bed_h = args.bed
+    t0 = time.time()
+    plates = pack_trays(footprints, bed_w, bed_h, args.spacing, allow_rotate=not args.no_rotate)
+    pack_time = time.time() - t0
+
+    LOG_IT(f'Packed {len(specs)} trays onto {len(plates)} plate(s) in {1000*pack_time:.1f} ms')
+    for i, plate in enumerate(plates):
+        LOG_IT(f'   Plate {i+1}: {len(plate)} trays, bed utilization {100*plate_utilization(plate, bed_w, bed_h):.1f}%')
+
+    total_util = sum(w * h for w, h in footprints) / (len(plates) * bed_w * bed_h)
+    LOG_IT(f'Overall bed utilization: {100*total_util:.1f}%')
+
+    os.makedirs(args.outdir, exist_ok=True)
+    layout = [{'plate': i + 1, 'trays': [dict(p, spec=specs[p['index']]) for p in plate]}
+              for i, plate in enumerate(plates)]
+    with open(os.path.join(args.outdir, 'plates.yaml'), 'w') as f:
+        yaml.dump(layout, f, indent=2)
+
+    if args.layout_only:
+        sys.exit(0)
+
+    plate_meshes = build_plate_meshes(plates, specs, os.path.join(args.outdir, 'trays'))
+    for i, tris in enumerate(plate_meshes):
+        fn_plate = os.path.join(args.outdir, f'plate_{i+1:02d}.stl')
+        write_stl(fn_plate, tris)
+        LOG_IT('Wrote plate:', fn_plate)
@@ -0,0 +1,162 @@
+#! /usr/bin/python
+"""
+Render one large tray with several OpenSCAD processes at once.
+
+OpenSCAD is single-threaded, and for a big tray (say 12x10 bins) nearly all of
+the time goes into one CGAL difference() with a hundred-plus slots.  Instead,
+we cut the tray into K strips of whole rows or columns (through the middle of
+the interior walls), render each strip as its own OpenSCAD job in parallel,
+then stitch the meshes back together:
+
+    1. Drop the cap triangles that each strip has on the shared cut planes
+    2. Weld the vertices, which joins the open edges of neighboring strips
+    3. Verify the result is closed and consistently oriented (manifold)
+
+Nothing crosses a cut plane except the wall, whose cross-section is a plain
+rectangle, so the strip boundaries match up exactly.
+
+    python3 parallel_render.py [40,40,40,40,40,40] [30,30,30,30] --strips 4
+
+Use --benchmark to render the same tray with several strip counts and report
+the wall-clock speedup of each, relative to the first count given (so start
+with 1 to compare against a single OpenSCAD process):
+
+    python3 parallel_render.py [40,40,40,40,40,40] [30,30,30,30] --benchmark 1 2 4 8
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from ast import literal_eval
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from solid import scad_render_to_file
+
+from constants import *
+from generate_tray import LOG_IT, createTrayStrip, run_openscad, render_tray_stl
+from mesh_utils import read_stl, write_stl, remove_plane_faces, weld_vertices, check_manifold
+
+
+def plan_strips(sizes, nstrips):
+    """
+    Splits the bins along one axis into (at most) nstrips contiguous groups
+    with about the same number of bins each.  Returns [(first, last), ...]
+    """
+    nstrips = max(1, min(nstrips, len(sizes)))
+    bounds = np.linspace(0, len(sizes), nstrips + 1).round().astype(int)
+    return [(int(bounds[i]), int(bounds[i + 1]) - 1) for i in range(nstrips)]
+
+
+def stitch_strips(strip_meshes, axis, cut_planes, tol=1e-4):
+    """
+    Joins the strip meshes into a single triangle array.  Raises an IOError if
+    the stitched mesh is not manifold.
+    """
+    parts = []
+    for tris in strip_meshes:
+        for c in cut_planes:
+            tris = remove_plane_faces(tris, axis, c, tol)
+        parts.append(tris)
+
+    verts, faces = weld_vertices(np.concatenate(parts, axis=0), tol)
+    problems = check_manifold(faces)
+    if any(problems.values()):
+        raise IOError(f'Stitched mesh is not manifold: {problems}')
+
+    return verts[faces]
+
+
+def render_tray_parallel(fn_stl, xlist, ylist, depth, wall, floor, round, units='mm',
+                         strips=4, workers=None, work_dir=None, slot_resolution=None):
+    """
+    Drop-in replacement for the OpenSCAD step, splitting the tray into strips
+    along its longer axis (by bin count).  Returns the path to the STL file.
+    """
+    if units != 'mm':
+        xlist = [x * MM_PER_IN for x in xlist]
+        ylist = [y * MM_PER_IN for y in ylist]
+        depth, wall, floor, round = [v * MM_PER_IN for v in (depth, wall, floor, round)]
+
+    axis = 0 if len(xlist) >= len(ylist) else 1
+    sizes = xlist if axis == 0 else ylist
+    groups = plan_strips(sizes, strips)
+
+    if len(groups) == 1:
+        return render_tray_stl(fn_stl, xlist, ylist, depth, wall, floor, round, slot_resolution=slot_resolution)
+
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='tray_strips_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    jobs = []
+    cut_planes = []
+    for i, (first, last) in enumerate(groups):
+        lo, hi, stripObj = createTrayStrip(xlist, ylist, depth, wall, floor, round, axis, first, last,
+                                           slot_resolution)
+        if i > 0:
+            cut_planes.append(lo)
+        fn_base = os.path.join(work_dir, f'strip_{i:02d}')
+        scad_render_to_file(stripObj, fn_base + '.scad', file_header='$fn=64;')
+        jobs.append((fn_base + '.scad', fn_base + '.stl'))
+
+    LOG_IT(f'Rendering {len(jobs)} strips in parallel')
+    with ThreadPoolExecutor(max_workers=workers or len(jobs)) as pool:
+        strip_files = list(pool.map(lambda job: run_openscad(*job), jobs))
+
+    tris = stitch_strips([read_stl(fn) for fn in strip_files], axis, cut_planes)
+    write_stl(fn_stl, tris)
+    LOG_IT(f'Stitched {len(jobs)} strips into {fn_stl} ({len(tris)} triangles, manifold)')
+    return fn_stl
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage="python3 parallel_render.py [x0,x1,...] [y0,y1,...] [options]",
+                                     description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("bin_sizes", nargs='*')
+    parser.add_argument("--depth", dest="depth", default=DEFAULT_DEPTH_MM, type=float, help="Bin depth (mm)")
+    parser.add_argument("--wall", dest="wall", default=DEFAULT_WALL_MM, type=float, help="Wall thickness (mm)")
+    parser.add_argument("--floor", dest="floor", default=DEFAULT_FLOOR_MM, type=float, help="Floor thickness (mm)")
+    parser.add_argument("--round", dest="round", default=DEFAULT_ROUND_MM, type=float, help="Floor roundness (mm)")
+
+    parser.add_argument("--strips",
+                        dest="strips",
+                        default=os.cpu_count(),
+                        type=int,
+                        help="Number of strips / parallel OpenSCAD jobs (default: number of CPUs)")
+
+    parser.add_argument("-o", "--outfile",
+                        dest="outfile",
+                        default='./output_trays/tray_parallel.stl',
+                        type=str)
+
+    parser.add_argument("--benchmark",
+                        dest="benchmark",
+                        nargs='+',
+                        type=int,
+                        default=None,
+                        help="Render with each of these strip counts and report the speedup")
+
+    args = parser.parse_args()
+    size_args = ''.join(args.bin_sizes).replace(' ', '').replace('][', '],[')
+    xsizes, ysizes = literal_eval(size_args)
+    tray_args = (xsizes, ysizes, args.depth, args.wall, args.floor, args.round)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.outfile)), exist_ok=True)
+    if args.benchmark is None:
+        render_tray_parallel(args.outfile, *tray_args, strips=args.strips)
+        sys.exit(0)
+
+    results = []
+    for nstrips in args.benchmark:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            t0 = time.time()
+            render_tray_parallel(os.path.join(tmpdir, 'tray.stl'), *tray_args, strips=nstrips, work_dir=tmpdir)
+            results.append((nstrips, time.time() - t0))
+
+    base = results[0][1]
+    LOG_IT(f'{"strips":>8} {"seconds":>10} {"speedup":>10}')
+    for nstrips, secs in results:
+        LOG_IT(f'{nstrips:>8} {secs:>10.1f} {base/secs:>9.2f}x')
@@ -0,0 +1,271 @@
+"""
+Fast approximate 3D preview meshes, without OpenSCAD.
+
+The tray is described as a signed-distance field (SDF) in NumPy:  the outer
+box minus the same rounded slots that create_subtract_slot() builds (a prism
+intersected with the union of a raised prism and a scaled sphere).  The SDF is
+sampled on a regular grid and turned into triangles with "surface nets", a
+close cousin of marching cubes that needs no 256-case lookup table and is
+fully vectorized here.  Distances are negative inside the solid.
+
+Several levels of detail are available (PREVIEW_LEVELS, the number of grid
+cells along the longest side of the tray).  The coarsest one takes a few
+milliseconds, so the web page can show it right away and then swap in the
+finer levels as they arrive.  Walls and floors thinner than the grid spacing
+would simply disappear, so at the coarse levels they are drawn thicker than
+they really are -- this is a preview, the STL is still made by OpenSCAD.
+
+The meshes are packaged as binary glTF (.glb), which browsers can load
+directly into three.js.
+"""
+import json
+import struct
+import numpy as np
+
+from constants import *
+
+
+PREVIEW_LEVELS = (32, 64, 128)
+
+
+def _interval_sdf(coord, lo, hi):
+    """ 1D signed distance to the interval [lo, hi] (negative inside) """
+    return np.maximum(lo - coord, coord - hi)
+
+
+def _nearest_interval(coord, starts, ends):
+    """ Index of the interval closest to each coordinate """
+    dists = np.maximum(starts[None, :] - coord[:, None], coord[:, None] - ends[None, :])
+    return np.argmin(dists, axis=1)
+
+
+def _box_sdf_from_axes(dx, dy, dz):
+    """ Combine 1D interval distances into the distance to an axis-aligned box """
+    outside = np.sqrt(np.maximum(dx, 0)**2 + np.maximum(dy, 0)**2 + np.maximum(dz, 0)**2)
+    inside = np.minimum(np.maximum(np.maximum(dx, dy), dz), 0)
+    return outside + inside
+
+
+def evaluate_tray_sdf(xlist, ylist, depth, wall, floor, round, xs, ys, zs):
+    """
+    Samples the tray SDF on the grid xs * ys * zs (all mm).  Returns an array
+    of shape (len(xs), len(ys), len(zs)).
+
+    The slots sit in a regular grid separated by walls, so the closest slot to
+    any point is found independently in x and y.  That means every sample only
+    needs to be compared against one slot rather than all of them.
+    """
+    xlist = np.asarray(xlist, dtype=np.float64)
+    ylist = np.asarray(ylist, dtype=np.float64)
+    x0 = wall + np.concatenate([[0], np.cumsum(xlist + wall)[:-1]])
+    y0 = wall + np.concatenate([[0], np.cumsum(ylist + wall)[:-1]])
+    x1, y1 = x0 + xlist, y0 + ylist
+    width = x1[-1] + wall
+    height = y1[-1] + wall
+    top = floor + depth
+
+    ix = _nearest_interval(xs, x0, x1)
+    iy = _nearest_interval(ys, y0, y1)
+    X = xs[:, None, None]
+    Y = ys[None, :, None]
+    Z = zs[None, None, :]
+
+    # Per-sample slot bounds, via broadcasting the nearest row/column
+    sx0, sx1 = x0[ix][:, None, None], x1[ix][:, None, None]
+    sy0, sy1 = y0[iy][None, :, None], y1[iy][None, :, None]
+
+    dx = _interval_sdf(X, sx0, sx1)
+    dy = _interval_sdf(Y, sy0, sy1)
+    dz_prism = _interval_sdf(Z, floor, floor + depth * 1.1)
+    slot = _box_sdf_from_axes(dx, dy, dz_prism)
+
+    if round > 0:
+        # Raised prism, starting at floor+round
+        dz_raised = _interval_sdf(Z, floor + round, floor + depth * 1.1)
+        raised = _box_sdf_from_axes(dx, dy, dz_raised)
+
+        # Scaled sphere -> ellipsoid with semi-axes (sqrt2*x/2, sqrt2*y/2, round)
+        cx = (sx0 + sx1) / 2.0
+        cy = (sy0 + sy1) / 2.0
+        ra = np.sqrt(2) * (sx1 - sx0) / 2.0
+        rb = np.sqrt(2) * (sy1 - sy0) / 2.0
+        px, py, pz = X - cx, Y - cy, Z - (floor + round)
+        k0 = np.sqrt((px / ra)**2 + (py / rb)**2 + (pz / round)**2)
+        k1 = np.sqrt((px / ra**2)**2 + (py / rb**2)**2 + (pz / round**2)**2)
+        ellipsoid = k0 * (k0 - 1.0) / np.maximum(k1, 1e-12)
+
+        slot = np.maximum(slot, np.minimum(raised, ellipsoid))
+
+    dz_box = _interval_sdf(Z, 0.0, top)
+    box = _box_sdf_from_axes(_interval_sdf(X, 0.0, width), _interval_sdf(Y, 0.0, height), dz_box)
+    return np.maximum(box, -slot)
+
+
+################################################################################
+# Corner offsets of a grid cell, and the 12 cell edges as pairs of corners
+_CORNERS = np.array([[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+_EDGES = [(a, b) for a in range(8) for b in range(a + 1, 8)
+          if np.abs(_CORNERS[a] - _CORNERS[b]).sum() == 1]
+
+
+def surface_nets(sdf, origin, spacing):
+    """
+    Extracts the zero level set of the sampled field.  One vertex is placed in
+    every cell that the surface passes through (at the average of the edge
+    crossings), and every grid edge with a sign change becomes a quad joining
+    the four cells around it.  The field must be positive on the boundary of
+    the grid so the result is closed.
+
+    Returns (verts, faces):  float32 (V, 3) and uint32 (F, 3), counter-
+    clockwise seen from outside.
+    """
+    nx, ny, nz = sdf.shape
+    inside = sdf < 0
+
+    corner_vals = np.stack([sdf[i:nx - 1 + i, j:ny - 1 + j, k:nz - 1 + k] for i, j, k in _CORNERS], axis=-1)
+    corner_in = corner_vals < 0
+    active = corner_in.any(axis=-1) & ~corner_in.all(axis=-1)
+    cell_idx = np.argwhere(active)
+
+    vals = corner_vals[active]
+    pos_sum = np.zeros((len(cell_idx), 3))
+    count = np.zeros(len(cell_idx))
+    for a, b in _EDGES:
+        va, vb = vals[:, a], vals[:, b]
+        crosses = (va < 0) != (vb < 0)
+        t = np.where(crosses, va / np.where(crosses, va - vb, 1.0), 0.0)
+        pt = _CORNERS[a][None, :] + t[:, None] * (_CORNERS[b] - _CORNERS[a])[None, :]
+        pos_sum += np.where(crosses[:, None], pt, 0.0)
+        count += crosses
+
+    verts = (cell_idx + pos_sum / count[:, None]) * spacing + origin
+
+    vert_id = np.full(active.shape, -1, dtype=np.int64)
+    vert_id[active] = np.arange(len(cell_idx))
+
+    faces = []
+    for axis in range(3):
+        b, c = (axis + 1) % 3, (axis + 2) % 3
+        lo = [slice(None)] * 3
+        hi = [slice(None)] * 3
+        lo[axis] = slice(0, -1)
+        hi[axis] = slice(1, None)
+        flips = inside[tuple(lo)] != inside[tuple(hi)]
+
+        # Edges on the outer layer of the grid can't have four cells around them
+        for ax in (b, c):
+            sl = [slice(None)] * 3
+            sl[ax] = 0
+            flips[tuple(sl)] = False
+            sl[ax] = -1
+            flips[tuple(sl)] = False
+
+        edge_idx = np.argwhere(flips)
+        starts_inside = inside[tuple(lo)][flips]
+
+        def cell(db, dc):
+            idx = edge_idx.copy()
+            idx[:, b] += db
+            idx[:, c] += dc
+            return vert_id[idx[:, 0], idx[:, 1], idx[:, 2]]
+
+        q = np.stack([cell(-1, -1), cell(0, -1), cell(0, 0), cell(-1, 0)], axis=1)
+        q[~starts_inside] = q[~starts_inside][:, ::-1]
+        faces.append(q[:, [0, 1, 2]])
+        faces.append(q[:, [0, 2, 3]])
+
+    return verts.astype(np.float32), np.concatenate(faces).astype(np.uint32)
+
+
+def vertex_normals(verts, faces):
+    """ Area-weighted vertex normals, so the preview shades smoothly """
+    tri = verts[faces].astype(np.float64)
+    fn = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+    vn = np.zeros((len(verts), 3))
+    for k in range(3):
+        np.add.at(vn, faces[:, k], fn)
+    lens = np.linalg.norm(vn, axis=1, keepdims=True)
+    lens[lens == 0] = 1.0
+    return (vn / lens).astype(np.float32)
+
+
+def build_preview_mesh(xlist, ylist, depth, wall, floor, round, units='mm', level=0):
+    """
+    Returns (verts, faces) for the given level of detail (index into
+    PREVIEW_LEVELS).  Output coordinates are always mm.
+    """
+    rescale = 1.0 if units == 'mm' else MM_PER_IN
+    xlist = [x * rescale for x in xlist]
+    ylist = [y * rescale for y in ylist]
+    depth, wall, floor, round = [v * rescale for v in (depth, wall, floor, round)]
+
+    width = sum(xlist) + (len(xlist) + 1) * wall
+    height = sum(ylist) + (len(ylist) + 1) * wall
+    h = max(width, height, floor + depth) / PREVIEW_LEVELS[level]
+
+    # Thicken anything that would fall between grid samples (see module docs)
+    min_thick = 1.5 * h
+    if wall < min_thick:
+        xlist = [max(x - (min_thick - wall), h) for x in xlist]
+        ylist = [max(y - (min_thick - wall), h) for y in ylist]
+        wall = min_thick
+    if floor < min_thick:
+        depth = max(depth - (min_thick - floor), h)
+        round = min(round, depth)
+        floor = min_thick
+
+    width = sum(xlist) + (len(xlist) + 1) * wall
+    height = sum(ylist) + (len(ylist) + 1) * wall
+    top = floor + depth
+
+    # Pad by two cells all around so the surface never touches the grid boundary
+    xs = np.arange(-2 * h, width + 2 * h, h)
+    ys = np.arange(-2 * h, height + 2 * h, h)
+    zs = np.arange(-2 * h, top + 2 * h, h)
+    sdf = evaluate_tray_sdf(xlist, ylist, depth, wall, floor, round, xs, ys, zs)
+    return surface_nets(sdf, np.array([xs[0], ys[0], zs[0]]), h)
+
+
+def encode_glb(verts, faces):
+    """
+    Minimal binary glTF 2.0:  one mesh with positions, normals and triangle
+    indices.  The tray is Z-up but glTF is Y-up, so the node carries a -90
+    degree rotation about x.
+    """
+    normals = vertex_normals(verts, faces)
+    pos_bytes = verts.astype('<f4').tobytes()
+    nrm_bytes = normals.astype('<f4').tobytes()
+    # Coarse levels fit in 16-bit indices, which keeps the first download small
+    idx_dtype, idx_type = ('<u2', 5123) if len(verts) < 65536 else ('<u4', 5125)
+    idx_bytes = faces.astype(idx_dtype).tobytes()
+    bin_chunk = pos_bytes + nrm_bytes + idx_bytes
+
+    gltf = {
+        'asset': {'version': '2.0', 'generator': 'OrganizerTrays3DPrint'},
+        'scene': 0,
+        'scenes': [{'nodes': [0]}],
+        'nodes': [{'mesh': 0, 'rotation': [-0.7071068, 0, 0, 0.7071068]}],
+        'meshes': [{'primitives': [{'attributes': {'POSITION': 0, 'NORMAL': 1}, 'indices': 2}]}],
+        'buffers': [{'byteLength': len(bin_chunk)}],
+        'bufferViews': [
+            {'buffer': 0, 'byteOffset': 0, 'byteLength': len(pos_bytes), 'target': 34962},
+            {'buffer': 0, 'byteOffset': len(pos_bytes), 'byteLength': len(nrm_bytes), 'target': 34962},
+            {'buffer': 0, 'byteOffset': len(pos_bytes) + len(nrm_bytes), 'byteLength': len(idx_bytes), 'target': 34963},
+        ],
+        'accessors': [
+            {'bufferView': 0, 'componentType': 5126, 'count': len(verts), 'type': 'VEC3',
+             'min': verts.min(axis=0).tolist(), 'max': verts.max(axis=0).tolist()},
+            {'bufferView': 1, 'componentType': 5126, 'count': len(verts), 'type': 'VEC3'},
+            {'bufferView': 2, 'componentType': idx_type, 'count': faces.size, 'type': 'SCALAR'},
+        ],
+    }
+
+    json_chunk = json.dumps(gltf, separators=(',', ':')).encode('utf-8')
+    json_chunk += b' ' * (-len(json_chunk) % 4)
+    bin_chunk += b'\x00' * (-len(bin_chunk) % 4)
+
+    total = 12 + 8 + len(json_chunk) + 8 + len(bin_chunk)
+    out = struct.pack('<4sII', b'glTF', 2, total)
+    out += struct.pack('<I4s', len(json_chunk), b'JSON') + json_chunk
+    out += struct.pack('<I4s', len(bin_chunk), b'BIN\x00') + bin_chunk
+    return out
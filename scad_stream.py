@@ -0,0 +1,259 @@
+#! /usr/bin/python
+"""
+Streams the OpenSCAD code for a tray straight from the slot layout, without
+building a SolidPython object tree first.
+
+createTray() builds about seven SolidPython objects per bin, and then
+scad_render_to_file() walks the tree and builds the whole file as one string
+(re-indenting each subtree once per level).  For a 100x100 bead organizer
+that's ~70,000 objects and a lot of string copying before OpenSCAD even
+starts.  The generators here produce the exact same text one slot at a time,
+so memory stays flat and the time is linear in the number of bins.
+
+The output is byte-for-byte what scad_render_to_file(createTray(...),
+file_header='$fn=64;') writes from generate_tray.py, including the SolidPython
+header line and the copy of the generating source appended at the end.  That
+is why the number formatting below mirrors SolidPython's py2openscad().
+
+Run this file directly to benchmark both paths on grids up to 100x100:
+
+    python3 scad_stream.py --benchmark 10 25 50 100
+"""
+import os
+import time
+import datetime
+import argparse
+import tracemalloc
+from math import sqrt
+from functools import lru_cache
+from importlib import metadata
+
+from constants import *
+from slot_polyhedron import slot_polyhedron
+
+
+def _fmt(v):
+    """ Same formatting SolidPython uses for parameter values """
+    if type(v) == bool:
+        return str(v).lower()
+    if type(v) == float:
+        return f'{v:.10f}'
+    if hasattr(v, '__iter__'):
+        return '[' + ', '.join([_fmt(x) for x in v]) + ']'
+    return str(v)
+
+
+def _open(depth, call):
+    return '\n' + '\t' * depth + call + ' {'
+
+
+def _close(depth):
+    return '\n' + '\t' * depth + '}'
+
+
+def _leaf(depth, call):
+    return '\n' + '\t' * depth + call + ';'
+
+
+@lru_cache(maxsize=256)
+def _polyhedron_call(x_size, y_size, depth, round, resolution):
+    """ The points & faces are most of the file, and most trays repeat the same few sizes """
+    points, faces = slot_polyhedron(x_size, y_size, depth, round, resolution)
+    return f'polyhedron(convexity = 10, faces = {_fmt(faces)}, points = {_fmt(points)})'
+
+
+def iter_slot_scad(x_offset, y_offset, x_size, y_size, depth, floor, round, indent, resolution=None):
+    """ The text of create_subtract_slot(), at the given indentation level """
+    x_size = float(x_size)
+    y_size = float(y_size)
+    d = indent
+
+    if round <= 0:
+        yield _open(d, f'translate(v = {_fmt([x_offset, y_offset, floor])})')
+        yield _leaf(d + 1, f'cube(size = {_fmt([x_size, y_size, depth*1.1])})')
+        yield _close(d)
+        return
+
+    if resolution is not None:
+        yield _open(d, f'translate(v = {_fmt([x_offset, y_offset, floor])})')
+        yield _leaf(d + 1, _polyhedron_call(x_size, y_size, depth, round, resolution))
+        yield _close(d)
+        return
+
+    sphereRad = sqrt(2)*x_size/2.0
+    sphereScaleZ = round/sphereRad
+    prism = f'cube(size = {_fmt([x_size, x_size, depth*1.1])})'
+
+    yield _open(d, f'translate(v = {_fmt([x_offset, y_offset, floor])})')
+    yield _open(d + 1, f'scale(v = {_fmt([1, y_size/x_size, 1])})')
+    yield _open(d + 2, 'intersection()')
+    yield _leaf(d + 3, prism)
+    yield _open(d + 3, 'union()')
+    yield _open(d + 4, f'translate(v = {_fmt([0, 0, round])})')
+    yield _leaf(d + 5, prism)
+    yield _close(d + 4)
+    yield _open(d + 4, f'translate(v = {_fmt([x_size/2.0, x_size/2.0, round])})')
+    yield _open(d + 5, f'scale(v = {_fmt([1, 1, sphereScaleZ])})')
+    yield _leaf(d + 6, f'sphere(r = {_fmt(sphereRad)})')
+    yield _close(d + 5)
+    yield _close(d + 4)
+    yield _close(d + 3)
+    yield _close(d + 2)
+    yield _close(d + 1)
+    yield _close(d)
+
+
+def iter_tray_scad(xlist, ylist, depth, wall, floor, round, units='mm', scale_xyz=(1.0, 1.0, 1.0),
+                   slot_resolution=None):
+    """ The text of createTray(), without the file header and footer """
+    if units != 'mm':
+        xlist = [x*MM_PER_IN for x in xlist]
+        ylist = [y*MM_PER_IN for y in ylist]
+        depth = depth*MM_PER_IN
+        wall = wall*MM_PER_IN
+        floor = floor*MM_PER_IN
+        round = round*MM_PER_IN
+
+    # The outer box comes before the slots in the file, so get the totals
+    # first.  Accumulate exactly like createTray() so the floats match.
+    totalWidth = wall
+    for xsz in xlist:
+        totalWidth += wall + xsz
+    totalHeight = wall
+    for ysz in ylist:
+        totalHeight += wall + ysz
+
+    yield _open(0, f'scale(v = {_fmt(list(scale_xyz))})')
+    yield _open(1, 'difference()')
+    yield _leaf(2, f'cube(size = {_fmt([totalWidth, totalHeight, floor+depth])})')
+    yield _open(2, 'union()')
+
+    yOff = wall
+    for ysz in ylist:
+        xOff = wall
+        for xsz in xlist:
+            yield from iter_slot_scad(xOff, yOff, xsz, ysz, depth, floor, round, indent=3,
+                                      resolution=slot_resolution)
+            xOff += wall + xsz
+        yOff += wall + ysz
+
+    yield _close(2)
+    yield _close(1)
+    yield _close(0)
+
+
+def solidpython_header(file_header='$fn=64;', date=None):
+    try:
+        version = metadata.version('solidpython')
+    except metadata.PackageNotFoundError:
+        version = '<Unknown>'
+
+    if date is None:
+        date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    header = f"// Generated by SolidPython {version} on {date}\n" + file_header
+    if not header.endswith('\n'):
+        header += '\n'
+
+    # SolidPython puts any include/use statements here, we have none
+    return header + '\n'
+
+
+def solidpython_footer(orig_code_file):
+    """ SolidPython appends the source of the module that wrote the file """
+    with open(orig_code_file, 'r') as f:
+        code = f.read()
+
+    return (f"\n"
+            f"/***********************************************\n"
+            f"*********      SolidPython code:      **********\n"
+            f"************************************************\n"
+            f" \n"
+            f"{code} \n"
+            f" \n"
+            f"************************************************/\n")
+
+
+def iter_tray_scad_file(xlist, ylist, depth, wall, floor, round, units='mm',
+                        scale_xyz=(1.0, 1.0, 1.0), slot_resolution=None, orig_code_file=None, date=None):
+    yield solidpython_header(date=date)
+    yield from iter_tray_scad(xlist, ylist, depth, wall, floor, round, units, scale_xyz, slot_resolution)
+    if orig_code_file is not None:
+        yield solidpython_footer(orig_code_file)
+
+
+def stream_tray_scad(fn_or_fileobj, xlist, ylist, depth, wall, floor, round, units='mm', **kwargs):
+    """
+    Writes the .scad file chunk by chunk.  Accepts a filename or any text
+    file-like object (including a pipe to "openscad -").
+    """
+    chunks = iter_tray_scad_file(xlist, ylist, depth, wall, floor, round, units, **kwargs)
+    if hasattr(fn_or_fileobj, 'write'):
+        fn_or_fileobj.writelines(chunks)
+    else:
+        with open(fn_or_fileobj, 'w') as f:
+            f.writelines(chunks)
+
+
+################################################################################
+def _measure(func):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage="python3 scad_stream.py --benchmark N [N ...]",
+                                     description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--benchmark",
+                        dest="benchmark",
+                        nargs='+',
+                        type=int,
+                        default=[10, 25, 50, 100],
+                        help="Grid sizes to benchmark (N means an NxN tray)")
+    parser.add_argument("--skip-tree",
+                        dest="skip_tree",
+                        action='store_true',
+                        help="Only time the streaming path (the tree path is slow at 100x100)")
+    args = parser.parse_args()
+
+    import tempfile
+    from solid import scad_render_to_file
+    import generate_tray
+    from generate_tray import createTray
+
+    scale_xyz = (generate_tray.xScale, generate_tray.yScale, generate_tray.zScale)
+
+    print(f'{"grid":>9} {"tree sec":>9} {"tree MB":>9} {"stream sec":>11} {"stream MB":>10}  identical')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n in args.benchmark:
+            sizes = [10.0] * n
+            tray_args = (sizes, sizes, 20.0, 1.2, 1.2, 5.0)
+            fn_tree = os.path.join(tmpdir, f'tree_{n}.scad')
+            fn_stream = os.path.join(tmpdir, f'stream_{n}.scad')
+
+            # SolidPython appends the source of whichever module called it, which is this one here
+            def tree_path():
+                _, _, trayObj = createTray(*tray_args)
+                scad_render_to_file(trayObj, fn_tree, file_header='$fn=64;')
+
+            def stream_path():
+                stream_tray_scad(fn_stream, *tray_args, scale_xyz=scale_xyz, orig_code_file=os.path.abspath(__file__))
+
+            s_time, s_peak = _measure(stream_path)
+            if args.skip_tree:
+                print(f'{n:>4}x{n:<4} {"-":>9} {"-":>9} {s_time:>11.3f} {s_peak/1e6:>10.1f}')
+                continue
+
+            t_time, t_peak = _measure(tree_path)
+
+            # Compare everything after the timestamp on the first line
+            with open(fn_tree) as f1, open(fn_stream) as f2:
+                identical = f1.read()[len(solidpython_header()):] == f2.read()[len(solidpython_header()):]
+
+            print(f'{n:>4}x{n:<4} {t_time:>9.3f} {t_peak/1e6:>9.1f} {s_time:>11.3f} {s_peak/1e6:>10.1f}  {identical}')
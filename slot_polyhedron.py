@@ -0,0 +1,143 @@
+#! /usr/bin/python
+"""
+Builds each rounded slot as a single OpenSCAD polyhedron().
+
+create_subtract_slot() makes the rounded floor with CSG:  a full sphere
+(tessellated at $fn=64), scaled, unioned with a prism and intersected with
+another prism.  OpenSCAD tessellates the whole sphere, throws most of it away,
+and runs two CGAL booleans per bin before the big difference() even starts.
+
+The slot is really just a height field:  over the x_size-by-y_size footprint,
+the floor follows the (scaled) bottom of that sphere, and everything above it
+up to the top of the prism is empty.  So we compute the floor surface on a
+grid directly, add the flat top and four side walls, and hand OpenSCAD one
+closed, convex polyhedron per slot.  No booleans at all until the final
+subtraction.  The "resolution" is the number of grid segments along each side
+of the slot floor.
+
+Run this file directly to compare the OpenSCAD render times of both builders
+(and the enclosed volumes, against compute_bin_volume()):
+
+    python3 slot_polyhedron.py --benchmark 2 4 8 --resolution 32
+"""
+import os
+import time
+import argparse
+import tempfile
+from functools import lru_cache
+from math import sqrt
+
+import numpy as np
+
+
+@lru_cache(maxsize=256)
+def slot_polyhedron(x_size, y_size, depth, round, resolution=32):
+    """
+    MM ONLY.  The points and faces of one rounded slot, with its corner at the
+    origin and its lowest point at z=0, exactly like the CSG version before
+    it's translated into place.  Returns (points, faces) as nested lists ready
+    for polyhedron(), with the faces ordered clockwise seen from outside, as
+    OpenSCAD wants them.  Cached, since most trays repeat the same few sizes.
+    """
+    x_size = float(x_size)
+    y_size = float(y_size)
+    n = int(resolution)
+    top = depth*1.1
+
+    # The CSG version builds the sphere at 1:1 aspect (radius reaching the
+    # corners of an x_size square), then stretches y.  Undo the stretch to
+    # find where each grid point sits on the sphere.
+    sphereRad = sqrt(2)*x_size/2.0
+    u, v = np.meshgrid(np.linspace(0.0, x_size, n + 1), np.linspace(0.0, y_size, n + 1))
+    du = u - x_size/2.0
+    dv = (v - y_size/2.0) * (x_size/y_size)
+    r2 = np.clip((du*du + dv*dv) / (sphereRad*sphereRad), 0.0, 1.0)
+    z = np.minimum(round * (1.0 - np.sqrt(1.0 - r2)), top)
+
+    floor_pts = np.stack([u, v, z], axis=-1).reshape(-1, 3)
+    top_pts = np.array([[0.0, 0.0, top], [x_size, 0.0, top], [x_size, y_size, top], [0.0, y_size, top]])
+    points = np.concatenate([floor_pts, top_pts])
+
+    def p(i, j):
+        return j*(n + 1) + i
+
+    t0, t1, t2, t3 = [len(floor_pts) + k for k in range(4)]
+    rng = range(n + 1)
+
+    # Built counter-clockwise seen from outside (outward normals), reversed at the end
+    faces = [[t0, t1, t2, t3]]
+    faces.append([p(i, 0) for i in rng] + [t1, t0])
+    faces.append([p(n, j) for j in rng] + [t2, t1])
+    faces.append([p(i, n) for i in reversed(rng)] + [t3, t2])
+    faces.append([p(0, j) for j in reversed(rng)] + [t0, t3])
+    for j in range(n):
+        for i in range(n):
+            faces.append([p(i, j), p(i, j + 1), p(i + 1, j + 1)])
+            faces.append([p(i, j), p(i + 1, j + 1), p(i + 1, j)])
+
+    return points.tolist(), [f[::-1] for f in faces]
+
+
+def slot_polyhedron_volume(points, faces):
+    """ Signed-tetrahedron sum over a fan of each face (clockwise faces, so negate) """
+    pts = np.asarray(points)
+    vol = 0.0
+    for f in faces:
+        a = pts[f[0]]
+        b, c = pts[f[1:-1]], pts[f[2:]]
+        vol -= np.einsum('j,ij->', a, np.cross(b, c))
+    return vol / 6.0
+
+
+################################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage="python3 slot_polyhedron.py --benchmark N [N ...] [--resolution R]",
+                                     description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--benchmark",
+                        dest="benchmark",
+                        nargs='+',
+                        type=int,
+                        default=[2, 4, 8],
+                        help="Grid sizes to render (N means an NxN tray of 30mm bins)")
+    parser.add_argument("--resolution",
+                        dest="resolution",
+                        default=32,
+                        type=int,
+                        help="Grid segments along each side of the slot floor")
+    parser.add_argument("--no-render",
+                        dest="no_render",
+                        action='store_true',
+                        help="Only compare the volumes, don't run OpenSCAD")
+    args = parser.parse_args()
+
+    from generate_tray import LOG_IT, compute_bin_volume, render_tray_stl
+    from mesh_utils import read_stl, mesh_volume
+
+    # The slot volume up to the nominal depth, vs the closed form in compute_bin_volume()
+    for xsz, ysz, depth, round in [(30.0, 30.0, 32.0, 12.0), (15.0, 60.0, 20.0, 5.0), (80.0, 10.0, 40.0, 15.0)]:
+        vol = slot_polyhedron_volume(*slot_polyhedron(xsz, ysz, depth, round, args.resolution))
+        vol -= 0.1*depth*xsz*ysz
+        ref = compute_bin_volume(xsz, ysz, depth, round)[0] * 1000
+        LOG_IT(f'slot {xsz:g}x{ysz:g}x{depth:g} round {round:g}:  polyhedron {vol:.1f} mm3, '
+               f'closed form {ref:.1f} mm3 ({100*(vol - ref)/ref:+.3f}%)')
+
+    if args.no_render:
+        raise SystemExit(0)
+
+    LOG_IT(f'{"grid":>9} {"CSG sec":>9} {"poly sec":>9} {"speedup":>8} {"volume diff":>12}')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n in args.benchmark:
+            tray_args = ([30.0] * n, [30.0] * n, 32.0, 1.8, 1.8, 12.0)
+
+            t0 = time.time()
+            fn_csg = render_tray_stl(os.path.join(tmpdir, f'csg_{n}'), *tray_args)
+            t_csg = time.time() - t0
+
+            t0 = time.time()
+            fn_poly = render_tray_stl(os.path.join(tmpdir, f'poly_{n}'), *tray_args, slot_resolution=args.resolution)
+            t_poly = time.time() - t0
+
+            v_csg, v_poly = mesh_volume(read_stl(fn_csg)), mesh_volume(read_stl(fn_poly))
+            LOG_IT(f'{n:>4}x{n:<4} {t_csg:>9.1f} {t_poly:>9.1f} {t_csg/t_poly:>7.2f}x '
+                   f'{100*(v_poly - v_csg)/v_csg:>+11.3f}%')
@@ -0,0 +1,45 @@
+import os
+import sys
+import importlib
+from unittest import mock
+
+import pytest
+
+FLASK_SERVE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'flask_serve')
+TRAY_HASH = 'a' * 64
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    pytest.importorskip('flask_wtf')
+    root = tmp_path_factory.mktemp('app')
+    env = {'GENTRAY_JOB_DB': str(root / 'jobs.sqlite3'), 'GENTRAY_STORE': str(root / 'store')}
+    # The store is looked up on every request, so the environment stays patched
+    with mock.patch.dict(os.environ, env), mock.patch.object(sys, 'path', [FLASK_SERVE_DIR] + sys.path):
+        app = importlib.import_module('app')
+        yield app.app.test_client()
+
+
+@pytest.mark.parametrize('url', [
+    f'/download_stl/{TRAY_HASH}?xform=8',
+    f'/download_stl/{TRAY_HASH}?xform=-1',
+    f'/download_stl/{TRAY_HASH}?xform=17',
+    f'/download_stl/{TRAY_HASH}?xform=abc',
+    f'/download_stl/{TRAY_HASH.upper()}?xform=1',
+    '/download_stl/..?xform=1',
+])
+def test_download_rejects_bad_layouts_and_hashes(client, url):
+    assert client.get(url).status_code == 400
+
+
+@pytest.mark.parametrize('route', [
+    '/download_status_wait/{}', '/preview_mesh/{}/0', '/preview_png/{}', '/volume_table/{}',
+    '/print_estimate/{}', '/mesh_stats/{}',
+])
+@pytest.mark.parametrize('tray_hash, xform', [(TRAY_HASH, '8'), (TRAY_HASH, '-1'), (TRAY_HASH, 'abc'), ('abc', '0')])
+def test_tray_routes_reject_bad_layouts_and_hashes(client, route, tray_hash, xform):
+    assert client.get(route.format(tray_hash), query_string={'xform': xform}).status_code == 400
+
+
+def test_download_of_unknown_tray_is_404(client):
+    assert client.get(f'/download_stl/{TRAY_HASH}?xform=3').status_code == 404
@@ -0,0 +1,52 @@
+import os
+import time
+import subprocess
+
+import yaml
+
+import job_index
+from job_index import JobIndex, is_stale_request
+from generate_tray import generate_script_args, generate_tray_key
+
+
+def test_only_old_queued_and_initiated_statuses_are_stale():
+    now = time.time()
+    old = now - job_index.STALE_REQUEST_SEC - 1
+    assert is_stale_request({'status': 'Queued', 'updated': old}, now)
+    assert is_stale_request({'status': 'Initiated', 'updated': old}, now)
+    assert is_stale_request({'status': 'Initiated'}, now)
+    assert not is_stale_request({'status': 'Queued', 'updated': now - 1}, now)
+    assert not is_stale_request({'status': 'Complete', 'updated': old}, now)
+    assert not is_stale_request({'status': 'DNE'}, now)
+
+
+def test_generate_script_syncs_index_for_existing_tray(tmp_path):
+    tray_hash, _, canon = generate_tray_key([30, 40], [50], 30, 1.8, 1.8, 10, 'mm')
+    store = tmp_path / 'store'
+    (store / tray_hash).mkdir(parents=True)
+    (store / tray_hash / 'status.txt').write_text(
+        yaml.dump({'status': 'Complete', 'message': 'Done', 'params': canon, 'updated': time.time()}))
+
+    job_db = str(tmp_path / 'jobs.sqlite3')
+    index = JobIndex(job_db)
+    index.set_tray_status(tray_hash, 'Queued', 'Waiting for a free render worker', canon)
+
+    subprocess.run(generate_script_args(canon, 'unused-bucket', tray_hash, job_db), cwd=str(tmp_path),
+                   env=dict(os.environ, GENTRAY_STORE=str(store)), check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    assert index.get_tray_statuses([tray_hash])[tray_hash]['status'] == 'Complete'
+
+
+def test_tray_params_are_kept_without_a_status(tmp_path):
+    index = JobIndex(str(tmp_path / 'jobs.sqlite3'))
+    tray_hash, _, canon = generate_tray_key([30, 40], [50], 30, 1.8, 1.8, 10, 'mm')
+    assert index.get_tray_params(tray_hash) is None
+
+    index.remember_tray_params(tray_hash, canon)
+    assert index.get_tray_params(tray_hash) == canon
+    assert index.get_tray_statuses([tray_hash])[tray_hash]['status'] == 'DNE'
+
+    index.set_tray_status(tray_hash, 'Complete', 'Done')
+    index.remember_tray_params(tray_hash, dict(canon, depth=1.0))
+    assert index.get_tray_params(tray_hash) == canon
+    assert index.get_tray_statuses([tray_hash])[tray_hash]['status'] == 'Complete'
@@ -0,0 +1,46 @@
+import numpy as np
+
+import pack_plates
+from generate_tray import compute_tray_footprint
+from mesh_utils import write_stl, mesh_bounds
+
+
+def _box_tris(w, h, d):
+    corners = np.array([[x, y, z] for x in (0, w) for y in (0, h) for z in (0, d)], dtype=np.float64)
+    faces = [(0, 1, 3), (0, 3, 2), (4, 6, 7), (4, 7, 5), (0, 4, 5), (0, 5, 1),
+             (2, 3, 7), (2, 7, 6), (0, 2, 6), (0, 6, 4), (1, 5, 7), (1, 7, 3)]
+    return corners[np.array(faces)]
+
+
+def _fake_render_tray_stl(fname, xlist, ylist, depth, wall, floor, round, units='mm', slot_resolution=None):
+    """ Stands in for OpenSCAD:  a solid box with the tray's footprint """
+    w, h = compute_tray_footprint(xlist, ylist, wall)
+    write_stl(fname, _box_tris(w, h, floor + depth))
+    return fname
+
+
+def test_transposed_trays_do_not_overlap(monkeypatch, tmp_path):
+    monkeypatch.setattr(pack_plates, 'render_tray_stl', _fake_render_tray_stl)
+
+    tray = pack_plates.normalize_tray_spec({'xlist': [30, 40, 25], 'ylist': [120]})
+    transposed = pack_plates.normalize_tray_spec({'xlist': [120], 'ylist': [30, 40, 25]})
+    specs = [tray, transposed, tray]
+    footprints = [compute_tray_footprint(s['xlist'], s['ylist'], s['wall']) for s in specs]
+    plates = pack_plates.pack_trays(footprints, 300, 300, spacing=5.0)
+
+    parts = pack_plates.place_tray_meshes(plates, specs, str(tmp_path))
+    boxes = []
+    for plate, plate_parts in zip(plates, parts):
+        for p, tris in zip(plate, plate_parts):
+            lo, hi = mesh_bounds(tris)
+            # Each mesh fills exactly the slot the packer made for it
+            np.testing.assert_allclose(lo[:2], [p['x'], p['y']], atol=0.01)
+            np.testing.assert_allclose(hi[:2], [p['x'] + p['width'], p['y'] + p['height']], atol=0.01)
+            boxes.append((lo, hi))
+
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                (lo_a, hi_a), (lo_b, hi_b) = boxes[i], boxes[j]
+                overlap = np.minimum(hi_a[:2], hi_b[:2]) - np.maximum(lo_a[:2], lo_b[:2])
+                assert (overlap <= 0).any(), f'placements {i} and {j} overlap'
+        boxes = []
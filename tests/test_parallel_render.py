@@ -0,0 +1,24 @@
+import os
+import sys
+import json
+import shutil
+import subprocess
+
+import pytest
+import yaml
+
+CHECK_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'check_equivalence.py')
+
+
+@pytest.mark.skipif(shutil.which('openscad') is None, reason='needs OpenSCAD')
+def test_stitched_strips_match_single_openscad_render(tmp_path):
+    """ One tray through OpenSCAD whole and in stitched strips, compared by check_equivalence.py """
+    corpus = tmp_path / 'corpus.yaml'
+    corpus.write_text(yaml.dump([{'xlist': [40, 25, 70], 'ylist': [30, 60], 'round': 10}]))
+    report = tmp_path / 'report.json'
+
+    proc = subprocess.run([sys.executable, CHECK_SCRIPT, '--engines', 'parallel', '--corpus', str(corpus),
+                           '--samples', '50000', '--report', str(report)], cwd=str(tmp_path))
+    results = json.loads(report.read_text())['results']
+    assert proc.returncode == 0, [r['failures'] for r in results]
+    assert [r['engine'] for r in results] == ['parallel']
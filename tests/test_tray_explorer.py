@@ -0,0 +1,51 @@
+import time
+import statistics
+
+import numpy as np
+import pytest
+
+pytest.importorskip('ipywidgets')
+
+from tray_explorer import TrayExplorer
+
+UPDATE_BUDGET_SEC = 0.050
+
+
+def _canvas_pixels(explorer):
+    return np.asarray(explorer.fig.canvas.buffer_rgba()).copy()
+
+
+def test_incremental_frame_matches_a_fresh_one():
+    explorer = TrayExplorer([60, 45, 80], [50, 70])
+    explorer.x_text.value = '60, 55, 80'
+    explorer.depth.value = 40
+    explorer.wall.value = 2.5
+    explorer.x_text.value = '60, 45, 80'
+    explorer.floor.value = 3
+
+    fresh = TrayExplorer([60, 45, 80], [50, 70], depth=40, wall=2.5, floor=3)
+    assert np.array_equal(_canvas_pixels(explorer), _canvas_pixels(fresh))
+
+    # Nothing changed, so the frame isn't encoded again
+    image = explorer.image.value
+    explorer.update()
+    assert explorer.image.value is image
+
+
+def test_updates_fit_the_budget_on_a_15x15_grid():
+    explorer = TrayExplorer([30] * 15, [30] * 15)
+    changes = {
+        'width': lambda i: setattr(explorer.x_text, 'value', ', '.join([str(31 + i)] + ['30'] * 14)),
+        'depth': lambda i: setattr(explorer.depth, 'value', 41 + i),
+        'wall': lambda i: setattr(explorer.wall, 'value', 2.0 + i / 10),
+        'floor': lambda i: setattr(explorer.floor, 'value', 2.0 + i / 10),
+        'round': lambda i: setattr(explorer.round, 'value', 11 + i),
+    }
+    for name, change in changes.items():
+        times = []
+        for i in range(5):
+            # Outside an event loop, changing a widget updates right away
+            t0 = time.perf_counter()
+            change(i)
+            times.append(time.perf_counter() - t0)
+        assert statistics.median(times) < UPDATE_BUDGET_SEC, (name, times)
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+import tray_server
+from generate_tray import parse_tray_spec
+
+
+def _fake_run_openscad(fn_scad, fn_stl):
+    with open(fn_stl, 'wb') as f:
+        f.write(b'fake'.ljust(80, b' ') + (0).to_bytes(4, 'little'))
+    return fn_stl
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    monkeypatch.setattr(tray_server, 'run_openscad', _fake_run_openscad)
+    renderer = tray_server.TrayRenderServer(str(tmp_path), workers=2)
+    yield renderer
+    renderer.shutdown()
+
+
+def _serve(renderer, *specs):
+    results = renderer.serve_lines([json.dumps(s) for s in specs], lambda result: None)
+    return {r['id']: r for r in results}
+
+
+@pytest.mark.parametrize('value', ['bad', 0, -4, 2.5, True])
+def test_parse_tray_spec_rejects_bad_slot_resolution(value):
+    with pytest.raises(ValueError):
+        parse_tray_spec({'xlist': [30], 'ylist': [40], 'slot_resolution': value})
+
+
+def test_slot_resolution_is_part_of_the_artifact_key(server):
+    tray = {'xlist': [30], 'ylist': [40]}
+    first = _serve(server, dict(tray, id='csg'), dict(tray, id='poly', slot_resolution=8))
+    assert first['csg']['stl'] != first['poly']['stl']
+    assert not first['csg']['cached'] and not first['poly']['cached']
+
+    again = _serve(server, dict(tray, id='poly', slot_resolution=12), dict(tray, id='csg'))
+    assert not again['poly']['cached']
+    assert again['csg']['cached']
+
+
+@pytest.fixture
+def batching_server(monkeypatch, tmp_path):
+    monkeypatch.setattr(tray_server, 'run_openscad', _fake_run_openscad)
+    renderer = tray_server.TrayRenderServer(str(tmp_path), workers=1, batch_window=0.05)
+    yield renderer
+    renderer.shutdown()
+
+
+def _serve_with_timeout(renderer, specs, timeout=5):
+    pending = [renderer.submit(json.dumps(s), lambda result: None) for s in specs]
+    return {f.result(timeout=timeout)['id']: f.result() for f in pending}
+
+
+def test_batch_scad_failure_fails_each_tray(monkeypatch, batching_server):
+    def broken_write_tray_scad(*args, **kwargs):
+        raise OSError('disk full')
+    monkeypatch.setattr(tray_server, 'write_tray_scad', broken_write_tray_scad)
+
+    specs = [{'id': str(i), 'xlist': [30 + i], 'ylist': [40]} for i in range(3)]
+    results = _serve_with_timeout(batching_server, specs)
+    assert {r['status'] for r in results.values()} == {'Failed'}
+    assert not batching_server.in_flight
+
+
+def test_batch_error_resolves_every_future(monkeypatch, batching_server):
+    def broken_render(*args, **kwargs):
+        raise RuntimeError('worker blew up')
+    monkeypatch.setattr(batching_server, '_render', broken_render)
+
+    specs = [{'id': str(i), 'xlist': [30 + i], 'ylist': [40]} for i in range(3)]
+    results = _serve_with_timeout(batching_server, specs)
+    assert [results[str(i)]['status'] for i in range(3)] == ['Failed'] * 3
+    assert 'worker blew up' in results['0']['error']
+    assert not batching_server.in_flight
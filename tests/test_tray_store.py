@@ -0,0 +1,21 @@
+import os
+
+import pytest
+
+from tray_store import LocalTrayStore
+
+
+@pytest.mark.parametrize('key', ['../outside.stl', 'abc/../../outside.stl', '..'])
+def test_local_store_refuses_keys_outside_its_root(tmp_path, key):
+    store = LocalTrayStore(str(tmp_path / 'store'))
+    with pytest.raises(ValueError):
+        store.local_path(key)
+
+
+def test_local_store_refuses_symlinks_out_of_it(tmp_path):
+    (tmp_path / 'store').mkdir()
+    os.symlink(str(tmp_path), str(tmp_path / 'store' / 'escape'))
+    store = LocalTrayStore(str(tmp_path / 'store'))
+    assert store.local_path('abc/organizer_tray.stl') == os.path.join(store.root, 'abc', 'organizer_tray.stl')
+    with pytest.raises(ValueError):
+        store.local_path('escape/organizer_tray.stl')
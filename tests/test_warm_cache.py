@@ -0,0 +1,50 @@
+import time
+
+import yaml
+
+from job_index import JobIndex
+from warm_cache import server_log_specs, job_history_specs, weigh_by_order, weigh_by_time, rank_trays
+from generate_tray import generate_tray_key
+
+PREVIEW = {'xlist': [30, 40], 'ylist': [50], 'depth': 30.0, 'wall': 1.8, 'floor': 1.8, 'round': 10.0,
+           'units': 'mm'}
+DOWNLOAD = dict(PREVIEW, xlist=[60, 40])
+
+
+def _form_record(params):
+    return 'INFO:root:' + yaml.dump(params, indent=2)
+
+
+def test_server_log_counts_previews_but_not_downloads():
+    log = ''.join([
+        'INFO:root:gen_tray_form called\n',
+        'INFO:root:gen_tray_form called\n', _form_record(PREVIEW),
+        # A download goes through the form page and then /process_stl_request, which logs it again
+        'INFO:root:gen_tray_form called\n', _form_record(DOWNLOAD), _form_record(DOWNLOAD),
+        'INFO:root:Tray cache miss: abc (xform=0)\n',
+        'INFO:root:gen_tray_form called\n', _form_record(PREVIEW),
+    ])
+    assert server_log_specs(log) == [PREVIEW, PREVIEW]
+
+
+def test_job_index_ranks_by_when_jobs_were_created(tmp_path):
+    index = JobIndex(str(tmp_path / 'jobs.sqlite3'))
+    old_hash, _, old_canon = generate_tray_key(**PREVIEW)
+    new_hash, _, new_canon = generate_tray_key(**DOWNLOAD)
+    for tray_hash, canon in ((old_hash, old_canon), (new_hash, new_canon)):
+        index.remember_tray_params(tray_hash, canon)
+        index.add_job(tray_hash)
+
+    now = time.time()
+    jobs = job_history_specs(str(tmp_path / 'jobs.sqlite3'))
+    assert [spec for _, spec in jobs] == [old_canon, new_canon]
+
+    # Two jobs for the first tray a week ago lose to one for the second just now
+    history = [(now - 7 * 86400, old_canon), (now - 7 * 86400, old_canon), (now, new_canon)]
+    trays = rank_trays([weigh_by_time(history, half_life_sec=86400, now=now)])
+    assert [t.tray_hash for t in trays] == [new_hash, old_hash]
+    assert [t.requests for t in trays] == [1, 2]
+
+    # With no timestamps, order is all there is
+    trays = rank_trays([weigh_by_order([old_canon, old_canon, new_canon], half_life=1000)])
+    assert [t.tray_hash for t in trays] == [old_hash, new_hash]
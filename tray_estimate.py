@@ -0,0 +1,194 @@
+#! /usr/bin/python
+"""
+Estimates the material, filament, weight and print time of a tray without
+rendering or slicing it.
+
+The geometry is all known up front.  The tray is a solid box of
+totalWidth x totalHeight x (floor+depth), same as createTray(), minus one
+cavity per bin.  compute_bin_volume() gives each cavity's volume, and for the
+rounded floor that's the scaled hemisphere-minus-caps, whose volume is always
+the same fraction of its x*y*round bounding box.  So every bin is just:
+
+    x * y * (depth - (1 - ROUND_FILL_FRACTION) * round)
+
+and summed over the grid, that's sum(x) * sum(y) * (...) for the whole tray.
+There are no per-bin loops, so thousands of trays take a few milliseconds
+as numpy arrays.
+
+The print is modeled the way a slicer would lay it out, roughly:
+
+  * perimeters:  `perimeters` loops of line_width around the outside of the
+    tray on every layer, and around every bin above the floor, printed at
+    perimeter_speed
+  * skins:  solid_layers of solid fill across the bottom and across the top
+    surfaces (the rim and the bin floors)
+  * infill:  whatever is left (the thick corners under the rounded floors),
+    at the infill fraction
+
+Skins and infill are printed at the profile's volumetric flow_rate, and each
+layer adds layer_sec for the layer change and travel.  Walls thinner than the
+perimeters are capped at the solid volume.  Times and weights are ballpark
+figures, good for quoting and comparing trays rather than for scheduling a
+printer.
+
+    python3 tray_estimate.py [40,25,70] [30,100,60] --depth 40
+    python3 tray_estimate.py --benchmark 10000
+"""
+import time
+import argparse
+from ast import literal_eval
+from collections import namedtuple
+
+import numpy as np
+
+from constants import *
+from generate_tray import compute_bin_volume
+
+
+PrintProfile = namedtuple('PrintProfile',
+                          'filament_diameter density layer_height line_width perimeters solid_layers infill '
+                          'flow_rate perimeter_speed layer_sec',
+                          defaults=(1.75,    # mm
+                                    1.24,    # g/cm3, PLA
+                                    0.2,     # mm
+                                    0.45,    # mm
+                                    2,       # loops
+                                    4,       # layers
+                                    0.2,     # fraction
+                                    8.0,     # mm3/s
+                                    40.0,    # mm/s
+                                    1.0))    # sec
+DEFAULT_PRINT_PROFILE = PrintProfile()
+
+# Cavity volume of a rounded floor, as a fraction of its x * y * round bounding box
+ROUND_FILL_FRACTION = compute_bin_volume(1.0, 1.0, 1.0, 1.0)[0] * MM3_PER_ML
+
+
+def parse_print_profile(values):
+    """ A PrintProfile from a dict of overrides (e.g. from the JSON API).  Raises ValueError """
+    if not isinstance(values, dict):
+        raise ValueError('profile must be an object')
+    unknown = set(values) - set(PrintProfile._fields)
+    if unknown:
+        raise ValueError(f'Unknown profile fields: {", ".join(sorted(unknown))}')
+
+    fields = {}
+    for k, v in values.items():
+        if not isinstance(v, (int, float)) or isinstance(v, bool) or v < 0:
+            raise ValueError(f'{k} must be a single, positive value')
+        fields[k] = type(getattr(DEFAULT_PRINT_PROFILE, k))(v)
+    profile = DEFAULT_PRINT_PROFILE._replace(**fields)
+
+    if profile.infill > 1:
+        raise ValueError('infill must be a fraction between 0 and 1')
+    if min(profile.filament_diameter, profile.density, profile.layer_height, profile.line_width,
+           profile.flow_rate, profile.perimeter_speed) <= 0:
+        raise ValueError('Profile sizes, speeds and density must be greater than zero')
+    return profile
+
+
+def estimate_print(sum_x, sum_y, nx, ny, depth, wall, floor, round, profile=DEFAULT_PRINT_PROFILE):
+    """
+    MM ONLY.  Every argument can be a scalar or an array (one entry per tray):
+    the sums and counts of the bin sizes along each axis, and the usual tray
+    parameters.  Returns a dict of arrays.
+    """
+    sum_x, sum_y, nx, ny, depth, wall, floor, round = \
+        [np.asarray(a, dtype=float) for a in (sum_x, sum_y, nx, ny, depth, wall, floor, round)]
+    p = profile
+
+    width = sum_x + (nx + 1) * wall
+    height = sum_y + (ny + 1) * wall
+    box_mm3 = width * height * (floor + depth)
+    cavity_mm3 = sum_x * sum_y * (depth - (1.0 - ROUND_FILL_FRACTION) * round)
+    solid_mm3 = box_mm3 - cavity_mm3
+
+    # Perimeters:  around the outside on every layer, around each bin above the floor
+    layers = np.ceil((floor + depth) / p.layer_height)
+    bin_layers = np.ceil(depth / p.layer_height)
+    outer_len = 2 * (width + height)
+    bins_len = 2 * (ny * sum_x + nx * sum_y)
+    perimeter_len = p.perimeters * (outer_len * layers + bins_len * bin_layers)
+    perimeter_mm3 = np.minimum(perimeter_len * p.line_width * p.layer_height, solid_mm3)
+
+    # Solid skins on the bottom and on every upward-facing surface, infill for the rest
+    skin_mm3 = np.minimum(2 * width * height * p.solid_layers * p.layer_height, solid_mm3 - perimeter_mm3)
+    infill_mm3 = p.infill * (solid_mm3 - perimeter_mm3 - skin_mm3)
+    printed_mm3 = perimeter_mm3 + skin_mm3 + infill_mm3
+
+    perimeter_flow = min(p.flow_rate, p.line_width * p.layer_height * p.perimeter_speed)
+    print_sec = perimeter_mm3 / perimeter_flow + (skin_mm3 + infill_mm3) / p.flow_rate + layers * p.layer_sec
+
+    filament_area = np.pi * (p.filament_diameter / 2) ** 2
+    return {
+        'width_mm': width,
+        'height_mm': height,
+        'solid_cm3': solid_mm3 / MM3_PER_ML,
+        'printed_cm3': printed_mm3 / MM3_PER_ML,
+        'filament_m': printed_mm3 / filament_area / 1000,
+        'weight_g': printed_mm3 / MM3_PER_ML * p.density,
+        'layers': layers,
+        'print_hours': print_sec / 3600,
+    }
+
+
+def estimate_trays(param_maps, profile=DEFAULT_PRINT_PROFILE):
+    """ One estimate dict per tray param map (xlist, ylist, depth, wall, floor, round, units), in one numpy pass """
+    rescale = np.array([1.0 if p.get('units', 'mm') == 'mm' else MM_PER_IN for p in param_maps])
+    cols = {k: np.array([p[k] for p in param_maps], dtype=float) * rescale for k in ('depth', 'wall', 'floor', 'round')}
+    est = estimate_print(np.array([sum(p['xlist']) for p in param_maps], dtype=float) * rescale,
+                         np.array([sum(p['ylist']) for p in param_maps], dtype=float) * rescale,
+                         [len(p['xlist']) for p in param_maps],
+                         [len(p['ylist']) for p in param_maps],
+                         profile=profile,
+                         **cols)
+    return [{k: float(v[i]) for k, v in est.items()} for i in range(len(param_maps))]
+
+
+def estimate_tray(xlist, ylist, depth, wall, floor, round, units='mm', profile=DEFAULT_PRINT_PROFILE):
+    param_map = {'xlist': xlist, 'ylist': ylist, 'depth': depth, 'wall': wall, 'floor': floor,
+                 'round': round, 'units': units}
+    return estimate_trays([param_map], profile)[0]
+
+
+def format_estimate(est, profile=DEFAULT_PRINT_PROFILE):
+    hours, minutes = divmod(int(np.round(est['print_hours'] * 60)), 60)
+    return (f'{est["printed_cm3"]:.1f} cm3 of plastic ({est["solid_cm3"]:.1f} cm3 solid), '
+            f'{est["filament_m"]:.1f} m of {profile.filament_diameter:g} mm filament, {est["weight_g"]:.0f} g, '
+            f'about {hours}h {minutes:02d}m at {profile.layer_height:g} mm layers')
+
+
+################################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage="python3 tray_estimate.py [x0,x1,...] [y0,y1,...] [options]",
+                                     description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("bin_sizes", nargs='*')
+    parser.add_argument("--depth", dest="depth", default=DEFAULT_DEPTH_MM, type=float)
+    parser.add_argument("--wall", dest="wall", default=DEFAULT_WALL_MM, type=float)
+    parser.add_argument("--floor", dest="floor", default=DEFAULT_FLOOR_MM, type=float)
+    parser.add_argument("--round", dest="round", default=DEFAULT_ROUND_MM, type=float)
+    for field, default in zip(PrintProfile._fields, DEFAULT_PRINT_PROFILE):
+        parser.add_argument(f"--{field.replace('_', '-')}", dest=field, default=default, type=type(default),
+                            help=f"Print profile (default {default})")
+    parser.add_argument("--benchmark",
+                        dest="benchmark",
+                        default=None,
+                        type=int,
+                        help="Time the estimate for this many random trays instead")
+    args = parser.parse_args()
+    profile = PrintProfile(*[getattr(args, f) for f in PrintProfile._fields])
+
+    if args.benchmark:
+        rng = np.random.default_rng(0)
+        trays = [{'xlist': rng.uniform(10, 80, rng.integers(1, 16)).tolist(),
+                  'ylist': rng.uniform(10, 80, rng.integers(1, 16)).tolist(),
+                  'depth': 32.0, 'wall': 1.8, 'floor': 1.8, 'round': 12.0}
+                 for _ in range(args.benchmark)]
+        t0 = time.time()
+        estimate_trays(trays, profile)
+        print(f'Estimated {args.benchmark} trays in {1000*(time.time() - t0):.1f} ms')
+    else:
+        xsizes, ysizes = literal_eval(''.join(args.bin_sizes).replace(' ', '').replace('][', '],['))
+        est = estimate_tray(xsizes, ysizes, args.depth, args.wall, args.floor, args.round, profile=profile)
+        print(format_estimate(est, profile))
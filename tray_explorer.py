@@ -0,0 +1,395 @@
+"""
+An interactive tray explorer for the notebook, built on the same layout and
+labels as draw_tray() and the volumes from compute_bin_volume().
+
+    from tray_explorer import TrayExplorer
+    TrayExplorer([30, 30, 45], [20, 60])
+
+Type the x/y sizes as comma-separated lists, or pick a column/row and drag its
+size slider, along with depth, wall, floor and round.  "Save PNG" writes the
+full-quality preview with draw_tray().
+
+Redrawing the preview with matplotlib takes a couple hundred milliseconds on a
+15x15 grid, nearly all of it laying out and rasterizing ~250 text labels.  So
+the explorer keeps one figure around and only redoes what a change touches:
+
+  * Input is debounced, so dragging a slider renders once it settles.
+  * The frame and bins are one PolyCollection whose vertices are replaced in
+    place, and the Agg canvas only redraws when the geometry changed.
+  * Changing one column's width recomputes that column's volumes and its one
+    x-label (likewise for rows).  Depth and round recompute every volume, wall
+    only moves things, floor only changes the summary text.
+  * Every label is one Text artist for the life of the grid, changed with
+    set_text()/set_position() only when its value or place changes.  They're
+    animated, so the full redraw leaves them out.  Each frame restores the
+    saved background and blits the labels that fit back on:  a label whose
+    text has been drawn before is pasted from its saved pixels, so only new
+    text is rasterized.  Labels sit on whole pixels, so a pasted label is
+    identical to a freshly drawn one.
+  * The frame goes to the browser as a JPEG, unless nothing on it changed.
+"""
+import io
+import time
+import asyncio
+
+import numpy as np
+import ipywidgets as widgets
+from PIL import Image as PILImage
+from matplotlib.collections import PolyCollection
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from constants import *
+from generate_tray import compute_bin_volume
+from gen_tray_png import (FIGURE_SIZE_IN, PREVIEW_DPI, FRAME_COLOR, BIN_COLOR, draw_tray, tray_display_layout,
+                          tray_label_visibility, axes_px_per_unit, size_label_text, volume_label_text,
+                          tray_summary_text)
+
+
+# (min, max, step) for each slider, in mm.  Inches get the same range, converted.
+SLIDER_RANGES_MM = {
+    'size': (5.0, 250.0, 0.5),
+    'depth': (5.0, 120.0, 0.5),
+    'wall': (0.4, 6.0, 0.1),
+    'floor': (0.4, 6.0, 0.1),
+    'round': (0.0, 40.0, 0.5),
+}
+
+DEBOUNCE_SEC = 0.15
+JPEG_QUALITY = 90
+MAX_SAVED_LABELS = 4096
+
+
+def _rect_verts(layout):
+    """ Corners of the frame then every bin (x-major), as one (N, 4, 2) array for PolyCollection.set_verts() """
+    x = np.concatenate([[layout.x0], np.repeat(layout.xoffs, len(layout.yoffs))])
+    y = np.concatenate([[layout.y0], np.tile(layout.yoffs, len(layout.xoffs))])
+    w = np.concatenate([[layout.x_total], np.repeat(layout.xlist_draw, len(layout.yoffs))])
+    h = np.concatenate([[layout.y_total], np.tile(layout.ylist_draw, len(layout.xoffs))])
+    return np.stack([np.stack([x, y], -1), np.stack([x + w, y], -1),
+                     np.stack([x + w, y + h], -1), np.stack([x, y + h], -1)], axis=1)
+
+
+def _parse_sizes(text):
+    sizes = [float(s) for s in text.replace(',', ' ').split()]
+    if not sizes:
+        raise ValueError('need at least one size')
+    if min(sizes) <= 0:
+        raise ValueError('sizes must be positive')
+    return sizes
+
+
+def _format_sizes(sizes):
+    return ', '.join(f'{s:g}' for s in sizes)
+
+
+class TrayExplorer:
+    def __init__(self,
+                 xlist,
+                 ylist,
+                 depth=None,
+                 wall=None,
+                 floor=None,
+                 round=None,
+                 units='mm',
+                 debounce_sec=DEBOUNCE_SEC):
+        self.units = units
+        self.debounce_sec = debounce_sec
+        if units == 'mm':
+            defaults = (DEFAULT_DEPTH_MM, DEFAULT_WALL_MM, DEFAULT_FLOOR_MM, DEFAULT_ROUND_MM)
+            ranges = SLIDER_RANGES_MM
+        else:
+            defaults = (DEFAULT_DEPTH_IN, DEFAULT_WALL_IN, DEFAULT_FLOOR_IN, DEFAULT_ROUND_IN)
+            ranges = {k: (lo / MM_PER_IN, hi / MM_PER_IN, 0.01) for k, (lo, hi, _) in SLIDER_RANGES_MM.items()}
+        values = [d if v is None else v for v, d in zip((depth, wall, floor, round), defaults)]
+
+        def slider(name, value, description):
+            lo, hi, step = ranges[name]
+            return widgets.FloatSlider(value=value, min=lo, max=max(hi, value), step=step,
+                                       description=description, continuous_update=True)
+
+        self.x_text = widgets.Text(value=_format_sizes(xlist), description=f'X sizes ({units})')
+        self.y_text = widgets.Text(value=_format_sizes(ylist), description=f'Y sizes ({units})')
+        self.x_index = widgets.IntSlider(value=0, min=0, max=len(xlist) - 1, description='Column')
+        self.y_index = widgets.IntSlider(value=0, min=0, max=len(ylist) - 1, description='Row')
+        self.x_size = slider('size', xlist[0], 'Width')
+        self.y_size = slider('size', ylist[0], 'Height')
+        self.depth = slider('depth', values[0], 'Depth')
+        self.wall = slider('wall', values[1], 'Wall')
+        self.floor = slider('floor', values[2], 'Floor')
+        self.round = slider('round', values[3], 'Round')
+        self.save_button = widgets.Button(description='Save PNG')
+        self.status = widgets.Label()
+        self.image = widgets.Image(format='jpeg')
+
+        self.widget = widgets.VBox([
+            widgets.HBox([self.x_text, self.x_index, self.x_size]),
+            widgets.HBox([self.y_text, self.y_index, self.y_size]),
+            widgets.HBox([self.depth, self.wall]),
+            widgets.HBox([self.floor, self.round]),
+            widgets.HBox([self.save_button, self.status]),
+            self.image,
+        ])
+
+        self._syncing = False
+        self._pending = None
+        for w in (self.x_text, self.y_text, self.depth, self.wall, self.floor, self.round):
+            w.observe(self._schedule, names='value')
+        self.x_text.observe(lambda change: self._sync_index(self.x_text, self.x_index, self.x_size), names='value')
+        self.y_text.observe(lambda change: self._sync_index(self.y_text, self.y_index, self.y_size), names='value')
+        self.x_index.observe(lambda change: self._sync_index(self.x_text, self.x_index, self.x_size), names='value')
+        self.y_index.observe(lambda change: self._sync_index(self.y_text, self.y_index, self.y_size), names='value')
+        self.x_size.observe(lambda change: self._set_size(self.x_text, self.x_index, self.x_size), names='value')
+        self.y_size.observe(lambda change: self._set_size(self.y_text, self.y_index, self.y_size), names='value')
+        self.save_button.on_click(self._save_png)
+
+        # One figure for the life of the explorer, only its collection's vertices change
+        self.fig = Figure(figsize=(FIGURE_SIZE_IN, FIGURE_SIZE_IN), dpi=PREVIEW_DPI)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot()
+        self.ax.set_aspect(1)
+        self.ax.axis('off')
+        self.collection = PolyCollection(np.zeros((0, 4, 2)), linewidths=0)
+        self.ax.add_collection(self.collection)
+        self.label_pools = {'x': [], 'y': [], 'vol': [], 'summary': []}
+
+        # {(kind, text): (pixels, offset)}, what each label looks like once drawn, and where that is
+        # relative to its anchor
+        self.saved_labels = {}
+        self.geometry_version = 0
+        self.frame_key = None
+
+        self.params = None
+        self.vol_mtrx_ml = None
+        self.update()
+
+    def _ipython_display_(self):
+        from IPython.display import display
+        display(self.widget)
+
+    ############################################################################
+    # Widget plumbing
+    ############################################################################
+    def _sync_index(self, text, index, size):
+        """ Point the index slider's range, and the size slider, at the current list """
+        if self._syncing:
+            return
+        try:
+            sizes = _parse_sizes(text.value)
+        except ValueError:
+            return
+        self._syncing = True
+        try:
+            index.max = len(sizes) - 1
+            size.max = max(size.max, sizes[index.value])
+            size.value = sizes[index.value]
+        finally:
+            self._syncing = False
+
+    def _set_size(self, text, index, size):
+        """ The size slider moved:  rewrite that one entry of the list (which schedules the update) """
+        if self._syncing:
+            return
+        try:
+            sizes = _parse_sizes(text.value)
+        except ValueError:
+            return
+        sizes[index.value] = size.value
+        self._syncing = True
+        try:
+            text.value = _format_sizes(sizes)
+        finally:
+            self._syncing = False
+
+    def _schedule(self, change=None):
+        """ Renders once the inputs have been still for debounce_sec.  Immediately, outside an event loop """
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.update()
+            return
+        self._pending = loop.call_later(self.debounce_sec, self.update)
+
+    def _save_png(self, button=None):
+        p = self.params
+        fn = draw_tray(p['xlist'], p['ylist'], p['wall'], self.vol_mtrx_ml, p['depth'], p['floor'], self.units)
+        self.status.value = f'Saved preview to {fn}'
+
+    ############################################################################
+    # Incremental update
+    ############################################################################
+    def _read_params(self):
+        return {
+            'xlist': _parse_sizes(self.x_text.value),
+            'ylist': _parse_sizes(self.y_text.value),
+            'depth': self.depth.value,
+            'wall': self.wall.value,
+            'floor': self.floor.value,
+            'round': self.round.value,
+        }
+
+    def _bin_volume_ml(self, x, y, p):
+        rescale = 1.0 if self.units == 'mm' else MM_PER_IN
+        return compute_bin_volume(x * rescale, y * rescale, p['depth'] * rescale, p['round'] * rescale)[0]
+
+    def update(self):
+        """ Re-renders whatever changed since the last update, returns the time it took in seconds """
+        self._pending = None
+        t0 = time.perf_counter()
+        try:
+            p = self._read_params()
+        except ValueError as e:
+            self.status.value = f'Invalid sizes: {e}'
+            return None
+
+        old = self.params
+        nx, ny = len(p['xlist']), len(p['ylist'])
+        if old is None or (len(old['xlist']), len(old['ylist'])) != (nx, ny):
+            self.vol_mtrx_ml = np.zeros((nx, ny))
+            self._make_labels(nx, ny)
+            changed_x, changed_y = list(range(nx)), list(range(ny))
+            all_vols = geometry = True
+        else:
+            changed_x = [i for i in range(nx) if p['xlist'][i] != old['xlist'][i]]
+            changed_y = [i for i in range(ny) if p['ylist'][i] != old['ylist'][i]]
+            all_vols = (p['depth'], p['round']) != (old['depth'], old['round'])
+            geometry = bool(changed_x or changed_y) or p['wall'] != old['wall']
+        self.params = p
+
+        # Volumes and their labels, only for the bins that changed
+        if all_vols:
+            cells = [(ix, iy) for ix in range(nx) for iy in range(ny)]
+        else:
+            cells = {(ix, iy) for ix in changed_x for iy in range(ny)}
+            cells |= {(ix, iy) for ix in range(nx) for iy in changed_y}
+        for ix, iy in cells:
+            self.vol_mtrx_ml[ix, iy] = self._bin_volume_ml(p['xlist'][ix], p['ylist'][iy], p)
+            self.vol_texts[ix, iy].set_text(volume_label_text(self.vol_mtrx_ml[ix, iy]))
+        for ix in changed_x:
+            self.xlabel_texts[ix].set_text(size_label_text(p['xlist'][ix], self.units))
+        for iy in changed_y:
+            self.ylabel_texts[iy].set_text(size_label_text(p['ylist'][iy], self.units))
+
+        if geometry:
+            self._redraw_geometry(p)
+
+        frame = self._compose_frame(p)
+        if frame is not None:
+            self.image.value = frame
+        elapsed = time.perf_counter() - t0
+        self.status.value = f'Recomputed {len(cells)} of {nx*ny} bins in {1000*elapsed:.0f} ms'
+        return elapsed
+
+    def _make_labels(self, nx, ny):
+        """ Label artists for an nx by ny grid, placed and filled in later.  Made once and reused """
+        self.xlabel_texts = self._take_labels('x', nx, ha='center', va='top')
+        self.ylabel_texts = self._take_labels('y', ny, ha='right', va='center')
+        self.vol_texts = np.empty((nx, ny), dtype=object)
+        self.vol_texts.flat[:] = self._take_labels('vol', nx * ny, ha='center', va='center', color='w')
+
+    def _take_labels(self, kind, n, **kwargs):
+        pool = self.label_pools[kind]
+        pool.extend(self.ax.text(0, 0, '', size=12, animated=True, **kwargs) for _ in range(n - len(pool)))
+        return pool[:n]
+
+    def _place_labels(self, texts, xy_px):
+        """ Puts the texts at whole-pixel display positions, returns them as (column, row) counting down from the top """
+        xy_px = np.round(np.asarray(xy_px, dtype=float).reshape(-1, 2))
+        for t, pos in zip(texts, self.ax.transData.inverted().transform(xy_px)):
+            t.set_position(pos)
+        height_px = self.fig.canvas.get_width_height()[1]
+        return [(int(col), int(height_px - row)) for col, row in xy_px]
+
+    def _redraw_geometry(self, p):
+        """ Moves the frame, bins and labels, redraws the canvas without the labels, and saves it """
+        layout = tray_display_layout(p['xlist'], p['ylist'], p['wall'])
+        nbins = len(layout.xoffs) * len(layout.yoffs)
+        self.collection.set_verts(_rect_verts(layout))
+        self.collection.set_facecolors([FRAME_COLOR] + [BIN_COLOR] * nbins)
+        self.ax.set_xlim(0, layout.xlim)
+        self.ax.set_ylim(0, layout.ylim)
+        self.fig.canvas.draw()
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.geometry_version += 1
+
+        # Anchors go on whole pixels, and are only known after the draw (which sets the aspect)
+        def place(texts, x, y):
+            return self._place_labels(texts, self.ax.transData.transform(np.column_stack(np.broadcast_arrays(x, y))))
+
+        xcenters = layout.xoffs + np.array(layout.xlist_draw)/2
+        ycenters = layout.yoffs + np.array(layout.ylist_draw)/2
+        xlabel_px = place(self.xlabel_texts, xcenters, layout.y0 - 1)
+        ylabel_px = place(self.ylabel_texts, layout.x0 - 1, ycenters)
+        vol_px = place(self.vol_texts.flat, np.repeat(xcenters, len(ycenters)), np.tile(ycenters, len(xcenters)))
+        self.summary_px = self.ax.transData.transform((2, 1))
+
+        show_xlabel, show_ylabel, self.fits_vol = tray_label_visibility(layout, axes_px_per_unit(self.ax, layout))
+        self.visible_labels = \
+            [(self.xlabel_texts[ix], 'x', xlabel_px[ix]) for ix in np.flatnonzero(show_xlabel)] + \
+            [(self.ylabel_texts[iy], 'y', ylabel_px[iy]) for iy in np.flatnonzero(show_ylabel)] + \
+            [(self.vol_texts.flat[i], 'vol', vol_px[i]) for i in np.flatnonzero(self.fits_vol)]
+
+    def _summary_labels(self, p):
+        """
+        The summary is one Text per line, bottom-left at (2, 1) and spaced like a multi-line Text, so
+        a change that touches one line (e.g. floor, only the height) only draws that line again
+        """
+        lines = tray_summary_text(p['xlist'], p['ylist'], p['wall'], p['depth'], p['floor'], self.units,
+                                  skipped_vols=not self.fits_vol.all()).split('\n')
+        texts = self._take_labels('summary', len(lines), ha='left', va='baseline')
+        if not hasattr(self, 'summary_line_px'):
+            # Measured off a Text like the others, so it's exactly what a multi-line one would do
+            renderer = self.fig.canvas.get_renderer()
+            t = texts[0]
+            t.set_position((0, 0))
+            t.set_text('lp')
+            one_line = t.get_window_extent(renderer)
+            t.set_text('lp\nlp')
+            self.summary_line_px = t.get_window_extent(renderer).height - one_line.height
+            self.summary_descent_px = self.ax.transData.transform((0, 0))[1] - one_line.y0
+
+        col, row = self.summary_px
+        rows = [row + self.summary_descent_px + self.summary_line_px * (len(lines) - 1 - i) for i in range(len(lines))]
+        anchors = self._place_labels(texts, [(col, r) for r in rows])
+        for t, line in zip(texts, lines):
+            t.set_text(line)
+        return [(t, 'summary', anchor) for t, anchor in zip(texts, anchors)]
+
+    def _compose_frame(self, p):
+        """
+        Puts the visible labels on the saved background and returns the JPEG, or None if it would be
+        the same as the last one.  Labels with new text are drawn (and their pixels saved) first,
+        the rest are pasted.
+        """
+        labels = self.visible_labels + self._summary_labels(p)
+        frame_key = (self.geometry_version, [(kind, t.get_text()) for t, kind, _ in labels])
+        if frame_key == self.frame_key:
+            return None
+        self.frame_key = frame_key
+
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        if len(self.saved_labels) >= MAX_SAVED_LABELS:
+            self.saved_labels.clear()
+
+        saved = []
+        for t, kind, (col, row) in labels:
+            key = (kind, t.get_text())
+            if key not in self.saved_labels:
+                self.ax.draw_artist(t)
+                # Glyph edges can spill a pixel past the (fractional) text extent, so take a pixel more
+                pixels = canvas.copy_from_bbox(t.get_window_extent(canvas.get_renderer()).padded(1))
+                left, top = pixels.get_extents()[:2]
+                self.saved_labels[key] = (pixels, (left - col, top - row))
+            else:
+                saved.append((self.saved_labels[key], col, row))
+        for (pixels, (dcol, drow)), col, row in saved:
+            canvas.restore_region(pixels, xy=(col + dcol, row + drow))
+
+        buf = io.BytesIO()
+        PILImage.fromarray(np.asarray(canvas.buffer_rgba())).convert('RGB').save(buf, format='jpeg',
+                                                                                 quality=JPEG_QUALITY)
+        return buf.getvalue()
@@ -0,0 +1,457 @@
+#! /usr/bin/python
+"""
+Long-running render server.  Keeps one warm interpreter (SolidPython imported,
+slot caches filled) and renders trays sent to it as JSON lines, instead of
+paying for a container, a Python start and the imports on every tray.
+
+    python3 tray_server.py --workers 4 < specs.jsonl > results.jsonl
+    python3 tray_server.py --listen unix:/tmp/gentray.sock --workers 4
+    python3 tray_server.py --listen tcp:0.0.0.0:5001
+
+The Docker image runs it through the normal entrypoint with --serve:
+
+    docker run -i -v `pwd`:/mnt etotheipi/3dprint-tray-gen:latest --serve --workers 4 < specs.jsonl
+
+Each input line is one tray, in the same form as the web app's bulk API
+(units default to mm, depth/wall/floor/round to the usual defaults), plus an
+optional "id" that is echoed back:
+
+    {"id": "a1", "xlist": [40, 25, 70], "ylist": [30, 100, 60], "depth": 40}
+
+Each result is one line, written as soon as that tray is done, so they are
+not necessarily in input order:
+
+    {"id": "a1", "status": "Complete", "tray_hash": "...", "xform": 0, "slot_resolution": null,
+     "stl": "/mnt/trays/<hash>_0_rcsg/organizer_tray.stl", "scad": "...",
+     "stl_sha256": "...", "stl_bytes": 123456, "cached": false,
+     "timings": {"queued_sec": 0.0, "scad_sec": 0.01, "openscad_sec": 41.2, ...}}
+
+With --batch-window, small trays (up to 3x3 bins) are held for that many
+seconds and whatever has arrived by then is rendered with one OpenSCAD run
+(see batch_render.py), which is most of the cost of a small tray.  Their
+results have "batch_size" set to the number of trays in that run.
+
+Trays that can't be parsed or rendered come back with "status": "Failed" and
+an "error".  Artifacts are kept by tray hash, xform and slot_resolution (an
+optional positive integer, see --slot-resolution), so a tray that is
+already in --out-dir comes straight back with "cached": true (add
+"force": true to the spec to render it again), and identical trays in flight
+at the same time share one render.
+
+With stdin/stdout, the server exits once stdin is closed and every result
+has been written.  Anything else that would go to stdout (log messages,
+OpenSCAD's own output) is sent to stderr, so stdout is only results.  On a
+socket, each connection gets the results for the trays it sent, and the
+connection stays open until they've all been written.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import signal
+import socketserver
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from constants import *
+from generate_tray import LOG_IT, generate_tray_key, parse_tray_spec, write_tray_scad, run_openscad
+from batch_render import is_small_tray, render_batch
+
+
+def file_sha256(fn, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def clamp_round(depth, round, units):
+    """ Same as the generate script with --yes.  Returns the round to use and a warning, if it changed """
+    max_round_size = depth - (3 / (MM_PER_IN if units == 'in' else 1.0))
+    if round > max_round_size:
+        round = max(max_round_size, 0)
+        return round, f'round shortened to {round:g} {units}, it must be at least 3mm less than depth'
+    return round, None
+
+
+class TrayRenderServer:
+    """ Renders tray specs on a pool of worker threads, each one driving an OpenSCAD process """
+    def __init__(self, out_dir, workers=1, slot_resolution=None, strips=1, batch_window=0.0, max_batch=16):
+        self.out_dir = os.path.abspath(out_dir)
+        self.slot_resolution = slot_resolution
+        self.strips = strips
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.batch_queue = []
+        self.batch_timer = None
+
+    def submit(self, line, emit):
+        """
+        Queues one JSON line.  emit(result) is called exactly once, from a
+        worker thread (or right away if the line is no good).  Returns a Future
+        that's done after emit() has returned.
+        """
+        t_recv = time.time()
+        done = Future()
+        job_id = None
+
+        def _finish(result):
+            result = dict(result, id=job_id)
+            try:
+                emit(result)
+            except OSError as e:
+                # The client went away, nothing left to tell it
+                LOG_IT(f'Could not send result for {job_id}: {e}')
+            finally:
+                done.set_result(result)
+
+        try:
+            spec = json.loads(line)
+            if isinstance(spec, dict):
+                job_id = spec.get('id')
+            params = parse_tray_spec(spec)
+        except ValueError as e:
+            _finish({'status': 'Failed', 'error': f'Invalid tray spec: {e}'})
+            return done
+
+        force = bool(spec.get('force', False))
+        slot_resolution = spec['slot_resolution'] if 'slot_resolution' in spec else self.slot_resolution
+        tray_hash, xform, _ = generate_tray_key(**params)
+        # CSG and polyhedron slots (at each resolution) are different meshes of the same tray
+        key = f'{tray_hash}_{xform}_r{slot_resolution or "csg"}'
+
+        is_new = False
+        with self.lock:
+            fut = None if force else self.in_flight.get(key)
+            if fut is None:
+                render_args = (params, key, tray_hash, xform, slot_resolution, force, t_recv)
+                if self.batch_window > 0 and self.strips == 1 and is_small_tray(params['xlist'], params['ylist']):
+                    fut = self._queue_for_batch(render_args)
+                else:
+                    fut = self.pool.submit(self._render, *render_args)
+                self.in_flight[key] = fut
+                is_new = True
+        # Not under the lock:  if the render is already done, the callback runs right here
+        if is_new:
+            fut.add_done_callback(lambda f: self._forget(key, f))
+        fut.add_done_callback(lambda f: _finish(f.result()))
+        return done
+
+    def _queue_for_batch(self, render_args):
+        """ Call with the lock held.  The batch goes to the pool when the window closes or it's full """
+        fut = Future()
+        self.batch_queue.append((render_args, fut))
+        if len(self.batch_queue) >= self.max_batch:
+            self._submit_batch()
+        elif self.batch_timer is None:
+            self.batch_timer = threading.Timer(self.batch_window, self._close_batch_window)
+            self.batch_timer.daemon = True
+            self.batch_timer.start()
+        return fut
+
+    def _close_batch_window(self):
+        with self.lock:
+            self._submit_batch()
+
+    def _submit_batch(self):
+        """ Call with the lock held """
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        if self.batch_queue:
+            self.pool.submit(self._render_batch, self.batch_queue)
+            self.batch_queue = []
+
+    def _forget(self, key, fut):
+        with self.lock:
+            if self.in_flight.get(key) is fut:
+                del self.in_flight[key]
+
+    def _artifact_paths(self, key):
+        out_dir = os.path.join(self.out_dir, key)
+        return os.path.join(out_dir, 'organizer_tray.scad'), os.path.join(out_dir, 'organizer_tray.stl')
+
+    def _render(self, params, key, tray_hash, xform, slot_resolution, force, t_recv, batched=None):
+        """ batched is set for trays the batch already rendered:  {'timings': {...}, 'result': {...}} """
+        t_start = time.time()
+        fn_scad, fn_stl = self._artifact_paths(key)
+        result = {
+            'status': 'Complete',
+            'tray_hash': tray_hash,
+            'xform': xform,
+            'slot_resolution': slot_resolution,
+            'params': params,
+            'scad': fn_scad,
+            'stl': fn_stl,
+            'cached': False,
+        }
+        timings = {'queued_sec': t_start - t_recv}
+
+        try:
+            if batched is not None:
+                timings.update(batched['timings'])
+                result.update(batched['result'])
+            elif not force and os.path.exists(fn_stl):
+                result['cached'] = True
+            else:
+                self._render_files(params, fn_scad, fn_stl, slot_resolution, timings, result)
+
+            t0 = time.time()
+            result['stl_sha256'] = file_sha256(fn_stl)
+            result['stl_bytes'] = os.path.getsize(fn_stl)
+            timings['hash_sec'] = time.time() - t0
+        except Exception as e:
+            LOG_IT(f'Failed to produce model {key}:', str(e))
+            result['status'] = 'Failed'
+            result['error'] = str(e)
+
+        timings['total_sec'] = time.time() - t_recv
+        result['timings'] = {k: round(v, 4) for k, v in timings.items()}
+        return result
+
+    def _render_files(self, params, fn_scad, fn_stl, slot_resolution, timings, result):
+        """ Renders next to the final names and moves them into place, so a half-written STL is never "cached" """
+        xlist, ylist = params['xlist'], params['ylist']
+        depth, wall, floor, round, units = [params[k] for k in ('depth', 'wall', 'floor', 'round', 'units')]
+
+        round, warning = clamp_round(depth, round, units)
+        if warning:
+            result['warning'] = warning
+
+        os.makedirs(os.path.dirname(fn_stl), exist_ok=True)
+        partial = f'.partial-{threading.get_ident()}'
+        tmp_scad = fn_scad[:-len('.scad')] + partial + '.scad'
+        tmp_stl = fn_stl[:-len('.stl')] + partial + '.stl'
+
+        t0 = time.time()
+        write_tray_scad(tmp_scad, xlist, ylist, depth, wall, floor, round, units, slot_resolution)
+        timings['scad_sec'] = time.time() - t0
+
+        t0 = time.time()
+        if self.strips > 1:
+            from parallel_render import render_tray_parallel
+            render_tray_parallel(tmp_stl, xlist, ylist, depth, wall, floor, round, units, strips=self.strips,
+                                 slot_resolution=slot_resolution)
+        else:
+            run_openscad(tmp_scad, tmp_stl)
+        timings['openscad_sec'] = time.time() - t0
+
+        os.replace(tmp_scad, fn_scad)
+        os.replace(tmp_stl, fn_stl)
+
+    def _render_batch(self, batch):
+        """
+        Renders the batch's trays with one OpenSCAD run (per slot resolution), then finishes each one
+        like any other render.  Anything the batch couldn't produce is rendered on its own.  Every
+        future is resolved no matter what, or its client (and anyone else asking for that tray)
+        would wait forever.
+        """
+        t_start = time.time()
+        error = 'Batch render stopped'
+        try:
+            todo = {}
+            for (params, key, tray_hash, xform, slot_resolution, force, t_recv), _ in batch:
+                queued = todo.setdefault(slot_resolution, [])
+                if (force or not os.path.exists(self._artifact_paths(key)[1])) and key not in [j[1] for j in queued]:
+                    queued.append((params, key, t_recv))
+
+            batched = {}
+            for slot_resolution, jobs in todo.items():
+                if len(jobs) > 1:
+                    batched.update(self._render_batch_files(jobs, slot_resolution, t_start))
+
+            for render_args, fut in batch:
+                fut.set_result(self._render(*render_args, batched=batched.get(render_args[1])))
+        except Exception as e:
+            LOG_IT(f'Batch of {len(batch)} trays failed:', str(e))
+            error = str(e)
+        finally:
+            for (params, key, tray_hash, xform, slot_resolution, force, t_recv), fut in batch:
+                if not fut.done():
+                    fut.set_result({'status': 'Failed', 'tray_hash': tray_hash, 'xform': xform,
+                                    'slot_resolution': slot_resolution, 'params': params, 'error': error})
+
+    def _render_batch_files(self, jobs, slot_resolution, t_start):
+        """
+        Returns {key: batched} for the trays that came out of the batch and passed the check.  If
+        anything goes wrong it returns {}, and they're all rendered one at a time instead.
+        """
+        partial = f'.partial-{threading.get_ident()}'
+        try:
+            specs, warnings, tmp_stls = [], [], []
+            t0 = time.time()
+            for params, key, _ in jobs:
+                round, warning = clamp_round(params['depth'], params['round'], params['units'])
+                specs.append(dict(params, round=round))
+                warnings.append(warning)
+
+                fn_scad, fn_stl = self._artifact_paths(key)
+                os.makedirs(os.path.dirname(fn_stl), exist_ok=True)
+                tmp_scad = fn_scad[:-len('.scad')] + partial + '.scad'
+                write_tray_scad(tmp_scad, *[specs[-1][k] for k in ('xlist', 'ylist', 'depth', 'wall', 'floor',
+                                                                  'round', 'units')], slot_resolution)
+                os.replace(tmp_scad, fn_scad)
+                tmp_stls.append(fn_stl[:-len('.stl')] + partial + '.stl')
+            scad_sec = time.time() - t0
+
+            t0 = time.time()
+            with tempfile.TemporaryDirectory(dir=self.out_dir, prefix='.batch-') as work_dir:
+                problems = render_batch(tmp_stls, specs, work_dir, slot_resolution=slot_resolution)
+            openscad_sec = time.time() - t0
+        except Exception as e:
+            LOG_IT(f'Batch of {len(jobs)} trays failed, rendering them one at a time:', str(e))
+            return {}
+
+        out = {}
+        for (params, key, t_recv), warning, tmp_stl, problem in zip(jobs, warnings, tmp_stls, problems):
+            if problem:
+                LOG_IT(f'Tray {key} did not come out of the batch right ({problem}), rendering it on its own')
+                continue
+            os.replace(tmp_stl, self._artifact_paths(key)[1])
+            result = {'batch_size': len(jobs)}
+            if warning:
+                result['warning'] = warning
+            out[key] = {'result': result,
+                        'timings': {'queued_sec': t_start - t_recv, 'scad_sec': scad_sec, 'openscad_sec': openscad_sec}}
+        return out
+
+    def serve_lines(self, lines, emit):
+        """ Submits every non-blank line, returns once all of their results have been emitted """
+        pending = [self.submit(line, emit) for line in lines if line.strip()]
+        wait(pending)
+        return [f.result() for f in pending]
+
+    def shutdown(self):
+        with self.lock:
+            self._submit_batch()
+        self.pool.shutdown(wait=True)
+
+
+def json_line_writer(f):
+    """ An emit() that writes one result per line to the binary file f, safe to call from several threads """
+    write_lock = threading.Lock()
+
+    def emit(result):
+        line = (json.dumps(result) + '\n').encode('utf-8')
+        with write_lock:
+            f.write(line)
+            f.flush()
+    return emit
+
+
+class _ConnectionHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        lines = (raw.decode('utf-8', errors='replace') for raw in self.rfile)
+        self.server.renderer.serve_lines(lines, json_line_writer(self.wfile))
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve_socket(renderer, listen):
+    """ listen is unix:<path> or tcp:<host>:<port> """
+    kind, _, addr = listen.partition(':')
+    if kind == 'unix':
+        if os.path.exists(addr):
+            os.remove(addr)
+        server = _ThreadingUnixServer(addr, _ConnectionHandler)
+    elif kind == 'tcp':
+        host, _, port = addr.rpartition(':')
+        server = _ThreadingTCPServer((host or '127.0.0.1', int(port)), _ConnectionHandler)
+    else:
+        raise ValueError(f'--listen must be unix:<path> or tcp:<host>:<port>, not "{listen}"')
+
+    server.renderer = renderer
+
+    # docker stop sends SIGTERM, and as PID 1 we'd otherwise ignore it
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    LOG_IT(f'Listening for tray specs on {listen}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if kind == 'unix' and os.path.exists(addr):
+            os.remove(addr)
+
+
+def serve_stdio(renderer):
+    # Keep the real stdout for results only.  Everything else that writes to
+    # fd 1, our own prints or the OpenSCAD child processes, goes to stderr.
+    results = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    renderer.serve_lines(sys.stdin, json_line_writer(results))
+    results.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(usage="python3 tray_server.py [--listen unix:PATH | tcp:HOST:PORT] [options]",
+                                     description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--listen",
+                        dest="listen",
+                        default=None,
+                        type=str,
+                        help="Serve on a socket, unix:<path> or tcp:<host>:<port> (default: stdin/stdout)")
+    parser.add_argument("--workers",
+                        dest="workers",
+                        default=int(os.environ.get('GENTRAY_RENDER_WORKERS', os.cpu_count() or 1)),
+                        type=int,
+                        help="Trays to render at once (default GENTRAY_RENDER_WORKERS, or the CPU count)")
+    parser.add_argument("--out-dir",
+                        dest="out_dir",
+                        default='trays',
+                        type=str,
+                        help="Where the rendered trays go, one directory per tray (default ./trays)")
+    parser.add_argument("--strips",
+                        dest='strips',
+                        default=1,
+                        type=int,
+                        help="Split each tray into this many strips and render them in parallel (default 1)")
+    parser.add_argument("--slot-resolution",
+                        dest='slot_resolution',
+                        default=None,
+                        type=int,
+                        help="Build each slot as one polyhedron with this many floor segments per side")
+    parser.add_argument("--batch-window",
+                        dest='batch_window',
+                        default=0.0,
+                        type=float,
+                        help="Hold small trays this many seconds and render what arrives with one OpenSCAD run "
+                             "(default 0, off)")
+    parser.add_argument("--max-batch",
+                        dest='max_batch',
+                        default=16,
+                        type=int,
+                        help="Most trays in one batch (default 16)")
+    args = parser.parse_args(argv)
+
+    renderer = TrayRenderServer(args.out_dir, args.workers, args.slot_resolution, args.strips,
+                                args.batch_window, args.max_batch)
+    try:
+        if args.listen is None:
+            serve_stdio(renderer)
+        else:
+            serve_socket(renderer, args.listen)
+    finally:
+        renderer.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
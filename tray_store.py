@@ -0,0 +1,156 @@
+"""
+Where generated trays (the STL plus a status.txt) are kept, by tray hash.
+
+In production that's a public S3 bucket:  the generate script uploads with
+boto3, and anyone can GET the objects over plain HTTPS.  Setting the
+GENTRAY_STORE environment variable to a directory swaps in a local store with
+the same keys, so the web app and the generate script can run (and be load
+tested) without AWS.  Both processes read the variable, and the generate
+script inherits it from the web app.
+
+The local store also keeps gzip and brotli copies of each STL next to it
+(organizer_tray.stl.gz, .br), since the web app serves those files itself.
+"""
+import os
+import gzip
+import shutil
+import tempfile
+
+import requests
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Precompressed copies of an object live next to it, with these suffixes.  The
+# web app picks one by Accept-Encoding and never compresses anything itself.
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+def compress_file(fn_in, fn_out, encoding):
+    """ Writes the br/gzip encoded copy of fn_in.  Returns False if that encoding isn't available here """
+    if encoding == 'gzip':
+        with open(fn_in, 'rb') as src, gzip.open(fn_out, 'wb', compresslevel=9) as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    elif encoding == 'br' and brotli is not None:
+        compressor = brotli.Compressor(quality=9)
+        with open(fn_in, 'rb') as src, open(fn_out, 'wb') as dst:
+            for chunk in iter(lambda: src.read(1 << 20), b''):
+                dst.write(compressor.process(chunk))
+            dst.write(compressor.finish())
+    else:
+        return False
+    return True
+
+
+class S3TrayStore:
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def public_url(self, key):
+        return f'https://{self.bucket}.s3.amazonaws.com/{key}'
+
+    def get_bytes(self, key):
+        """ The object contents, or None if it doesn't exist """
+        resp = requests.get(self.public_url(key))
+        return resp.content if resp.status_code == 200 else None
+
+    def put_bytes(self, key, data, content_type='application/octet-stream', public=False):
+        import boto3
+        extra = {'ContentType': content_type}
+        if public:
+            extra['ACL'] = 'public-read'
+
+        with tempfile.TemporaryFile() as fp:
+            fp.write(data)
+            fp.seek(0)
+            boto3.client('s3').upload_fileobj(fp, self.bucket, key, ExtraArgs=extra)
+
+    def put_file(self, key, fn):
+        import boto3
+        boto3.client('s3').upload_file(fn, self.bucket, key)
+
+    def put_encoded_variants(self, key, fn):
+        """ Downloads from S3 go straight to the bucket, which doesn't negotiate encodings """
+        return []
+
+
+class LocalTrayStore:
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+
+    def local_path(self, key):
+        """ Raises a ValueError for a key that would end up outside the store (.., absolute, symlinks) """
+        path = os.path.realpath(os.path.join(self.root, *key.split('/')))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise ValueError(f'Key outside the tray store: {key}')
+        return path
+
+    def public_url(self, key):
+        """ Nothing to redirect to, the web app has to serve these itself """
+        return None
+
+    def get_bytes(self, key):
+        try:
+            with open(self.local_path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_atomic(self, key, write_func):
+        # Readers poll these files while they're being replaced, they must never see half of one
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_func(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def put_bytes(self, key, data, content_type='application/octet-stream', public=False):
+        self._write_atomic(key, lambda f: f.write(data))
+
+    def put_file(self, key, fn):
+        def _copy(f):
+            with open(fn, 'rb') as src:
+                shutil.copyfileobj(src, f)
+
+        # Compressed copies of the old contents would be served in its place
+        for suffix in ENCODING_SUFFIXES.values():
+            if os.path.exists(self.local_path(key + suffix)):
+                os.remove(self.local_path(key + suffix))
+        self._write_atomic(key, _copy)
+
+    def put_encoded_variants(self, key, fn):
+        """ Stores a compressed copy of fn next to key for each encoding we can produce.  Returns the encodings """
+        done = []
+        for encoding, suffix in ENCODING_SUFFIXES.items():
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.local_path(key)), prefix='.tmp_')
+            os.close(fd)
+            try:
+                if compress_file(fn, tmp_path, encoding):
+                    os.replace(tmp_path, self.local_path(key + suffix))
+                    done.append(encoding)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return done
+
+    def encoded_variants(self, key):
+        """ {encoding: path} of every stored copy of key, 'identity' being the object itself """
+        paths = {'identity': self.local_path(key)}
+        paths.update({enc: self.local_path(key + suffix) for enc, suffix in ENCODING_SUFFIXES.items()})
+        return {enc: path for enc, path in paths.items() if os.path.exists(path)}
+
+
+def get_tray_store(s3bucket):
+    """ The S3 bucket, unless GENTRAY_STORE points at a local directory """
+    local_root = os.environ.get('GENTRAY_STORE')
+    if local_root:
+        return LocalTrayStore(local_root)
+    return S3TrayStore(s3bucket)
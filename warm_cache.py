@@ -0,0 +1,311 @@
+#! /usr/bin/python
+"""
+Warm the tray store after a deploy or a cache wipe, by replaying what people
+asked for before.
+
+A new script version changes every tray hash, so right after a deploy the
+store has nothing, and the first person to ask for even the most popular
+tray waits for OpenSCAD.  This pre-renders the trays most likely to be asked
+for next, from three records of past demand:
+
+  * gentray_server.log:  the web app logs the parameters of every form
+    submission as YAML.  Only the previews are counted from it, downloads
+    are in the job index
+  * gentray_script.log:  the generate script logs its arguments as YAML
+    every time it's run from the command line
+  * the job index:  every tray submitted through the web form or the bulk
+    API, with its canonical parameters
+
+Every request is turned back into a canonical tray spec and hashed with the
+current script version, so equivalent trays (other units, mirrored or
+transposed) count as one.  Each request counts for 0.5 ** (age / half-life),
+where a job's age is how long ago it was submitted, and a logged request's
+is the number of later ones in the same log (the logs have no timestamps),
+so trays asked for often AND lately rank first.
+
+The top N that aren't already in the store are rendered one after another,
+the same way the web app does it (so the job index is updated too), at the
+lowest CPU priority, until the renders have used up the CPU budget.  At the
+end it reports how much of the past demand the store now covers, which is
+the hit rate to expect if the next requests look like the last ones.
+
+    python3 warm_cache.py --top 100 --cpu-budget 1800
+    python3 warm_cache.py --top 100 --dry-run
+"""
+import io
+import os
+import re
+import time
+import argparse
+import resource
+import subprocess
+import contextlib
+from ast import literal_eval
+from collections import namedtuple
+
+import yaml
+
+from constants import *
+from generate_tray import LOG_IT, generate_tray_key, parse_tray_spec, check_status, generate_script_args
+from job_index import JobIndex
+
+THIS_SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_S3BUCKET = 'etotheipi-gentray-store'
+
+# Each record starts with the default logging format, "LEVEL:logger:", and runs until the next one
+LOG_RECORD_START = re.compile(r'^(?:DEBUG|INFO|WARNING|ERROR|CRITICAL):[^:\n]*:', re.MULTILINE)
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+# Logged by the form page before it parses a submission (and on every plain GET)
+FORM_PAGE_RECORD = 'gen_tray_form called'
+SEC_PER_DAY = 24 * 3600
+
+TrayDemand = namedtuple('TrayDemand', 'tray_hash params requests score')
+
+
+def iter_log_records(text):
+    starts = list(LOG_RECORD_START.finditer(text))
+    for m, nxt in zip(starts, starts[1:] + [None]):
+        yield text[m.end():nxt.start() if nxt is not None else len(text)]
+
+
+def _load_yaml_record(record):
+    try:
+        values = yaml.load(record, Loader=YAML_LOADER)
+    except yaml.YAMLError:
+        return None
+    return values if isinstance(values, dict) else None
+
+
+def server_log_specs(text):
+    """
+    Tray specs of the previews in the web app's log, oldest first.  The form page logs the params of
+    every submission right after FORM_PAGE_RECORD, and a download logs them again from
+    /process_stl_request (with no FORM_PAGE_RECORD before it).  Downloads are counted from the job
+    index, so that second record takes back the form page's one.
+    """
+    specs = []
+    from_form_page = False
+    for record in iter_log_records(text):
+        if record.startswith(FORM_PAGE_RECORD):
+            from_form_page = True
+        elif 'xlist:' in record and 'ylist:' in record:
+            values = _load_yaml_record(record)
+            if values is None:
+                continue
+            if from_form_page:
+                specs.append(values)
+            elif specs and specs[-1] == values:
+                specs.pop()
+            from_form_page = False
+    return specs
+
+
+def script_log_specs(text):
+    """
+    Tray specs from the argument dumps in the generate script's log, oldest first.  Runs launched
+    by the web app (with --s3bucket) are already counted from its own log and the job index.
+    """
+    specs = []
+    for record in iter_log_records(text):
+        if not record.startswith('bin_sizes:'):
+            continue
+        args = _load_yaml_record(record)
+        if args is None or args.get('s3bucket') or args.get('hardcoded_params'):
+            continue
+        try:
+            xlist, ylist = literal_eval(''.join(args['bin_sizes']).replace(' ', '').replace('][', '],['))
+        except (ValueError, SyntaxError, TypeError, KeyError):
+            continue
+        spec = {'xlist': list(xlist), 'ylist': list(ylist), 'units': 'in' if args.get('unit_is_inches') else 'mm'}
+        spec.update({k: args[k] for k in ('depth', 'wall', 'floor', 'round') if args.get(k) is not None})
+        specs.append(spec)
+    return specs
+
+
+def job_history_specs(job_db):
+    """ (created, canonical params) of every job in the index, oldest first """
+    return [(job['created'], job['params']) for job in JobIndex(job_db).job_history() if job['params'] is not None]
+
+
+def weigh_by_order(specs, half_life=1000.0):
+    """ (spec, weight) for specs with no timestamps, oldest first:  the age is the number of later ones """
+    return [(spec, 0.5 ** ((len(specs) - 1 - i) / half_life)) for i, spec in enumerate(specs)]
+
+
+def weigh_by_time(timed_specs, half_life_sec, now=None):
+    """ (spec, weight) for (created, spec) pairs:  the age is the time since created """
+    now = time.time() if now is None else now
+    return [(spec, 0.5 ** (max(now - created, 0.0) / half_life_sec)) for created, spec in timed_specs]
+
+
+def rank_trays(sources):
+    """
+    sources is a list of (spec, weight) lists.  Returns a TrayDemand for every distinct tray,
+    highest score first.  Specs that don't validate are skipped.
+    """
+    # Hash each distinct spec once, generate_tray_key() logs every hash it computes
+    weights = {}
+    for weighted_specs in sources:
+        for spec, weight in weighted_specs:
+            try:
+                params = parse_tray_spec(spec)
+            except ValueError:
+                continue
+            key = tuple((k, tuple(v) if isinstance(v, list) else v) for k, v in sorted(params.items()))
+            count, score = weights.get(key, (0, 0.0))
+            weights[key] = (count + 1, score + weight)
+
+    trays = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for key, (count, score) in weights.items():
+            tray_hash, _, canon = generate_tray_key(**dict(key))
+            prev = trays.get(tray_hash)
+            if prev is not None:
+                count, score = count + prev.requests, score + prev.score
+            trays[tray_hash] = TrayDemand(tray_hash, canon, count, score)
+
+    return sorted(trays.values(), key=lambda t: (-t.score, -t.requests, t.tray_hash))
+
+
+def children_cpu_sec():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _lowest_priority():
+    os.nice(19)
+
+
+def warm_trays(trays, s3bucket, job_db=None, cpu_budget=None, dry_run=False):
+    """
+    Renders every tray in the list that isn't already complete in the store, in order, until the
+    renders have used cpu_budget CPU-seconds.  Returns {tray_hash: 'cached' | 'rendered' |
+    'failed' | 'skipped'}.
+    """
+    outcome = {}
+    cpu_start = children_cpu_sec()
+    for i, tray in enumerate(trays):
+        if check_status(s3bucket, tray.tray_hash)['status'].lower() == 'complete':
+            outcome[tray.tray_hash] = 'cached'
+            continue
+
+        cpu_used = children_cpu_sec() - cpu_start
+        if dry_run or (cpu_budget is not None and cpu_used >= cpu_budget):
+            outcome[tray.tray_hash] = 'skipped'
+            continue
+
+        LOG_IT(f'Warming {i + 1}/{len(trays)}: {tray.tray_hash} ({tray.requests} requests, '
+               f'{cpu_used:.0f} CPU-sec used)')
+        call_args = generate_script_args(tray.params, s3bucket, tray.tray_hash,
+                                         None if job_db is None else os.path.abspath(job_db))
+        subprocess.run(call_args, cwd=THIS_SCRIPT_PATH, preexec_fn=_lowest_priority,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        ok = check_status(s3bucket, tray.tray_hash)['status'].lower() == 'complete'
+        outcome[tray.tray_hash] = 'rendered' if ok else 'failed'
+    return outcome
+
+
+def projected_hit_rate(trays, in_store):
+    """ Share of the (weighted, and raw) past requests that would be served from the store """
+    total_score = sum(t.score for t in trays) or 1.0
+    total_requests = sum(t.requests for t in trays) or 1
+    hit_score = sum(t.score for t in trays if t.tray_hash in in_store)
+    hit_requests = sum(t.requests for t in trays if t.tray_hash in in_store)
+    return hit_score / total_score, hit_requests / total_requests
+
+
+def read_log(fn):
+    if not os.path.exists(fn):
+        LOG_IT(f'No log at {fn}, skipping it')
+        return ''
+    with open(fn, 'r', errors='replace') as f:
+        return f.read()
+
+
+################################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage="python3 warm_cache.py [--top N] [--cpu-budget SEC] [options]",
+                                     description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top",
+                        dest="top",
+                        default=50,
+                        type=int,
+                        help="How many of the most requested trays to warm (default 50)")
+    parser.add_argument("--cpu-budget",
+                        dest="cpu_budget",
+                        default=None,
+                        type=float,
+                        help="Stop starting renders once they've used this many CPU-seconds (default no limit)")
+    parser.add_argument("--half-life",
+                        dest="half_life",
+                        default=1000.0,
+                        type=float,
+                        help="A logged request counts half as much once there are this many newer ones in its "
+                             "log (default 1000)")
+    parser.add_argument("--half-life-days",
+                        dest="half_life_days",
+                        default=30.0,
+                        type=float,
+                        help="A job in the index counts half as much once it's this many days old (default 30)")
+    parser.add_argument("--server-log",
+                        dest="server_logs",
+                        action='append',
+                        default=None,
+                        help="Web app log(s) to read (default flask_serve/gentray_server.log)")
+    parser.add_argument("--script-log",
+                        dest="script_logs",
+                        action='append',
+                        default=None,
+                        help="Generate script log(s) to read (default gentray_script.log)")
+    parser.add_argument("--job-db",
+                        dest="job_db",
+                        default=os.environ.get('GENTRAY_JOB_DB',
+                                               os.path.join(THIS_SCRIPT_PATH, 'flask_serve', 'gentray_jobs.sqlite3')),
+                        type=str,
+                        help="Job index to read, and to update as trays are rendered (default GENTRAY_JOB_DB, "
+                             "or the web app's)")
+    parser.add_argument("--s3bucket",
+                        dest="s3bucket",
+                        default=DEFAULT_S3BUCKET,
+                        type=str,
+                        help=f"Store to warm (default {DEFAULT_S3BUCKET}, or GENTRAY_STORE if that's set)")
+    parser.add_argument("--dry-run",
+                        dest="dry_run",
+                        action='store_true',
+                        help="Only rank the trays and report the hit rate of what's in the store now")
+    args = parser.parse_args()
+
+    server_logs = args.server_logs or [os.path.join(THIS_SCRIPT_PATH, 'flask_serve', 'gentray_server.log')]
+    script_logs = args.script_logs or [os.path.join(THIS_SCRIPT_PATH, 'gentray_script.log')]
+
+    # Read the script log before anything below appends to it
+    t0 = time.time()
+    sources = {
+        'server log': weigh_by_order([s for fn in server_logs for s in server_log_specs(read_log(fn))],
+                                     args.half_life),
+        'script log': weigh_by_order([s for fn in script_logs for s in script_log_specs(read_log(fn))],
+                                     args.half_life),
+        'job index': weigh_by_time(job_history_specs(args.job_db) if os.path.exists(args.job_db) else [],
+                                   args.half_life_days * SEC_PER_DAY),
+    }
+    trays = rank_trays(list(sources.values()))
+    LOG_IT(f'Ranked {len(trays)} distinct trays from ' +
+           ', '.join(f'{len(specs)} {name} requests' for name, specs in sources.items()) +
+           f' in {time.time() - t0:.1f} sec')
+
+    top = trays[:args.top]
+    t0 = time.time()
+    outcome = warm_trays(top, args.s3bucket, args.job_db, args.cpu_budget, args.dry_run)
+    in_store = {h for h, status in outcome.items() if status in ('cached', 'rendered')}
+    counts = {status: sum(1 for s in outcome.values() if s == status)
+              for status in ('cached', 'rendered', 'failed', 'skipped')}
+
+    LOG_IT(f'Top {len(top)}:  ' + ', '.join(f'{n} {status}' for status, n in counts.items()) +
+           f' in {time.time() - t0:.1f} sec')
+    top_weighted, top_raw = projected_hit_rate(trays, {t.tray_hash for t in top})
+    hit_weighted, hit_raw = projected_hit_rate(trays, in_store)
+    LOG_IT(f'The top {len(top)} trays cover {100 * top_weighted:.1f}% of recent demand '
+           f'({100 * top_raw:.1f}% of all requests)')
+    LOG_IT(f'Projected hit rate from the top {len(top)} now in the store:  {100 * hit_weighted:.1f}% '
+           f'({100 * hit_raw:.1f}% of all requests)')